@@ -1,11 +1,25 @@
 #!/usr/bin/env python3
 
+import argparse
+import array
+import bisect
+import collections
+import contextlib
+import csv
+import fractions
+import hashlib
+import heapq
 import json
+import math
+import mmap
+import operator
 import os
 import random
-import re
+import shutil
+import struct
 import sys
 import time
+from xml.sax.saxutils import escape as xml_escape
 
 #This should be backwards and forwards compatible with python2 or 3
 try:
@@ -32,6 +46,11 @@ else:
                 Return the expanded path to the user's home
                 """
                 return os.path.expanduser('~')
+try:
+    import fcntl
+except ImportError:
+    fcntl = None #Windows, profiles aren't locked
+perf_timer = getattr(time, 'perf_counter', time.time) #Python2 has no perf_counter
 
 # These are defaults
 MAX_MIN = 10
@@ -39,7 +58,12 @@ LEFT_HAND = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
 RIGHT_HAND = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
 ALLOW_SUB_NEGATIVE_ANS = 'no'
 ALLOW_SUB_MULTI_DBL_QUESTION = 'no'
+DIVISION_MODE = 'exact' # How new profiles answer division, one of DIVISION_MODES:
+                        # 'exact' (whole numbers only), 'remainder' (17 / 5 = 3 r 2) or 'fraction' (7 / 3 = 7/3)
+CANONICAL_PROBLEMS = 'no' # Count 3 x 4 and 4 x 3 (and 'x' and '*') as the same problem in new profiles
 REWARD_TIME_SEC = 20
+REWARD_TIME_LEVEL_SEC = 2 # The bonus reward time shrinks by this much every level
+REWARD_TIME_LONG_LEVEL = 10 # Level the bonus reward time starts from double REWARD_TIME_SEC
 KNOWN_OPERATORS = ( '+', '-', '*', 'x', '/' )
 ENCOURAGEMENTS = (
     "I'm sorry, that's not quite right you silly goose!\n\nAnswer: {answer}",
@@ -56,6 +80,7 @@ CONGRATULATIONS = (
 # Paths and where to find things
 USER_HOME = str(Path.home())
 STATE_FILE_DIR = '{}/mathster'.format(USER_HOME)
+STATE_DB_NAME = 'mathster.db' # Database file inside STATE_FILE_DIR for the sqlite storage backend
 SCORING_MATRIX = {
     '*': (
         (10, 1), # less than == 10 is 1 point
@@ -75,6 +100,29 @@ SCORING_MATRIX = {
 }
 
 POINTS_TO_REWARD_VAL = 0.0125 #Every this many points == 1min reward time
+GRADE_OPEN_PROFILES = 64 # Profiles 'grade' keeps loaded at once, the least recently used is saved and dropped
+FEEDBACK_PAUSE_SEC = 1.5 # Pause after showing if an answer was right, 0 skips it. On a terminal Enter skips it early
+COUNTDOWN_TICK_SEC = 1 # How often the time left is redrawn on a terminal while waiting for an answer
+SCHEDULER = 'spaced' # Problem scheduler for profiles that don't pick one ('spaced' or 'random')
+# Spaced repetition settings, intervals are in seconds
+SR_FIRST_INTERVALS = (60, 300) # Wait after the first and second correct answer in a row
+SR_LAPSE_INTERVAL = 20 # Wait after a wrong answer
+SR_DEFAULT_EASE = 2.5
+SR_MIN_EASE = 1.3
+SR_NEW_PROBLEM_TRIES = 8 # Random draws to find a problem that hasn't been seen yet
+LEVELS = 'tiers' # How levels choose problems in new profiles, 'tiers' (every level is a harder slice of the problem space) or 'grid' (every level is the whole space again). Older profiles stay on 'grid'
+LEVEL_TIERS = 10 # Difficulty tiers the problem space is split into (at most 255), levels past the last one draw from the whole space
+LEVEL_TIER_MIN_PROBLEMS = 20 # Fewer tiers are used when there wouldn't be this many problems in each
+LEVEL_TIER_SAMPLE_RATIO = 32 # Tiers holding less than 1/this of the problem space are listed out once per level instead of sampled
+DIFFICULTY_DIGIT_WEIGHT = 2.0 # Difficulty of every operand digit past the first
+DIFFICULTY_CARRY_WEIGHT = 1.0 # Difficulty of every carry, borrow or extra partial product working a problem out takes
+DIFFICULTY_ERROR_WEIGHT = 6.0 # Difficulty of a problem that has always been answered wrong, scaled by its error rate
+JOURNAL_COMPACT_EVERY = 50 # Answers appended to the journal before it's folded into the save state file
+JOURNAL_FSYNC = False # fsync the journal after every answer, safer but slower on some disks
+STORAGE_BACKEND = 'json' # Where profiles are kept, 'json' (one file per profile), 'binary' (one compact file per profile) or 'sqlite'
+LATENCY_MIN_SEC = 0.000001 # Upper bound of the first latency histogram bucket
+LATENCY_BUCKET_GROWTH = 2 ** 0.25 # Every latency bucket is this much wider than the one before (~19%)
+LATENCY_BUCKETS = 128 # Latency buckets per histogram, the last one also holds everything slower (~70 minutes)
 
 ##- Functions -##
 def clear():
@@ -83,37 +131,364 @@ def clear():
     else:
         os.system('cls')
 
-def get_ans(lh, rh, op):
-    ans = None
-    if op == '+':
-        ans =  lh + rh
-    elif op == '-':
-        ans =  lh - rh
-    elif op in [ 'x', '*' ]:
-        ans =  lh * rh
-        op = '*'
-    elif op in [ '/' ]:
-        ans =  lh / rh
-        op = '/'
-    else:
+class PlainRenderer(object):
+    """
+    Draw the game as plain text, one frame after another.
+
+    Used when output isn't a terminal (nothing is cleared) or when the
+    terminal doesn't understand ANSI escape sequences (the screen is cleared
+    with clear() between frames).
+    """
+    def __init__(self, stream=None, clear_screen=False):
+        self.stream = stream or sys.stdout
+        self.clear_screen = clear_screen
+
+    def clear(self):
+        if self.clear_screen:
+            clear()
+
+    def frame(self, text):
+        """
+        Draw the header and problem
+        """
+        self.stream.write(text + '\n')
+        self.stream.flush()
+
+    def refresh(self, text):
+        """
+        Redraw the frame while the learner is typing an answer, plain text
+        can't be changed once it is written so nothing happens
+        """
+        pass
+
+    def prompt(self, text):
+        """
+        Return the prompt to hand to input for the answer
+        """
+        return text
+
+    def feedback(self, text):
+        """
+        Draw text below the answer
+        """
+        self.stream.write(text + '\n')
+        self.stream.flush()
+
+    def pause(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def end_frame(self):
+        """
+        Called once a problem is done with, before the next frame
+        """
+        if self.clear_screen:
+            clear()
+        else:
+            self.stream.write('\n')
+
+class AnsiRenderer(PlainRenderer):
+    """
+    Draw the game on a terminal with ANSI escape sequences.
+
+    The lines of the last frame are remembered and only the ones that changed
+    are rewritten, then everything below the answer prompt is erased. No
+    subprocess is forked to clear the screen. The pause after an answer can be
+    skipped by pressing Enter.
+    """
+    CSI = '\033['
+
+    def __init__(self, stream=None):
+        super(AnsiRenderer, self).__init__(stream)
+        self._lines = None
+        self._feedback_lines = 0
+
+    def clear(self):
+        self.stream.write(self.CSI + 'H' + self.CSI + '2J')
+        self.stream.flush()
+        self._lines = []
+
+    def invalidate(self):
+        """
+        Forget what is on the screen so the next frame is drawn in full
+        """
+        self._lines = None
+
+    def _changed(self, lines):
+        out = []
+        for row, line in enumerate(lines):
+            if row >= len(self._lines) or self._lines[row] != line:
+                out.append('{}{};1H{}2K{}'.format(self.CSI, row + 1, self.CSI, line))
+        return out
+
+    def frame(self, text):
+        lines = text.split('\n')
+        if self._lines is None:
+            self.clear()
+        out = self._changed(lines)
+        #Erase rows left over from a taller frame, the prompt erases everything below itself
+        for row in range(len(lines), len(self._lines)):
+            out.append('{}{};1H{}2K'.format(self.CSI, row + 1, self.CSI))
+        self.stream.write(''.join(out))
+        self.stream.flush()
+        self._lines = lines
+
+    def refresh(self, text):
+        """
+        Rewrite the lines of the frame that changed, then put the cursor back
+        where the learner is typing
+        """
+        lines = text.split('\n')
+        if self._lines is None or len(lines) != len(self._lines) or self._scrolled():
+            return
+        out = self._changed(lines)
+        if out:
+            self.stream.write('\0337' + ''.join(out) + '\0338')
+            self.stream.flush()
+        self._lines = lines
+
+    def prompt(self, text):
+        self._feedback_lines = 1
+        return '{}{};1H{}J{}'.format(self.CSI, len(self._lines or ()) + 1, self.CSI, text)
+
+    def feedback(self, text):
+        self._feedback_lines += text.count('\n') + 2 # Leave room for an extra prompt
+        super(AnsiRenderer, self).feedback(text)
+
+    def pause(self, seconds):
+        if seconds <= 0:
+            return
+        import select
+        ready = select.select([sys.stdin], [], [], seconds)[0]
+        if ready:
+            sys.stdin.readline()
+
+    def _scrolled(self):
+        try:
+            rows = shutil.get_terminal_size().lines
+        except AttributeError:
+            rows = 24
+        return len(self._lines or ()) + self._feedback_lines >= rows
+
+    def end_frame(self):
+        #If the feedback scrolled the screen the remembered lines moved, draw the next frame in full
+        if self._scrolled():
+            self.invalidate()
+
+def make_renderer(stream=None):
+    """
+    Return the best renderer for the output stream
+    """
+    stream = stream or sys.stdout
+    is_tty = hasattr(stream, 'isatty') and stream.isatty()
+    if not is_tty:
+        return PlainRenderer(stream)
+    if os.name == 'posix' and os.environ.get('TERM', '') != 'dumb':
+        return AnsiRenderer(stream)
+    return PlainRenderer(stream, clear_screen=True)
+
+class InputTimeout(Exception):
+    """
+    The deadline passed before a line was entered
+    """
+    pass
+
+class DeadlineInput(object):
+    """
+    Read lines from a terminal without waiting past a deadline.
+
+    Called like text_input(). The stream is watched with selectors (select on
+    Python 2) until a line can be read or the deadline passes, which raises
+    InputTimeout even with half an answer typed. While waiting on_tick is
+    called every tick seconds of time left so a countdown can be redrawn.
+    Without a deadline it waits as long as input() would.
+    """
+    def __init__(self, stream=None, out=None, tick=COUNTDOWN_TICK_SEC, clock=time.time):
+        self.stream = stream or sys.stdin
+        self.out = out or sys.stdout
+        self.tick = tick
+        self.clock = clock
+        self.deadline = None
+        self.on_tick = None
+        try:
+            import selectors
+        except ImportError:
+            self._selector = None
+        else:
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self.stream, selectors.EVENT_READ)
+
+    def _ready(self, timeout):
+        if self._selector is None:
+            import select
+            return bool(select.select([self.stream], [], [], timeout)[0])
+        return bool(self._selector.select(timeout))
+
+    def __call__(self, prompt=''):
+        self.out.write(prompt)
+        self.out.flush()
+        while True:
+            wait = None
+            if self.deadline is not None:
+                wait = self.deadline - self.clock()
+                if wait <= 0:
+                    self.out.write('\n')
+                    self.out.flush()
+                    raise InputTimeout()
+            if self.on_tick is not None:
+                #Wake up as each whole tick of time left runs out so the countdown changes on time
+                wait = (wait % self.tick or self.tick) if wait is not None else self.tick
+            if self._ready(wait):
+                line = self.stream.readline()
+                if not line:
+                    raise EOFError()
+                return line.rstrip('\r\n')
+            if self.on_tick is not None:
+                self.on_tick()
+
+    def close(self):
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+
+def make_input(stream=None):
+    """
+    Return a DeadlineInput when answers are typed on a terminal, otherwise
+    None to read with text_input(), which can't be interrupted
+    """
+    stream = stream or sys.stdin
+    if os.name == 'posix' and hasattr(stream, 'isatty') and stream.isatty():
+        return DeadlineInput(stream)
+    return None
+
+DIVISION_MODES = ('exact', 'remainder', 'fraction')
+
+def _divide(lh, rh, mode=None):
+    """
+    Divide the way a division mode wants the answer, a (quotient, remainder)
+    pair in 'remainder' mode and a Fraction in 'fraction' mode. Otherwise
+    the answer is a whole number, or a float if it doesn't divide.
+    """
+    if mode == 'remainder':
+        return divmod(lh, rh)
+    if mode == 'fraction':
+        return fractions.Fraction(lh, rh)
+    if lh % rh == 0:
+        return lh // rh
+    return float(lh) / rh
+
+OPERATORS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    'x': operator.mul,
+    '/': _divide,
+}
+OPERATOR_ALIASES = {
+    'x': '*',
+}
+COMMUTATIVE_OPERATORS = ('+', '*') # a op b is the same problem as b op a in canonical profiles
+
+def get_ans(lh, rh, op, division=None):
+    try:
+        func = OPERATORS[op]
+    except KeyError:
         print("Unknown operator: '{}'".format(op))
         sys.exit(1)
-    return (ans, op)
+    if op == '/':
+        ans = func(lh, rh, division)
+    else:
+        ans = func(lh, rh)
+    return (ans, OPERATOR_ALIASES.get(op, op))
+
+ANSWER_HINTS = {
+    'remainder': "like 3 r 2",
+    'fraction': "like 7/3 or 2 1/3",
+}
+
+def parse_answer(text, division=None):
+    """
+    Parse a typed answer: a whole number, or for division problems '3 r 2'
+    in 'remainder' mode and '7/3' or '2 1/3' in 'fraction' mode. Raises
+    ValueError if it isn't one.
+    """
+    text = ' '.join(str(text).lower().split()).replace(' /', '/').replace('/ ', '/')
+    if division == 'remainder':
+        quotient, sep, remainder = text.partition('r')
+        if not sep:
+            return (int(text), 0)
+        return (int(quotient), int(remainder))
+    if division == 'fraction':
+        whole, _, part = text.rpartition(' ')
+        value = fractions.Fraction(part)
+        if whole:
+            if value < 0 or value >= 1:
+                raise ValueError("Bad mixed number: {}".format(text))
+            whole = int(whole)
+            value = whole - value if whole < 0 else whole + value
+        return value
+    return int(text)
+
+def format_answer(ans):
+    """
+    Return an answer the way it's typed in
+    """
+    if isinstance(ans, tuple):
+        return '{} r {}'.format(*ans)
+    return str(ans)
 
 def get_score_value(ans, op):
     matrix = SCORING_MATRIX.get(op, None)
     if matrix == None:
         return SCORING_MATRIX['default']
+    if isinstance(ans, tuple):
+        #Remainder answers score on the quotient
+        ans = ans[0]
     for pval, score in matrix:
         if ans <= pval:
             return score
     return score
 
-def gen_tuples(left_hand, right_hand, operators, allow_sub_neg_ans=False, allow_sub_mult_dbl_q=False, **kwargs):
+def score_problem(problem, division=None):
+    """
+    Return the (answer, points) of a problem
+    """
+    lh, rh, op = problem
+    ans, op = get_ans(lh, rh, op, division)
+    return ans, get_score_value(ans, op)
+
+def grade_batch(records, division=None, reward_time=None):
+    """
+    Grade (problem, response, duration) records, returns a (correct, points)
+    pair for each. The bonus is included when duration is within reward_time,
+    a duration of None earns none.
+    """
+    grades = []
+    for problem, response, duration in records:
+        answer, points = score_problem(problem, division)
+        if response != answer:
+            grades.append((False, 0))
+            continue
+        if reward_time is not None and duration is not None and duration <= reward_time:
+            points += SCORING_MATRIX['bonus']
+        grades.append((True, points))
+    return grades
+
+def gen_tuples(left_hand, right_hand, operators, allow_sub_neg_ans=False, allow_sub_mult_dbl_q=False, division=DIVISION_MODE, **kwargs):
     tuples = []
     for lh in left_hand:
         for rh in right_hand:
             for op in operators:
+                if op == '/':
+                    # Division is built from products (lh is the quotient) so there's never a zero divisor or a bad answer
+                    if rh == 0 or (division == 'remainder' and rh < 0):
+                        continue
+                    if division == 'fraction':
+                        tuples.append((lh, rh, op))
+                        continue
+                    for remainder in range(rh if division == 'remainder' else 1):
+                        tuples.append((lh * rh + remainder, rh, op))
+                    continue
                 if op == '-':
                     # We only want subtraction to have postive answers for now
                     if not allow_sub_neg_ans:
@@ -126,388 +501,3593 @@ def gen_tuples(left_hand, right_hand, operators, allow_sub_neg_ans=False, allow_
                 tuples.append((lh, rh, op))
     return tuples
 
-def get_valid_int(minimum=0, maximum=-1, default=None, prompt="Enter Integer (default={default})", error_prompt='Incorrect integer inputed: \'{int_input}\'. Must be an Integer between {minimum} and {maximum}'):
-    prompt = '{}: '.format(prompt)
-    while True:
-        try:
-            int_input = text_input(prompt.format(default=default))
-        except:
-            sys.exit(1)
-        if int_input == '':
-            if default != None:
-                int_input = default
-        if int_input == 'exit':
+class _DivisionBlock(object):
+    """
+    The division problems of a ProblemSpace, built from products.
+
+    Every problem is dividend / divisor with dividend = divisor x quotient
+    (+ remainder in 'remainder' mode) for a quotient from the left hand and a
+    divisor from the right hand numbers, so each one has the kind of answer
+    its mode asks for and none have to be generated and thrown away. Zero is
+    never a divisor. 'fraction' mode divides the left hand numbers by the
+    right hand ones as they are, the answer being a fraction.
+    """
+    def __init__(self, op, left_hand, right_hand, mode):
+        self.op = op
+        self.mode = mode
+        self.left_hand = left_hand
+        if mode == 'remainder':
+            self.divisors = [rh for rh in right_hand if rh > 0]
+        else:
+            self.divisors = [rh for rh in right_hand if rh != 0]
+        #Where the problems of each divisor start within a row
+        self._starts = []
+        total = 0
+        for divisor in self.divisors:
+            self._starts.append(total)
+            total += divisor if mode == 'remainder' else 1
+        self._row_len = total
+        self.size = len(left_hand) * total
+
+    def problem_at(self, idx):
+        row, offset = divmod(idx, self._row_len)
+        col = bisect.bisect_right(self._starts, offset) - 1
+        lh, divisor = self.left_hand[row], self.divisors[col]
+        if self.mode == 'fraction':
+            return (lh, divisor, self.op)
+        return (lh * divisor + offset - self._starts[col], divisor, self.op)
+
+    def index(self, lh, rh):
+        """
+        Return the index of the problem within this block or None
+        """
+        col = _sorted_index(self.divisors, rh)
+        if col is None:
             return None
-        try:
-            int_input = int(int_input)
-            if maximum < 0:
-                if int_input < minimum:
-                    raise ValueError
-            else:
-                if int_input < minimum or int_input > maximum:
-                    raise ValueError
-        except ValueError:
-            max_str = maximum
-            if maximum < 0:
-                max_str = 'inf'
-            print(error_prompt.format(int_input=int_input, minimum=minimum, maximum=max_str))
-            continue
-        break
-    return int_input
+        if self.mode == 'fraction':
+            quotient, remainder = lh, 0
+        else:
+            quotient, remainder = divmod(lh, rh)
+            if remainder and self.mode != 'remainder':
+                return None
+        row = _sorted_index(self.left_hand, quotient)
+        if row is None:
+            return None
+        return row * self._row_len + self._starts[col] + remainder
 
-def get_user_input(prompt='Enter a value (default={default})', allow_empty=False, default=None, yesno=False):
-    prompt = '{}: '.format(prompt)
-    while True:
-        try:
-            resp = text_input(prompt.format(default=default))
-        except:
-            sys.exit(1)
-        if not resp:
-            if default:
-                resp = default
-        if yesno:
-            if resp.lower() in ('yes','y'):
-                return True
-            elif resp.lower() in ('no', 'n'):
-                return False
-            else:
-                print("Invalid response, must be one of 'yes, y, no, n'")
-                continue
-        if allow_empty:
-            return resp
+class _OperatorBlock(object):
+    """
+    All of the problems in a ProblemSpace for a single operator.
+
+    Problems are laid out row by row, one row per left hand number. Every row
+    is a prefix of the (sorted) right hand numbers, so a row can be described
+    by its length alone and the i-th problem can be found with a bisect over
+    the cumulative row lengths instead of enumerating the pairs.
+    """
+    def __init__(self, op, left_hand, right_hand, row_len=None):
+        self.op = op
+        self.left_hand = left_hand
+        self.right_hand = right_hand
+        self._row_len = row_len
+        self._row_ends = None
+        if row_len is None:
+            self.size = len(left_hand) * len(right_hand)
         else:
-            if not resp:
-                print("You must provide an answer")
-                continue
-            else:
-                return resp
+            self._row_ends = []
+            total = 0
+            for lh in left_hand:
+                total += row_len(lh)
+                self._row_ends.append(total)
+            self.size = total
 
-def get_selection_menu(options, enabled_options=None, title=None, loop_title=None, show_all=False, show_done=False):
-    enabled_opts = []
-    if enabled_options:
-        enabled_opts = list(enabled_opts)
-    if title:
-        print(title)
-    if show_done:
-        print("NOTE: enabled = *")
-    while True:
-        for idx, opt in enumerate(options, start=1):
-            pre_str = ''
-            if show_done:
-                pre_str = '[ ]'
-                if opt in enabled_opts:
-                    pre_str = '[*]'
-            print("  {idx} - {pre_str}{opt}".format(idx=idx, pre_str=pre_str, opt=opt))
-        options_len = len(options)
-        extra_opts = 0
-        if show_all:
-            extra_opts += 1
-            all_opt = options_len + extra_opts
-            print("  {opt} - ALL".format(opt=all_opt))
-        if show_done:
-            extra_opts += 1
-            done_opt = options_len + extra_opts
-            print("  {opt} - Done".format(opt=done_opt))
-        try:
-            selection = text_input("Selection: ").strip()
-        except:
-            sys.exit(1)
-        try:
-            sel_idx = int(selection)
-        except ValueError:
-            print("Incorrect option: '{}' . Must be an Integer".format(selection))
-            continue
-        if show_done:
-            if sel_idx == done_opt:
-                break
-        if show_all:
-            if sel_idx == all_opt:
-                for idx, opt in enumerate(options, start=0):
-                    if opt in enabled_opts:
-                        enabled_opts.remove(opt)
-                        continue
-                    enabled_opts.append(opt)
-                if not show_done:
-                    break
-                if loop_title:
-                    print(loop_title)
-                continue
-        if sel_idx < 1 or sel_idx > options_len + extra_opts:
-            print("\nIncorrect option: {selection}. Must be a number from 1 to {max_idx}".format(selection=selection, max_idx=options_len + extra_opts))
-            continue
-        option_val = options[sel_idx-1]
-        if option_val not in enabled_opts:
-            enabled_opts.append(option_val)
+    def problem_at(self, idx):
+        if self._row_ends is None:
+            row, col = divmod(idx, len(self.right_hand))
         else:
-            if show_done:
-                enabled_opts.remove(option_val)
-        if not show_done:
-            break
-    return enabled_opts
+            row = bisect.bisect_right(self._row_ends, idx)
+            col = idx - (self._row_ends[row-1] if row else 0)
+        return (self.left_hand[row], self.right_hand[col], self.op)
 
-def print_results(results):
-    print("Ending results:\n")
-    def human_keys(astr):
+    def index(self, lh, rh):
         """
-        Sorts keys based on human order.. IE 1 is less than 10 etc..
+        Return the index of the problem within this block or None
+        """
+        row = _sorted_index(self.left_hand, lh)
+        col = _sorted_index(self.right_hand, rh)
+        if row is None or col is None:
+            return None
+        if self._row_ends is None:
+            return row * len(self.right_hand) + col
+        start = self._row_ends[row-1] if row else 0
+        if col >= self._row_ends[row] - start:
+            return None
+        return start + col
+
+class _CommutativeBlock(_OperatorBlock):
+    """
+    The problems of a commutative operator with only one of a op b and b op a.
 
-        alist.sort(key=human_keys) sorts in human order
+    When both orders are in the left_hand x right_hand grid the one with the
+    smaller left hand number is kept. What a row drops is the numbers on both
+    sides that are smaller than its own left hand number, always a prefix of
+    the sorted numbers on both sides, so rows are still addressed with
+    bisects instead of enumerating the pairs.
+    """
+    def __init__(self, op, left_hand, right_hand):
+        self._both = sorted(set(left_hand).intersection(right_hand))
+        self._rh_set = set(right_hand)
+        super(_CommutativeBlock, self).__init__(op, left_hand, right_hand, row_len=self._commutative_row_len)
+
+    def _dropped(self, lh, below):
         """
-        keys=[]
-        for elt in re.split(r'(\d+)', astr):
-            elt=elt.swapcase()
-            try: elt=int(elt)
-            except ValueError: pass
-            keys.append(elt)
-        return keys
-    if results['mastered']:
-        print("You MASTERED the following problems! Congratulations!!")
-        prob_text = list()
-        for mastered in results['mastered']:
-            prob_text.append("  {0} {2} {1}".format(*mastered))
-        print('  \n'.join(sorted(prob_text, key=human_keys)))
-    if results['needs_work']:
-        print("\nHere are some problems you should work some more on:")
-        needs_work_text = list()
-        for needs_work in results['needs_work']:
-            needs_work_text.append("  {0} {2} {1}".format(*needs_work))
-        print('  \n'.join(sorted(needs_work_text, key=human_keys)))
-    else:
-        print("You didn't seem to encounter any problems you couldn't solve! Way to go!")
+        Return how many of the right hand numbers less than below row lh drops
+        """
+        if lh not in self._rh_set:
+            return 0
+        return bisect.bisect_left(self._both, min(lh, below))
 
-def load_state(new=False):
-    state = {}
-    if new:
-        print("Creating new state profile...")
-        state['results'] = {
-            'needs_work': [],
-            'mastered': [],
-        }
-        state['level'] = 1
-        state['score'] = 0
-        
-    if os.path.isfile(STATE_FILE):
-        with open(STATE_FILE, 'r') as sfile:
-            state = json.load(sfile)
-    elif not new:
-        print("Cannot find save state file: {}".format(STATE_FILE))
-    if not 'left_hand' in state:
-        left_hand = get_user_input(prompt="Enter the left hand set of number you'd like to use for generating problems. Numbers should be comma separated (default={default})", default=','.join([str(i) for i in LEFT_HAND]))
-        state['left_hand'] = [int(i) for i in left_hand.split(',')]
-    if not 'right_hand' in state:
-        right_hand = get_user_input(prompt="Enter the right hand set of number you'd like to use for generating problems. Numbers should be comma separated (default={default})", default=','.join([str(i) for i in RIGHT_HAND]))
-        state['right_hand'] = [int(i) for i in right_hand.split(',')]
-    if not 'operators' in state:
-        operators = None
-        if 'results' in state:
-            if state['results']['mastered']:
-                operators = state['results']['mastered'][0][2]
-            elif state['results']['needs_work']:
-                operators = state['results']['needs_work'][0][2]
-        elif state['tuples']:
-            operators = state['tuples'][0][2]
-        if not operators:
-            operators = get_selection_menu(options=KNOWN_OPERATORS, title="Enter the operators to use for problems", show_done=True)
-        state['operators'] = operators
-    #Make sure that we are using known operators
-    if not set(KNOWN_OPERATORS).intersection(set(state['operators'])) == set(state['operators']):
-        unknown_ops= set(state['operators']).difference(set(KNOWN_OPERATORS))
-        print("ERROR! Unknown operator(s): {}".format(', '.join(unknown_ops)))
-        sys.exit(1)
-    if '-' in state['operators']:
-        if not 'allow_sub_neg_ans' in state:
-            allow_sub_neg_ans = get_user_input(prompt="Would you like to allow negative answers for subtraction? (default={default})", default=ALLOW_SUB_NEGATIVE_ANS, yesno=True)
-            state['allow_sub_neg_ans'] = allow_sub_neg_ans
-        if not 'allow_sub_mult_dbl_q' in state:
-            allow_sub_mult_dbl_q = get_user_input(prompt="Would you like to allow two double digits to be subracted? (default={default})", default=ALLOW_SUB_MULTI_DBL_QUESTION, yesno=True)
-            state['allow_sub_mult_dbl_q'] = allow_sub_mult_dbl_q
-    if 'rewards_enabled' not in state:
-        state['rewards_enabled'] = get_user_input(prompt="Would you like to enable 'reward minutes' for this profile? (y/n)", yesno=True)
-    return state
+    def _commutative_row_len(self, lh):
+        return len(self.right_hand) - self._dropped(lh, lh)
 
-def redeem_reward_mins(reward_mins, minimum_to_prompt=10):
-    reward_mins = int(reward_mins)
-    if reward_mins >= minimum_to_prompt:
-        while True:
-            if get_user_input(prompt="Are you here to redeem your rewards mins? (y/n)", yesno=True, default='no'):
-                redeem_amount = get_valid_int(
-                    prompt="How many reward minutes would you like to redeem, current balance: {}".format(reward_mins),
-                    error_prompt="I'm sorry, you don't have that many minutes. Must enter a number between {minimum} and {maximum}",
-                    maximum=int(reward_mins)
-                )
-                if get_user_input(prompt="You're about to redeem: {} minutes, is that correct? (y/n)".format(redeem_amount), yesno=True):
-                    reward_mins -= redeem_amount
+    def problem_at(self, idx):
+        row = bisect.bisect_right(self._row_ends, idx)
+        pos = idx - (self._row_ends[row-1] if row else 0)
+        lh = self.left_hand[row]
+        #Find the first column with pos + 1 kept numbers up to and including it
+        lo, hi = pos, len(self.right_hand) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mid + 1 - self._dropped(lh, self.right_hand[mid] + 1) < pos + 1:
+                lo = mid + 1
+            else:
+                hi = mid
+        return (lh, self.right_hand[lo], self.op)
+
+    def index(self, lh, rh):
+        row = _sorted_index(self.left_hand, lh)
+        col = _sorted_index(self.right_hand, rh)
+        if row is None or col is None:
+            return None
+        if rh < lh and lh in self._rh_set and _sorted_index(self._both, rh) is not None:
+            return None
+        return (self._row_ends[row-1] if row else 0) + col - self._dropped(lh, rh)
+
+def _sorted_index(seq, value):
+    """
+    Return the index of value within the sorted sequence seq, or None
+    """
+    idx = bisect.bisect_left(seq, value)
+    if idx < len(seq) and seq[idx] == value:
+        return idx
+    return None
+
+class ProblemSpace(object):
+    """
+    A lazy, index addressable version of gen_tuples().
+
+    Holds the same problems gen_tuples() would generate for the settings, but
+    computes each one from its index on demand. Size, lookup, membership and
+    uniform sampling never have to materialize the whole grid, and the
+    subtraction filters are applied arithmetically per left hand number.
+
+    A canonical space holds one problem per equivalence class instead:
+    operators are replaced by their OPERATOR_ALIASES and only one order of
+    each COMMUTATIVE_OPERATORS pair is kept, see canonical().
+    """
+    def __init__(self, left_hand, right_hand, operators, allow_sub_neg_ans=False, allow_sub_mult_dbl_q=False, canonical=False, division=DIVISION_MODE, **kwargs):
+        self.left_hand = sorted(set(left_hand))
+        self.right_hand = sorted(set(right_hand))
+        self.is_canonical = bool(canonical)
+        self.division = division
+        self.operators = []
+        for op in operators:
+            if self.is_canonical:
+                op = OPERATOR_ALIASES.get(op, op)
+            if op not in self.operators:
+                self.operators.append(op)
+        self.allow_sub_neg_ans = allow_sub_neg_ans
+        self.allow_sub_mult_dbl_q = allow_sub_mult_dbl_q
+        self._blocks = []
+        self._block_ends = []
+        self._block_by_op = {}
+        total = 0
+        for op in self.operators:
+            block = self._make_block(op)
+            total += block.size
+            self._blocks.append(block)
+            self._block_ends.append(total)
+            self._block_by_op[op] = block
+        self.size = total
+
+    def _make_block(self, op):
+        if op == '/':
+            return _DivisionBlock(op, self.left_hand, self.right_hand, self.division)
+        if self.is_canonical and op in COMMUTATIVE_OPERATORS:
+            return _CommutativeBlock(op, self.left_hand, self.right_hand)
+        if op == '-' and not (self.allow_sub_neg_ans and self.allow_sub_mult_dbl_q):
+            return _OperatorBlock(op, self.left_hand, self.right_hand, row_len=self._sub_row_len)
+        return _OperatorBlock(op, self.left_hand, self.right_hand)
+
+    def _sub_row_len(self, lh):
+        row_len = len(self.right_hand)
+        # We only want subtraction to have postive answers for now
+        if not self.allow_sub_neg_ans:
+            row_len = min(row_len, bisect.bisect_right(self.right_hand, lh))
+        # We only want subtraction to be one double digit minus a single digit
+        if not self.allow_sub_mult_dbl_q and lh >= 10:
+            row_len = min(row_len, bisect.bisect_left(self.right_hand, 10))
+        return row_len
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.size
+        if idx < 0 or idx >= self.size:
+            raise IndexError('Problem index out of range')
+        block_idx = bisect.bisect_right(self._block_ends, idx)
+        start = self._block_ends[block_idx-1] if block_idx else 0
+        return self._blocks[block_idx].problem_at(idx - start)
+
+    def __iter__(self):
+        for block in self._blocks:
+            for idx in range(block.size):
+                yield block.problem_at(idx)
+
+    def __contains__(self, problem):
+        return self.index(problem) is not None
+
+    def index(self, problem):
+        """
+        Return the index of problem within the space, or None if it isn't part of it
+        """
+        try:
+            lh, rh, op = problem
+        except (TypeError, ValueError):
+            return None
+        block = self._block_by_op.get(op)
+        if block is None:
+            return None
+        idx = block.index(lh, rh)
+        if idx is None:
+            return None
+        block_idx = self._blocks.index(block)
+        return idx + (self._block_ends[block_idx-1] if block_idx else 0)
+
+    def canonical(self, problem):
+        """
+        Return the problem of this space that stands for problem. In a
+        canonical space that's the aliased operator, in whichever order is
+        part of the space, anything else is returned as is.
+        """
+        lh, rh, op = problem
+        if not self.is_canonical:
+            return (lh, rh, op)
+        op = OPERATOR_ALIASES.get(op, op)
+        if op in COMMUTATIVE_OPERATORS and (lh, rh, op) not in self and (rh, lh, op) in self:
+            return (rh, lh, op)
+        return (lh, rh, op)
+
+    def display(self, problem, rng=random):
+        """
+        Return problem the way it should be shown. In a canonical space a
+        commutative problem is shown either way round at random.
+        """
+        if self.is_canonical and problem[2] in COMMUTATIVE_OPERATORS and rng.random() < 0.5:
+            return (problem[1], problem[0], problem[2])
+        return problem
+
+    def sample(self, rng=random):
+        """
+        Return a uniformly chosen problem from the space
+        """
+        if not self.size:
+            raise IndexError('Cannot choose from an empty problem space')
+        return self[rng.randrange(self.size)]
+
+class ProblemPool(object):
+    """
+    A set of problems with constant time add, remove, membership and choice.
+
+    Problems live in a list for uniform random choice and a dict maps each
+    problem to its position in that list. Removal swaps the last problem into
+    the freed slot so nothing has to be shifted. Problems are always stored as
+    tuples, so lists that came back from JSON compare equal to them.
+    """
+    def __init__(self, problems=()):
+        self._items = []
+        self._index = {}
+        for problem in problems:
+            self.add(problem)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __bool__(self):
+        return len(self._items) > 0
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __contains__(self, problem):
+        return tuple(problem) in self._index
+
+    def add(self, problem):
+        """
+        Add a problem to the pool, returns False if it was already there
+        """
+        problem = tuple(problem)
+        if problem in self._index:
+            return False
+        self._index[problem] = len(self._items)
+        self._items.append(problem)
+        return True
+
+    def discard(self, problem):
+        """
+        Remove a problem from the pool, returns False if it wasn't there
+        """
+        idx = self._index.pop(tuple(problem), None)
+        if idx is None:
+            return False
+        last = self._items.pop()
+        if idx < len(self._items):
+            self._items[idx] = last
+            self._index[last] = idx
+        return True
+
+    def remove(self, problem):
+        """
+        Remove a problem from the pool, raises KeyError if it wasn't there
+        """
+        if not self.discard(problem):
+            raise KeyError(problem)
+
+    def choice(self, rng=random):
+        """
+        Return a uniformly chosen problem from the pool
+        """
+        if not self._items:
+            raise IndexError('Cannot choose from an empty pool')
+        return self._items[rng.randrange(len(self._items))]
+
+    def clear(self):
+        self._items = []
+        self._index = {}
+
+    def to_list(self):
+        """
+        Return the problems as a sorted list for saving
+        """
+        return sorted(self._items)
+
+def _carries(a, b):
+    """
+    Return the carries adding a and b (both positive) column by column takes
+    """
+    carries = carry = 0
+    while a or b:
+        carry = 1 if a % 10 + b % 10 + carry >= 10 else 0
+        carries += carry
+        a //= 10
+        b //= 10
+    return carries
+
+def _borrows(a, b):
+    """
+    Return the borrows subtracting b from a (a >= b >= 0) column by column takes
+    """
+    borrows = borrow = 0
+    while b or borrow:
+        borrow = 1 if a % 10 - b % 10 - borrow < 0 else 0
+        borrows += borrow
+        a //= 10
+        b //= 10
+    return borrows
+
+def _product_steps(a, b):
+    """
+    Return the carries plus the extra partial products multiplying a by b
+    (both positive) long hand takes
+    """
+    steps = partials = 0
+    while b:
+        digit = b % 10
+        if digit:
+            partials += 1
+            rest, carry = a, 0
+            while rest:
+                carry = (rest % 10 * digit + carry) // 10
+                steps += 1 if carry else 0
+                rest //= 10
+        b //= 10
+    return steps + max(partials - 1, 0)
+
+def problem_difficulty(problem, error_rate=0.0):
+    """
+    Return how hard a problem is: DIFFICULTY_DIGIT_WEIGHT for every operand
+    digit past the first, DIFFICULTY_CARRY_WEIGHT for every carry, borrow or
+    extra partial product working it out takes (and for a negative answer or
+    a remainder) and DIFFICULTY_ERROR_WEIGHT scaled by error_rate, the
+    fraction of the times it was answered wrong.
+    """
+    lh, rh, op = problem
+    op = OPERATOR_ALIASES.get(op, op)
+    a, b = abs(lh), abs(rh)
+    if op == '/':
+        #Worked out as the product the problem was built from
+        quotient, remainder = divmod(a, b) if b else (0, 0)
+        steps = _product_steps(quotient, b) + (1 if remainder else 0)
+    elif op == '*':
+        steps = _product_steps(a, b)
+    else:
+        if op == '-':
+            rh = -rh
+        if (lh < 0) == (rh < 0):
+            steps = _carries(a, b)
+        else:
+            steps = _borrows(max(a, b), min(a, b))
+        if lh + rh < 0:
+            steps += 1
+    digits = len(str(a)) + len(str(b)) - 2
+    return DIFFICULTY_DIGIT_WEIGHT * digits + DIFFICULTY_CARRY_WEIGHT * steps + DIFFICULTY_ERROR_WEIGHT * error_rate
+
+LEVEL_MODES = ('tiers', 'grid')
+_SCORE_COUNTS = {} # Tier key -> {difficulty: problems}, the spaces scored so far
+
+class DifficultyTiers(object):
+    """
+    The problems of a ProblemSpace bucketed into tiers of increasing difficulty.
+
+    Tiers are worked out once, when a profile first uses them, and saved
+    with it as 'tiers': how many problems have each difficulty score is
+    counted over the space and the scores are split into LEVEL_TIERS runs of
+    about the same number of problems. Only the lowest score of every tier
+    and its size are kept, along with the error rates the scores used, so
+    the tiers don't move as the learner's stats change. Whether a problem is
+    in a tier is worked out from its own score, nothing is enumerated on load.
+    """
+    def __init__(self, space, lows, sizes, errors=None):
+        self.space = space
+        self.lows = lows
+        self.sizes = sizes
+        self.errors = errors or {} # problem -> error rate when the tiers were built
+
+    @staticmethod
+    def key(space, tiers, min_problems):
+        """
+        Return what the tiers of a space were built for, they're rebuilt when it changes
+        """
+        settings = [space.left_hand, space.right_hand, space.operators, bool(space.allow_sub_neg_ans), bool(space.allow_sub_mult_dbl_q),
+                    space.is_canonical, space.division, DIFFICULTY_DIGIT_WEIGHT, DIFFICULTY_CARRY_WEIGHT, DIFFICULTY_ERROR_WEIGHT, tiers, min_problems]
+        return hashlib.sha1(json.dumps(settings).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def build(cls, space, latency=None, tiers=LEVEL_TIERS, min_problems=LEVEL_TIER_MIN_PROBLEMS):
+        """
+        Bucket the problems of a space into tiers, with the error rates in latency.
+        The scores without errors are counted once per space and process.
+        """
+        key = cls.key(space, tiers, min_problems)
+        counts = _SCORE_COUNTS.get(key)
+        if counts is None:
+            counts = {}
+            for problem in space:
+                score = problem_difficulty(problem)
+                counts[score] = counts.get(score, 0) + 1
+            _SCORE_COUNTS[key] = counts
+        errors = {}
+        if latency is not None:
+            counts = dict(counts)
+            for problem, wrong in latency.errors.items():
+                if not wrong or problem not in space:
+                    continue
+                answers = latency.answers(problem)
+                errors[problem] = min(float(wrong) / answers, 1.0) if answers else 1.0
+                score = problem_difficulty(problem)
+                counts[score] -= 1
+                score = problem_difficulty(problem, errors[problem])
+                counts[score] = counts.get(score, 0) + 1
+        count = max(1, min(tiers, 255, len(space) // max(min_problems, 1)))
+        lows, sizes = [], []
+        total = 0
+        for score in sorted(counts):
+            if not counts[score]:
+                continue
+            #A new tier starts once the ones so far hold their share of the space
+            if not lows or total >= len(space) * len(lows) // count:
+                lows.append(score)
+                sizes.append(0)
+            sizes[-1] += counts[score]
+            total += counts[score]
+        tiers = cls(space, lows or [0.0], sizes or [0], errors)
+        tiers.built_for = key
+        return tiers
+
+    @classmethod
+    def from_dict(cls, space, data, tiers=LEVEL_TIERS, min_problems=LEVEL_TIER_MIN_PROBLEMS):
+        """
+        Load tiers saved by to_dict(), None when there are none for this space
+        """
+        if not data or data.get('key') != cls.key(space, tiers, min_problems):
+            return None
+        loaded = cls(space, data['lows'], data['sizes'], dict((tuple(row[:3]), row[3]) for row in data.get('errors', ())))
+        loaded.built_for = data['key']
+        return loaded
+
+    def to_dict(self):
+        return {
+            'key': self.built_for,
+            'lows': self.lows,
+            'sizes': self.sizes,
+            'errors': [list(problem) + [self.errors[problem]] for problem in sorted(self.errors)],
+        }
+
+    def __len__(self):
+        return len(self.lows)
+
+    def tier(self, problem):
+        """
+        Return the tier a problem of the space is in
+        """
+        problem = tuple(problem)
+        return bisect.bisect_right(self.lows, problem_difficulty(problem, self.errors.get(problem, 0.0))) - 1
+
+    def level(self, level):
+        """
+        Return the problems a level draws from, its tier or the whole space
+        for the levels past the last tier
+        """
+        if level > len(self.lows):
+            return self.space
+        return _TierView(self, max(level, 1) - 1)
+
+class _TierView(object):
+    """
+    One tier of DifficultyTiers, sampled like a ProblemSpace.
+
+    Problems are drawn from the space until one is in the tier. A tier that
+    is only a small part of the space (less than 1/LEVEL_TIER_SAMPLE_RATIO)
+    is listed out instead, the first time it is sampled.
+    """
+    def __init__(self, tiers, tier):
+        self.tiers = tiers
+        self.tier = tier
+        self.size = tiers.sizes[tier]
+        self._members = None
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        if self._members is not None:
+            return iter(self._members)
+        return (problem for problem in self.tiers.space if self.tiers.tier(problem) == self.tier)
+
+    def __contains__(self, problem):
+        return tuple(problem) in self.tiers.space and self.tiers.tier(problem) == self.tier
+
+    def sample(self, rng=random):
+        """
+        Return a uniformly chosen problem from the tier
+        """
+        if not self.size:
+            raise IndexError('Cannot choose from an empty tier')
+        if self._members is None and len(self.tiers.space) > self.size * LEVEL_TIER_SAMPLE_RATIO:
+            self._members = list(self)
+        if self._members is not None:
+            return self._members[rng.randrange(len(self._members))]
+        while True:
+            problem = self.tiers.space.sample(rng)
+            if self.tiers.tier(problem) == self.tier:
+                return problem
+
+class ProblemLibrary(object):
+    """
+    The problems of a ProblemSpace that have not been retired yet.
+
+    This replaces the old materialized 'tuples' list. Only the retired
+    problems (mastered twice) are stored, everything else is computed from the
+    space. Sampling rejects retired problems until most of the space has been
+    retired, at which point the (by then small) remainder is materialized.
+
+    Given DifficultyTiers only the problems of the level's tier are in the
+    library, and reset() moves it on to the tier of the next level.
+    """
+    def __init__(self, space, retired=(), tiers=None, level=1):
+        self.space = space
+        self.tiers = tiers
+        #What the library draws from, the whole space or the level's tier
+        self.problems = space if tiers is None else tiers.level(level)
+        if tiers is None and isinstance(retired, ProblemPool):
+            #Kept as is, a MappedProblemPool answers from the save state file without being decoded
+            self.retired = retired
+        else:
+            self.retired = ProblemPool(p for p in retired if tuple(p) in self.problems)
+        self._remaining = None
+
+    def __len__(self):
+        return len(self.problems) - len(self.retired)
+
+    def __bool__(self):
+        return len(self) > 0
+    __nonzero__ = __bool__
+
+    def __contains__(self, problem):
+        return problem not in self.retired and tuple(problem) in self.problems
+
+    def choice(self, rng=random):
+        """
+        Return a uniformly chosen problem that hasn't been retired
+        """
+        if not self:
+            raise IndexError('Cannot choose from an empty library')
+        if self._remaining is None:
+            if len(self.retired) * 2 <= len(self.problems):
+                while True:
+                    problem = self.problems.sample(rng)
+                    if problem not in self.retired:
+                        return problem
+            self._remaining = ProblemPool(p for p in self.problems if p not in self.retired)
+        return self._remaining.choice(rng)
+
+    def remove(self, problem):
+        """
+        Retire a problem so that it isn't chosen anymore
+        """
+        if problem in self.retired or tuple(problem) not in self.problems:
+            return
+        self.retired.add(problem)
+        if self._remaining is not None:
+            self._remaining.discard(problem)
+
+    def append(self, problem):
+        """
+        Put a retired problem back into the library
+        """
+        if self.retired.discard(problem) and self._remaining is not None:
+            self._remaining.add(problem)
+
+    def reset(self, level=None):
+        """
+        Put every problem back into the library, with tiers the problems of
+        level's tier
+        """
+        if self.tiers is not None and level is not None:
+            self.problems = self.tiers.level(level)
+        self.retired.clear()
+        self._remaining = None
+
+def canonicalize_state(save_data, space):
+    """
+    Move the problems of a save state that doesn't use canonical problems
+    yet onto the problems of the canonical space, in place.
+
+    A problem is mastered or needs work if any of its old forms was, and
+    stays retired only if every old form was. Schedules keep whichever form
+    is due first and latency stats are merged.
+    """
+    old_space = ProblemSpace(**dict(save_data, canonical=False))
+    def old_forms(problem):
+        lh, rh, op = problem
+        ops = [op] + [alias for alias, target in OPERATOR_ALIASES.items() if target == op]
+        pairs = [(lh, rh), (rh, lh)] if op in COMMUTATIVE_OPERATORS else [(lh, rh)]
+        return [(a, b, o) for a, b in pairs for o in ops if (a, b, o) in old_space]
+    results = save_data['results']
+    for bucket in ('mastered', 'needs_work'):
+        results[bucket] = ProblemPool(space.canonical(problem) for problem in results[bucket])
+    retired = ProblemPool(save_data.get('retired', ()))
+    save_data['retired'] = ProblemPool(
+        problem for problem in set(space.canonical(old) for old in retired)
+        if problem not in results['needs_work'] and all(form in retired for form in old_forms(problem))
+    )
+    if save_data.get('schedule'):
+        schedule = {}
+        for row in save_data['schedule']:
+            problem = space.canonical(row[:3])
+            #row[7] is when the problem is due
+            if problem not in schedule or row[7] < schedule[problem][7]:
+                schedule[problem] = list(problem) + list(row[3:])
+        save_data['schedule'] = [schedule[problem] for problem in sorted(schedule)]
+    if save_data.get('latency'):
+        #Merged in place, a running Session may already hold on to the stats
+        latency = save_data['latency'] = LatencyStats.from_dict(save_data['latency'])
+        problems, operators, errors, untimed, timeouts = latency.problems, latency.operators, latency.errors, latency.untimed, latency.timeouts
+        latency.problems, latency.operators, latency.errors, latency.untimed, latency.timeouts = {}, {}, {}, {}, {}
+        for problem, hist in problems.items():
+            latency._hist(latency.problems, space.canonical(problem)).merge(hist)
+        for op, hist in operators.items():
+            latency._hist(latency.operators, OPERATOR_ALIASES.get(op, op)).merge(hist)
+        for problem, count in errors.items():
+            problem = space.canonical(problem)
+            latency.errors[problem] = latency.errors.get(problem, 0) + count
+        for problem, count in untimed.items():
+            problem = space.canonical(problem)
+            latency.untimed[problem] = latency.untimed.get(problem, 0) + count
+        for problem, count in timeouts.items():
+            problem = space.canonical(problem)
+            latency.timeouts[problem] = latency.timeouts.get(problem, 0) + count
+    save_data['canonical_problems'] = True
+
+def _drop_division_problems(save_data, space):
+    """
+    Forget the division problems of a save state that aren't part of its
+    space. Older versions paired every left and right hand number, giving
+    problems without whole number answers and with zero divisors.
+    """
+    def stale(problem):
+        return problem[2] == '/' and tuple(problem) not in space
+    for bucket in ('mastered', 'needs_work'):
+        pool = save_data['results'][bucket]
+        for problem in [p for p in pool if stale(p)]:
+            pool.discard(problem)
+    if any(stale(problem) for problem in save_data.get('retired', ())):
+        save_data['retired'] = ProblemPool(p for p in save_data['retired'] if not stale(p))
+    if save_data.get('schedule'):
+        save_data['schedule'] = [row for row in save_data['schedule'] if not stale(row[:3])]
+
+def load_library(save_data):
+    """
+    Build the ProblemLibrary for a save state.
+
+    Older save files stored every remaining problem under 'tuples', those are
+    converted to the set of retired problems. Save states that just switched
+    to canonical problems are migrated with canonicalize_state(). Profiles
+    with 'tiers' levels get the DifficultyTiers saved with them (built the
+    first time) and the library holds the tier of the profile's level.
+    """
+    space = ProblemSpace(**save_data)
+    if 'tuples' in save_data:
+        remaining = set(tuple(p) for p in save_data['tuples'])
+        #Only what the old left_hand x right_hand grid had can have been
+        #retired, division problems built from products start out unretired
+        left_hand, right_hand = set(space.left_hand), set(space.right_hand)
+        save_data['retired'] = ProblemPool(p for p in ProblemSpace(**dict(save_data, canonical=False))
+                                           if p[0] in left_hand and p[1] in right_hand and p not in remaining)
+        del save_data['tuples']
+    if '/' in space.operators:
+        _drop_division_problems(save_data, space)
+    if space.is_canonical and not save_data.get('canonical_problems'):
+        canonicalize_state(save_data, space)
+    elif not space.is_canonical:
+        save_data.pop('canonical_problems', None)
+    #Profiles from before tiers keep their levels unless they opt in
+    levels = save_data.get('levels', 'grid')
+    if levels not in LEVEL_MODES:
+        print("ERROR! Unknown levels: {}".format(levels))
+        sys.exit(1)
+    tiers = None
+    if levels == 'tiers':
+        tiers = DifficultyTiers.from_dict(space, save_data.get('tiers'), LEVEL_TIERS, LEVEL_TIER_MIN_PROBLEMS)
+        if tiers is None:
+            tiers = DifficultyTiers.build(space, LatencyStats.from_dict(save_data.get('latency')), LEVEL_TIERS, LEVEL_TIER_MIN_PROBLEMS)
+            save_data['tiers'] = tiers.to_dict()
+    return ProblemLibrary(space, save_data.get('retired', ()), tiers=tiers, level=save_data.get('level', 1))
+
+class RandomScheduler(object):
+    """
+    The original problem selection, weighted coin flips between needs_work and
+    the library.
+    """
+    name = 'random'
+
+    def __init__(self, library, results, schedule=(), rng=random):
+        self.library = library
+        self.results = results
+        self.rng = rng
+
+    def next_problem(self, now=None):
+        """
+        Return the next problem to work on
+        """
+        needs_work = self.results['needs_work']
+        if needs_work:
+            if len(needs_work) > 4:
+                #If there are more than 4 problems that need work, then favor the ones that need more work
+                pick_needs_work = self.rng.choice([True, True, False])
+            else:
+                #If there are 1-4 problems that need work then slightly favor one from the main pool of tuples
+                pick_needs_work = self.rng.choice([True, False, False])
+            if pick_needs_work or not self.library:
+                return needs_work.choice(self.rng)
+        return self.library.choice(self.rng)
+
+    def record(self, problem, correct, duration, reward_time, now=None):
+        """
+        Record the outcome of an answer
+        """
+        pass
+
+    def forget(self, problem):
+        """
+        Stop scheduling a problem, called once it has been retired
+        """
+        pass
+
+    def reset(self):
+        """
+        Forget everything, called on level up
+        """
+        pass
+
+    def metadata(self, problem):
+        """
+        Return the scheduling metadata kept for a problem, if any
+        """
+        return None
+
+    def to_list(self):
+        """
+        Return the scheduling metadata for saving
+        """
+        return []
+
+class SpacedRepetitionScheduler(RandomScheduler):
+    """
+    Schedule problems with SM-2 style spaced repetition.
+
+    Every problem that has been answered gets an ease factor and an interval.
+    Correct answers grow the interval (quicker answers grow it more), wrong
+    answers reset it to SR_LAPSE_INTERVAL and lower the ease. A heap keyed by
+    the next due time gives the problem to review in O(log n); when nothing is
+    due a problem that hasn't been seen yet is drawn from the library.
+    Stale heap entries are skipped lazily when they reach the top.
+    """
+    name = 'spaced'
+
+    def __init__(self, library, results, schedule=(), rng=random):
+        super(SpacedRepetitionScheduler, self).__init__(library, results, rng=rng)
+        # problem -> [ease, interval, reps, lapses, due, last_seen, last_dur]
+        self.meta = {}
+        self._heap = []
+        self._counter = 0
+        self._entries = {}
+        for row in schedule:
+            problem = tuple(row[:3])
+            if problem in library or problem in results['needs_work']:
+                self.meta[problem] = list(row[3:])
+                self._add(problem)
+        # Problems missed before scheduling metadata was kept are due right away
+        for problem in results['needs_work']:
+            if problem not in self.meta:
+                self.meta[problem] = [SR_DEFAULT_EASE, 0, 0, 1, 0, 0, 0]
+                self._add(problem)
+        heapq.heapify(self._heap)
+
+    def _add(self, problem):
+        """
+        _push() without keeping the heap in order, for loading
+        """
+        self._counter += 1
+        self._entries[problem] = self._counter
+        self._heap.append((self.meta[problem][4], self._counter, problem))
+
+    def _push(self, problem):
+        self._counter += 1
+        self._entries[problem] = self._counter
+        heapq.heappush(self._heap, (self.meta[problem][4], self._counter, problem))
+
+    def _peek(self):
+        while self._heap:
+            due, counter, problem = self._heap[0]
+            if self._entries.get(problem) == counter:
+                return due, problem
+            heapq.heappop(self._heap)
+        return None, None
+
+    def next_problem(self, now=None):
+        if now is None:
+            now = time.time()
+        due, problem = self._peek()
+        if problem is not None and due <= now:
+            return problem
+        if self.library:
+            for _ in range(SR_NEW_PROBLEM_TRIES):
+                candidate = self.library.choice(self.rng)
+                if candidate not in self.meta:
+                    return candidate
+        if problem is not None:
+            return problem
+        return super(SpacedRepetitionScheduler, self).next_problem(now)
+
+    def record(self, problem, correct, duration, reward_time, now=None):
+        if now is None:
+            now = time.time()
+        problem = tuple(problem)
+        ease, interval, reps, lapses = self.meta.get(problem, [SR_DEFAULT_EASE, 0, 0, 0])[:4]
+        if not correct:
+            quality = 1
+        elif duration > reward_time:
+            quality = 3
+        elif duration > reward_time / 2.0:
+            quality = 4
+        else:
+            quality = 5
+        ease = max(SR_MIN_EASE, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+        if correct:
+            reps += 1
+            if reps <= len(SR_FIRST_INTERVALS):
+                interval = SR_FIRST_INTERVALS[reps-1]
+            else:
+                interval = interval * ease
+        else:
+            reps = 0
+            lapses += 1
+            interval = SR_LAPSE_INTERVAL
+        self.meta[problem] = [ease, interval, reps, lapses, now + interval, now, duration]
+        self._push(problem)
+
+    def forget(self, problem):
+        problem = tuple(problem)
+        self.meta.pop(problem, None)
+        self._entries.pop(problem, None)
+
+    def reset(self):
+        self.meta = {}
+        self._heap = []
+        self._entries = {}
+
+    def metadata(self, problem):
+        return self.meta.get(tuple(problem))
+
+    def to_list(self):
+        return [list(problem) + meta for problem, meta in sorted(self.meta.items())]
+
+SCHEDULERS = {
+    RandomScheduler.name: RandomScheduler,
+    SpacedRepetitionScheduler.name: SpacedRepetitionScheduler,
+}
+
+def make_scheduler(save_data, library, results, rng=random):
+    """
+    Create the profile's problem scheduler and load its saved metadata
+    """
+    name = save_data.get('scheduler', SCHEDULER)
+    try:
+        scheduler_class = SCHEDULERS[name]
+    except KeyError:
+        print("ERROR! Unknown scheduler: {}".format(name))
+        sys.exit(1)
+    return scheduler_class(library, results, schedule=save_data.get('schedule', ()), rng=rng)
+
+def get_valid_int(minimum=0, maximum=-1, default=None, prompt="Enter Integer (default={default})", error_prompt='Incorrect integer inputed: \'{int_input}\'. Must be an Integer between {minimum} and {maximum}', read=None):
+    prompt = '{}: '.format(prompt)
+    while True:
+        try:
+            int_input = (read or text_input)(prompt.format(default=default))
+        except InputTimeout:
+            raise
+        except:
+            sys.exit(1)
+        if int_input == '':
+            if default != None:
+                int_input = default
+        if int_input == 'exit':
+            return None
+        try:
+            int_input = int(int_input)
+            if maximum < 0:
+                if int_input < minimum:
+                    raise ValueError
+            else:
+                if int_input < minimum or int_input > maximum:
+                    raise ValueError
+        except ValueError:
+            max_str = maximum
+            if maximum < 0:
+                max_str = 'inf'
+            print(error_prompt.format(int_input=int_input, minimum=minimum, maximum=max_str))
+            continue
+        break
+    return int_input
+
+def get_valid_answer(division=None, prompt="Enter your answer", read=None):
+    """
+    get_valid_int() for the answer to a problem, division answers in
+    'remainder' and 'fraction' mode are parsed with parse_answer(). read
+    replaces text_input(), a DeadlineInput raises InputTimeout when time is up
+    """
+    if division not in ANSWER_HINTS:
+        return get_valid_int(prompt=prompt, read=read)
+    while True:
+        try:
+            answer = (read or text_input)('{} ({}): '.format(prompt, ANSWER_HINTS[division]))
+        except InputTimeout:
+            raise
+        except:
+            sys.exit(1)
+        if answer == 'exit':
+            return None
+        try:
+            return parse_answer(answer, division)
+        except (ValueError, ZeroDivisionError):
+            print("Incorrect answer inputed: '{}'. Must be a number {}".format(answer, ANSWER_HINTS[division]))
+
+def get_user_input(prompt='Enter a value (default={default})', allow_empty=False, default=None, yesno=False):
+    prompt = '{}: '.format(prompt)
+    while True:
+        try:
+            resp = text_input(prompt.format(default=default))
+        except:
+            sys.exit(1)
+        if not resp:
+            if default:
+                resp = default
+        if yesno:
+            if resp.lower() in ('yes','y'):
+                return True
+            elif resp.lower() in ('no', 'n'):
+                return False
+            else:
+                print("Invalid response, must be one of 'yes, y, no, n'")
+                continue
+        if allow_empty:
+            return resp
+        else:
+            if not resp:
+                print("You must provide an answer")
+                continue
+            else:
+                return resp
+
+def get_selection_menu(options, enabled_options=None, title=None, loop_title=None, show_all=False, show_done=False):
+    enabled_opts = []
+    if enabled_options:
+        enabled_opts = list(enabled_opts)
+    if title:
+        print(title)
+    if show_done:
+        print("NOTE: enabled = *")
+    while True:
+        for idx, opt in enumerate(options, start=1):
+            pre_str = ''
+            if show_done:
+                pre_str = '[ ]'
+                if opt in enabled_opts:
+                    pre_str = '[*]'
+            print("  {idx} - {pre_str}{opt}".format(idx=idx, pre_str=pre_str, opt=opt))
+        options_len = len(options)
+        extra_opts = 0
+        if show_all:
+            extra_opts += 1
+            all_opt = options_len + extra_opts
+            print("  {opt} - ALL".format(opt=all_opt))
+        if show_done:
+            extra_opts += 1
+            done_opt = options_len + extra_opts
+            print("  {opt} - Done".format(opt=done_opt))
+        try:
+            selection = text_input("Selection: ").strip()
+        except:
+            sys.exit(1)
+        try:
+            sel_idx = int(selection)
+        except ValueError:
+            print("Incorrect option: '{}' . Must be an Integer".format(selection))
+            continue
+        if show_done:
+            if sel_idx == done_opt:
+                break
+        if show_all:
+            if sel_idx == all_opt:
+                for idx, opt in enumerate(options, start=0):
+                    if opt in enabled_opts:
+                        enabled_opts.remove(opt)
+                        continue
+                    enabled_opts.append(opt)
+                if not show_done:
+                    break
+                if loop_title:
+                    print(loop_title)
+                continue
+        if sel_idx < 1 or sel_idx > options_len + extra_opts:
+            print("\nIncorrect option: {selection}. Must be a number from 1 to {max_idx}".format(selection=selection, max_idx=options_len + extra_opts))
+            continue
+        option_val = options[sel_idx-1]
+        if option_val not in enabled_opts:
+            enabled_opts.append(option_val)
+        else:
+            if show_done:
+                enabled_opts.remove(option_val)
+        if not show_done:
+            break
+    return enabled_opts
+
+def problem_sort_key(problem):
+    """
+    Sort problems the way they read, left hand, operator then right hand
+    """
+    return (problem[0], problem[2], problem[1])
+
+def print_results(results):
+    print("Ending results:\n")
+    if results['mastered']:
+        print("You MASTERED the following problems! Congratulations!!")
+        print('  \n'.join("  {0} {2} {1}".format(*mastered) for mastered in sorted(results['mastered'], key=problem_sort_key)))
+    if results['needs_work']:
+        print("\nHere are some problems you should work some more on:")
+        print('  \n'.join("  {0} {2} {1}".format(*needs_work) for needs_work in sorted(results['needs_work'], key=problem_sort_key)))
+    else:
+        print("You didn't seem to encounter any problems you couldn't solve! Way to go!")
+
+class LatencyHistogram(object):
+    """
+    Log-bucketed histogram of durations in seconds.
+
+    Bucket i counts the values up to LATENCY_MIN_SEC * LATENCY_BUCKET_GROWTH**i,
+    so there are never more than LATENCY_BUCKETS counters however many values
+    are recorded, and quantiles are accurate to within one bucket.
+    """
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = {} # bucket index -> count, only buckets that have been hit
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @staticmethod
+    def bucket(seconds):
+        if seconds <= LATENCY_MIN_SEC:
+            return 0
+        idx = int(math.ceil(math.log(seconds / LATENCY_MIN_SEC) / math.log(LATENCY_BUCKET_GROWTH) - 1e-9))
+        return min(idx, LATENCY_BUCKETS - 1)
+
+    @staticmethod
+    def upper_bound(idx):
+        return LATENCY_MIN_SEC * LATENCY_BUCKET_GROWTH ** idx
+
+    def record(self, seconds, count=1):
+        seconds = max(seconds, 0.0)
+        idx = self.bucket(seconds)
+        self.counts[idx] = self.counts.get(idx, 0) + count
+        self.count += count
+        self.total += seconds * count
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for idx, count in other.counts.items():
+            self.counts[idx] = self.counts.get(idx, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def quantile(self, q):
+        """
+        Return the value q (0-1) of the way through the recorded values, or None
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= rank:
+                #The geometric middle of the bucket is off by at most half a bucket either way
+                return min(max(self.upper_bound(idx) / math.sqrt(LATENCY_BUCKET_GROWTH), self.min), self.max)
+        return self.max
+
+    def buckets(self):
+        """
+        Return (upper bound, cumulative count) for every bucket that has been hit
+        """
+        cumulative = []
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            cumulative.append((self.upper_bound(idx), seen))
+        return cumulative
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': self.buckets(),
+        }
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'buckets': [[idx, self.counts[idx]] for idx in sorted(self.counts)],
+        }
+
+    @classmethod
+    def from_dict(cls, data, layout=None):
+        """
+        Load a histogram saved by to_dict(). Buckets saved with a different
+        layout ([min_sec, growth]) are moved to the current buckets.
+        """
+        hist = cls()
+        hist.count = data.get('count', 0)
+        hist.total = data.get('sum', 0.0)
+        hist.min = data.get('min')
+        hist.max = data.get('max')
+        for idx, count in data.get('buckets', ()):
+            if layout is not None and list(layout) != [LATENCY_MIN_SEC, LATENCY_BUCKET_GROWTH]:
+                idx = cls.bucket(layout[0] * layout[1] ** idx)
+            hist.counts[idx] = hist.counts.get(idx, 0) + count
+        return hist
+
+class LatencyStats(object):
+    """
+    Answer latency per problem and per operator, plus how long the engine
+    itself spends on each stage (selecting a problem, grading, rendering and
+    saving), each in a LatencyHistogram. Wrong answers, answers graded
+    without a time and problems left unanswered when the session ran out of
+    time are counted per problem too. Saved with the profile as 'latency'.
+    """
+    def __init__(self):
+        self.problems = {}
+        self.operators = {}
+        self.engine = {}
+        self.errors = {} # problem -> wrong answers
+        self.untimed = {} # problem -> answers that came without a time
+        self.timeouts = {} # problem -> times the session ended while it was asked
+
+    @staticmethod
+    def _hist(histograms, key):
+        hist = histograms.get(key)
+        if hist is None:
+            hist = histograms[key] = LatencyHistogram()
+        return hist
+
+    def answer(self, problem, seconds, correct=True):
+        """
+        Record how long a learner took to answer a problem, seconds is None
+        when that isn't known
+        """
+        problem = tuple(problem)
+        if seconds is None:
+            self.untimed[problem] = self.untimed.get(problem, 0) + 1
+        else:
+            self._hist(self.problems, problem).record(seconds)
+            self._hist(self.operators, problem[2]).record(seconds)
+        if not correct:
+            self.errors[problem] = self.errors.get(problem, 0) + 1
+
+    def answers(self, problem=None):
+        """
+        Return how many answers a problem, or all of them, got timed or not
+        """
+        if problem is None:
+            return sum(hist.count for hist in self.operators.values()) + sum(self.untimed.values())
+        hist = self.problems.get(problem)
+        return (hist.count if hist is not None else 0) + self.untimed.get(problem, 0)
+
+    def timeout(self, problem):
+        """
+        Record a problem the session ran out of time on, it isn't an answer
+        """
+        problem = tuple(problem)
+        self.timeouts[problem] = self.timeouts.get(problem, 0) + 1
+
+    def overhead(self, stage, seconds):
+        """
+        Record time the engine spent on a stage
+        """
+        self._hist(self.engine, stage).record(seconds)
+
+    @contextlib.contextmanager
+    def timing(self, stage):
+        start = perf_timer()
+        try:
+            yield
+        finally:
+            self.overhead(stage, perf_timer() - start)
+
+    def __bool__(self):
+        return bool(self.operators or self.engine or self.untimed)
+    __nonzero__ = __bool__
+
+    def to_dict(self):
+        return {
+            'layout': [LATENCY_MIN_SEC, LATENCY_BUCKET_GROWTH],
+            'problems': [list(problem) + [self.problems[problem].to_dict()] for problem in sorted(self.problems)],
+            'operators': dict((op, hist.to_dict()) for op, hist in self.operators.items()),
+            'engine': dict((stage, hist.to_dict()) for stage, hist in self.engine.items()),
+            'errors': [list(problem) + [self.errors[problem]] for problem in sorted(self.errors)],
+            'untimed': [list(problem) + [self.untimed[problem]] for problem in sorted(self.untimed)],
+            'timeouts': [list(problem) + [self.timeouts[problem]] for problem in sorted(self.timeouts)],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Load stats saved by to_dict(), data can be None or already loaded
+        """
+        if isinstance(data, cls):
+            return data
+        stats = cls()
+        if not data:
+            return stats
+        layout = data.get('layout')
+        for row in data.get('problems', ()):
+            stats.problems[tuple(row[:3])] = LatencyHistogram.from_dict(row[3], layout)
+        for op, hist in data.get('operators', {}).items():
+            stats.operators[op] = LatencyHistogram.from_dict(hist, layout)
+        for stage, hist in data.get('engine', {}).items():
+            stats.engine[stage] = LatencyHistogram.from_dict(hist, layout)
+        for row in data.get('errors', ()):
+            stats.errors[tuple(row[:3])] = row[3]
+        for row in data.get('untimed', ()):
+            stats.untimed[tuple(row[:3])] = row[3]
+        for row in data.get('timeouts', ()):
+            stats.timeouts[tuple(row[:3])] = row[3]
+        return stats
+
+    def summary(self):
+        """
+        Return the quantiles of every histogram, slowest problems first
+        """
+        problems = sorted(self.problems.items(), key=lambda item: (-(item[1].quantile(0.5) or 0), item[0]))
+        return {
+            'operators': dict((op, hist.summary()) for op, hist in self.operators.items()),
+            'problems': [dict(problem=list(problem), wrong=self.errors.get(problem, 0), timeouts=self.timeouts.get(problem, 0), **hist.summary()) for problem, hist in problems],
+            'engine': dict((stage, hist.summary()) for stage, hist in self.engine.items()),
+        }
+
+def _prom_labels(labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels)
+
+def latency_prometheus(profiles):
+    """
+    Yield the Prometheus text exposition lines for (profile, LatencyStats) pairs
+    """
+    profiles = list(profiles)
+    metrics = (
+        ('mathster_answer_seconds', "Seconds taken to answer a problem, by operator", 'operators', ('op',)),
+        ('mathster_problem_answer_seconds', "Seconds taken to answer a problem", 'problems', ('lh', 'rh', 'op')),
+        ('mathster_engine_seconds', "Seconds spent by the game engine, by stage", 'engine', ('stage',)),
+    )
+    for metric, help_text, attr, label_names in metrics:
+        yield '# HELP {} {}'.format(metric, help_text)
+        yield '# TYPE {} histogram'.format(metric)
+        for profile, stats in profiles:
+            histograms = getattr(stats, attr)
+            for key in sorted(histograms):
+                hist = histograms[key]
+                values = key if isinstance(key, tuple) else (key,)
+                labels = [('profile', profile)] + list(zip(label_names, values))
+                for upper, count in hist.buckets():
+                    yield '{}_bucket{{{}}} {}'.format(metric, _prom_labels(labels + [('le', repr(upper))]), count)
+                yield '{}_bucket{{{}}} {}'.format(metric, _prom_labels(labels + [('le', '+Inf')]), hist.count)
+                yield '{}_sum{{{}}} {}'.format(metric, _prom_labels(labels), repr(hist.total))
+                yield '{}_count{{{}}} {}'.format(metric, _prom_labels(labels), hist.count)
+
+def _state_base(state_file):
+    """
+    Return the path a save state file's journal and lock file are named after,
+    binary profiles get their own so they don't share them with a json
+    profile of the same name
+    """
+    if state_file.endswith(STATE_SUFFIX):
+        return state_file[:-len(STATE_SUFFIX)]
+    if state_file.endswith(BINARY_STATE_SUFFIX):
+        return state_file[:-len(BINARY_STATE_SUFFIX)] + '-bin'
+    return state_file
+
+def journal_file(state_file):
+    """
+    Return the path of the answer journal that goes with a save state file
+    """
+    return '{}-journal.jsonl'.format(_state_base(state_file))
+
+def lock_file(state_file):
+    """
+    Return the path of the lock file that goes with a save state file
+    """
+    return '{}.lock'.format(_state_base(state_file))
+
+@contextlib.contextmanager
+def file_lock(path, exclusive=False):
+    """
+    Hold an fcntl advisory lock on path while the block runs, shared for
+    readers and exclusive for writers. Nothing is locked without fcntl
+    (Windows), when path is None or when the lock file can't be created.
+    """
+    lfile = None
+    if fcntl is not None and path is not None:
+        try:
+            lfile = open(path, 'a')
+        except (IOError, OSError):
+            pass
+    if lfile is None:
+        yield
+        return
+    try:
+        fcntl.flock(lfile.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        #Closing the file releases the lock
+        lfile.close()
+
+def atomic_write(path, data):
+    """
+    Write data to path so that readers only ever see the old or the new
+    contents, never a partial write
+    """
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as tfile:
+        tfile.write(data)
+        tfile.flush()
+        os.fsync(tfile.fileno())
+    try:
+        os.replace(tmp_path, path)
+    except AttributeError:
+        #Python2, rename is atomic on posix
+        os.rename(tmp_path, path)
+
+class Journal(object):
+    """
+    Append-only log of the events of a session.
+
+    Every answer is one small JSON line appended to the journal. save_state()
+    folds everything into the save state file and empties the journal, and
+    load_state() replays whatever is left in the journal on top of it. Events
+    are numbered so ones that already made it into the save state file are
+    skipped if the journal couldn't be emptied.
+
+    Sessions playing the same profile at the same time share the journal.
+    Appends hold the profile's lock file and first catch up with what the
+    others appended, so events stay numbered in order across all of them and
+    each is tagged with the session ('sid') it came from. Once another
+    session has written to the journal it is marked shared and saves merge
+    instead of overwriting (see JsonStorage.write()).
+    """
+    def __init__(self, path, seq=0, lock_path=None):
+        self.path = path
+        self.seq = seq
+        self.pending = 0
+        self.lock_path = lock_path
+        self.sid = '{}-{:x}'.format(os.getpid(), id(self))
+        self.shared = False # Another session wrote to the journal since this one started
+        self._offset = 0 # How much of the journal has been seen
+        self._head = None # The first line of the journal, it changes whenever the journal is emptied
+        self._file = None
+
+    def sync(self):
+        """
+        Catch up with events other sessions appended, called with the lock held
+        """
+        try:
+            jfile = open(self.path, 'r')
+        except (IOError, OSError):
+            return
+        with jfile:
+            head = jfile.readline()
+            if head != self._head:
+                #Another session folded the journal into the save state file
+                self._head = head
+                self._offset = 0
+            size = os.fstat(jfile.fileno()).st_size
+            if size == self._offset:
+                return
+            jfile.seek(self._offset)
+            for line in jfile:
+                try:
+                    seq = json.loads(line)['seq']
+                except (ValueError, KeyError):
+                    break
+                if seq > self.seq:
+                    self.seq = seq
+                    self.shared = True
+        self._offset = size
+
+    def append(self, event):
+        with file_lock(self.lock_path, exclusive=True):
+            self.sync()
+            self.seq += 1
+            event['seq'] = self.seq
+            event['sid'] = self.sid
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(json.dumps(event, default=_json_default, separators=(',', ':')) + '\n')
+            self._file.flush()
+            if JOURNAL_FSYNC:
+                os.fsync(self._file.fileno())
+            self._offset = os.fstat(self._file.fileno()).st_size
+        self.pending += 1
+
+    def truncate(self):
+        """
+        Empty the journal, called with the lock held once its events are in
+        the save state file. It's emptied in place, other sessions keep it
+        open, and left holding the number of the last event folded in.
+        """
+        line = json.dumps({'type': 'compact', 'seq': self.seq}) + '\n'
+        with open(self.path, 'w') as jfile:
+            jfile.write(line)
+        self._head = line
+        self._offset = len(line)
+        self.pending = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def read_journal(path):
+    """
+    Yield the events in a journal file, a torn last line from a crash is ignored
+    """
+    if not os.path.isfile(path):
+        return
+    with open(path, 'r') as jfile:
+        for line in jfile:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                break
+
+def replay_journal(state, events):
+    """
+    Apply the journal events that are newer than the save state to it
+    """
+    seq = state.get('journal_seq', 0)
+    results = state['results']
+    buckets = {
+        'mastered': results['mastered'],
+        'needs_work': results['needs_work'],
+        'retired': state['retired'],
+    }
+    #The stats are only loaded if there is something to add to them
+    latency = None
+    schedule = None
+    flags = {} # problem -> {sid: buckets of the last answer from that session}
+    for event in events:
+        if event['seq'] <= seq:
+            continue
+        seq = event['seq']
+        if schedule is None:
+            schedule = dict((tuple(row[:3]), row) for row in state.get('schedule', []))
+            latency = state['latency'] = LatencyStats.from_dict(state.get('latency'))
+        if event['type'] == 'level':
+            state['level'] = event['level']
+            for bucket in buckets.values():
+                bucket.clear()
+            schedule.clear()
+            flags.clear()
+        elif event['type'] == 'redeem':
+            state['reward_mins'] = state.get('reward_mins', 0) + event['reward']
+        elif event['type'] == 'answer':
+            problem = tuple(event['problem'])
+            latency.answer(problem, event['dur'], event['correct'])
+            state['score'] = state.get('score', 0) + event['points']
+            state['reward_mins'] = state.get('reward_mins', 0) + event['reward']
+            flags.setdefault(problem, {})[event.get('sid')] = event['buckets']
+            if event.get('schedule'):
+                schedule[problem] = list(problem) + event['schedule']
+            else:
+                schedule.pop(problem, None)
+        elif event['type'] == 'timeout':
+            latency.timeout(event['problem'])
+    #Sessions that played at the same time are merged: a problem needs work if
+    #any of them says so, it's only mastered (or retired) if all of them agree
+    for problem, sessions in flags.items():
+        needs_work = any(flagged['needs_work'] for flagged in sessions.values())
+        for name, bucket in buckets.items():
+            if name == 'needs_work':
+                present = needs_work
+            else:
+                present = not needs_work and all(flagged[name] for flagged in sessions.values())
+            if present:
+                bucket.add(problem)
+            else:
+                bucket.discard(problem)
+    if schedule is not None:
+        state['schedule'] = [schedule[problem] for problem in sorted(schedule)]
+    state['journal_seq'] = seq
+    return state
+
+STATE_SUFFIX = '-stats.json'
+BINARY_STATE_SUFFIX = '-stats.bin'
+# Parts of a save state kept up to date by the journal, a save merging concurrent sessions takes them from the replayed journal
+MERGED_STATE_KEYS = ('results', 'retired', 'schedule', 'score', 'reward_mins', 'level', 'latency')
+MANIFEST_FILE = 'manifest.json' # Index of the profiles kept next to their save state files
+BINARY_MANIFEST_FILE = 'manifest-bin.json' # The same for the binary storage backend
+
+def profile_label(profile, entry):
+    """
+    Return the profile menu line for a manifest entry
+    """
+    label = "{} (level {}, score {}, {:.1f} reward mins".format(profile, entry.get('level', 1), entry.get('score', 0), entry.get('reward_mins', 0))
+    if entry.get('last_played'):
+        label += ", last played {}".format(time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['last_played'])))
+    return label + ")"
+
+def manifest_entry(state, last_played=None):
+    """
+    Return what the profile menu shows about a profile
+    """
+    return {
+        'level': state.get('level', 1),
+        'score': state.get('score', 0),
+        'reward_mins': state.get('reward_mins', 0),
+        'last_played': time.time() if last_played is None else last_played,
+    }
+
+def profile_name(state_file):
+    """
+    Return the profile name for a save state file path
+    """
+    name = os.path.basename(state_file)
+    if name.endswith(STATE_SUFFIX):
+        name = name[:-len(STATE_SUFFIX)]
+    return name
+
+class JsonStorage(object):
+    """
+    Keep every profile in its own '<name>-stats.json' file plus journal
+    """
+    name = 'json'
+    suffix = STATE_SUFFIX
+    manifest_name = MANIFEST_FILE
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+
+    def location(self, profile):
+        return '{}/{}{}'.format(self.state_dir, profile, self.suffix)
+
+    def manifest_file(self):
+        return '{}/{}'.format(self.state_dir, self.manifest_name)
+
+    def _scan_profiles(self):
+        profiles = [f[:-len(self.suffix)] for f in os.listdir(self.state_dir) if os.path.isfile('{}/{}'.format(self.state_dir, f)) and f.endswith(self.suffix)]
+        profiles.sort()
+        return profiles
+
+    def manifest(self):
+        """
+        Return {profile: manifest_entry()} for every profile from the manifest
+        file, without touching the save state files. If there is no manifest
+        yet it's built from the save state files once.
+        """
+        profiles = self._read_manifest()
+        if profiles is None:
+            with file_lock(lock_file(self.manifest_file()), exclusive=True):
+                profiles = self._locked_manifest()
+        return profiles
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_file(), 'r') as mfile:
+                return json.load(mfile)['profiles']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def _locked_manifest(self):
+        """
+        manifest(), for callers already holding the manifest lock
+        """
+        profiles = self._read_manifest()
+        if profiles is not None:
+            return profiles
+        profiles = {}
+        for profile in self._scan_profiles():
+            state = self.read(profile)
+            if state is not None:
+                profiles[profile] = manifest_entry(state, last_played=os.path.getmtime(self.location(profile)))
+        self._write_manifest(profiles)
+        return profiles
+
+    def _write_manifest(self, profiles):
+        atomic_write(self.manifest_file(), json.dumps({'profiles': profiles}, indent=4, sort_keys=True))
+
+    def list_profiles(self):
+        return sorted(self.manifest())
+
+    def exists(self, profile):
+        return os.path.isfile(self.location(profile))
+
+    def read(self, profile):
+        """
+        Return the saved state of a profile with its journal replayed, or None
+        """
+        path = self.location(profile)
+        if not os.path.isfile(path):
+            return None
+        with file_lock(lock_file(path)):
+            return self._read(path)
+
+    def _read(self, path):
+        state = self._load(path)
+        if 'results' in state:
+            replay_journal(state, read_journal(journal_file(path)))
+        return state
+
+    def _load(self, path):
+        """
+        Return the contents of a save state file
+        """
+        with open(path, 'r') as sfile:
+            state = json.load(sfile)
+        if 'results' in state:
+            for bucket in ('needs_work', 'mastered'):
+                state['results'][bucket] = ProblemPool(state['results'][bucket])
+            state['retired'] = ProblemPool(state.get('retired', ()))
+        return state
+
+    def _dump(self, state):
+        """
+        Return the contents of the save state file for state
+        """
+        return json.dumps(state, indent=4, default=_json_default)
+
+    def write(self, profile, state, journal=None):
+        """
+        Atomically write the save state file and empty the journal it replaces.
+
+        If other sessions wrote to the journal too, state only has this
+        session's view. The saved state is read back with every session's
+        journaled events replayed on top (summing their score and reward
+        minutes and merging their buckets) and only the settings and stats
+        that aren't journaled are taken from state.
+        """
+        path = self.location(profile)
+        if journal is None:
+            journal = self.journal(profile, seq=state.get('journal_seq', 0))
+        with file_lock(lock_file(path), exclusive=True):
+            journal.sync()
+            if journal.shared and os.path.isfile(path):
+                merged = dict(state)
+                merged.update((key, value) for key, value in self._read(path).items() if key in MERGED_STATE_KEYS)
+                state = merged
+            state['journal_seq'] = journal.seq
+            atomic_write(path, self._dump(state))
+            journal.truncate()
+        #Sessions saving other profiles update the manifest too, one at a time
+        with file_lock(lock_file(self.manifest_file()), exclusive=True):
+            profiles = self._locked_manifest()
+            profiles[profile] = manifest_entry(state)
+            self._write_manifest(profiles)
+
+    def journal(self, profile, seq=0):
+        path = self.location(profile)
+        return Journal(journal_file(path), seq=seq, lock_path=lock_file(path))
+
+BINARY_MAGIC = b'MSTB'
+BINARY_VERSION = 2
+BINARY_BITSETS = ('mastered', 'needs_work', 'retired', 'scheduled')
+
+def _pad8(offset):
+    return (offset + 7) & ~7
+
+def _array_bytes(values):
+    """
+    Return the little endian bytes of an array
+    """
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+
+def _bytes_array(typecode, data):
+    """
+    Return the array of the little endian bytes in data
+    """
+    values = array.array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+class BinaryProfile(object):
+    """
+    Read only access to a binary save state file through mmap.
+
+    Only the header is read up front, everything else is read from the
+    mapping when it's asked for, so opening a profile costs the same however
+    many problems it has and only the pages that are touched are read. The
+    layout, little endian, every section starting on 8 bytes:
+
+        header      HEADER: magic, version, schedule metadata width, number
+                    of records, settings size and how many bits are set in
+                    each of BINARY_BITSETS
+        settings    JSON of everything but the buckets, schedule and latency
+        records     (lh, rh, operator code) int32 triples, sorted. The
+                    operator code is its index in KNOWN_OPERATORS
+        bitsets     one bit per record for each of BINARY_BITSETS
+        schedule    the scheduling metadata of every record in the
+                    'scheduled' bitset as float64s, in record order
+        latency     JSON of the latency stats, to the end of the file. It
+                    grows with every problem answered so it is only parsed
+                    when the stats are used (see MappedLatency)
+
+    Version 1 files have no latency section, the stats are in the settings.
+
+    The Mapped* containers reading from a profile each hold on to it until
+    they have read what they need, the file is unmapped once the last one
+    lets go so it can be replaced (Windows won't replace a mapped file).
+    """
+    HEADER = struct.Struct('<4sHHIIIIII')
+    RECORD = struct.Struct('<iii')
+
+    def __init__(self, path):
+        with open(path, 'rb') as bfile:
+            self.map = mmap.mmap(bfile.fileno(), 0, access=mmap.ACCESS_READ)
+        fields = self.HEADER.unpack_from(self.map, 0)
+        if fields[0] != BINARY_MAGIC or fields[1] not in (1, BINARY_VERSION):
+            raise ValueError("{} isn't a version 1 to {} binary profile".format(path, BINARY_VERSION))
+        self.meta_width, self.records, self._settings_size = fields[2:5]
+        self.counts = dict(zip(BINARY_BITSETS, fields[5:]))
+        self._records_at = _pad8(self.HEADER.size + self._settings_size)
+        self._bitset_size = _pad8((self.records + 7) // 8)
+        bitsets_at = _pad8(self._records_at + self.records * self.RECORD.size)
+        self._bitsets_at = dict((name, bitsets_at + num * self._bitset_size) for num, name in enumerate(BINARY_BITSETS))
+        self._schedule_at = bitsets_at + len(BINARY_BITSETS) * self._bitset_size
+        self._latency_at = self._schedule_at + self.counts['scheduled'] * self.meta_width * 8
+        self._users = 0
+
+    def acquire(self):
+        self._users += 1
+        return self
+
+    def release(self):
+        self._users -= 1
+        if self._users <= 0:
+            self.close()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    @staticmethod
+    def dump(state):
+        """
+        Return the binary save state file for state
+        """
+        settings = dict((k, v) for k, v in state.items() if k not in ('results', 'retired', 'schedule', 'latency'))
+        settings = json.dumps(settings, default=_json_default, separators=(',', ':')).encode('utf-8')
+        latency = b''
+        if state.get('latency'):
+            latency = json.dumps(state['latency'], default=_json_default, separators=(',', ':')).encode('utf-8')
+        results = state.get('results', {})
+        bitsets = {
+            'mastered': results.get('mastered', ()),
+            'needs_work': results.get('needs_work', ()),
+            'retired': state.get('retired', ()),
+        }
+        schedule = dict((tuple(row[:3]), row[3:]) for row in state.get('schedule', ()))
+        problems = set(schedule)
+        for problem_set in bitsets.values():
+            problems.update(tuple(problem) for problem in problem_set)
+        records = sorted((lh, rh, KNOWN_OPERATORS.index(op)) for lh, rh, op in problems)
+        index = dict(((lh, rh, KNOWN_OPERATORS[code]), num) for num, (lh, rh, code) in enumerate(records))
+        bitsets['scheduled'] = schedule
+        meta_width = max([len(meta) for meta in schedule.values()] or [0])
+        bitset_size = _pad8((len(records) + 7) // 8)
+        packed = []
+        for name in BINARY_BITSETS:
+            bits = bytearray(bitset_size)
+            for problem in bitsets[name]:
+                num = index[tuple(problem)]
+                bits[num >> 3] |= 1 << (num & 7)
+            packed.append(bytes(bits))
+        flat = array.array('i')
+        for record in records:
+            flat.extend(record)
+        metas = array.array('d')
+        for record in records:
+            problem = (record[0], record[1], KNOWN_OPERATORS[record[2]])
+            if problem in schedule:
+                meta = schedule[problem]
+                metas.extend(list(meta) + [0.0] * (meta_width - len(meta)))
+        header = BinaryProfile.HEADER.pack(BINARY_MAGIC, BINARY_VERSION, meta_width, len(records), len(settings),
+                                           *[len(bitsets[name]) for name in BINARY_BITSETS])
+        chunks = [header, settings]
+        records_at = _pad8(len(header) + len(settings))
+        chunks.append(b'\0' * (records_at - len(header) - len(settings)))
+        records = _array_bytes(flat)
+        chunks.extend([records, b'\0' * (_pad8(len(records)) - len(records))])
+        chunks.extend(packed)
+        chunks.extend([_array_bytes(metas), latency])
+        return b''.join(chunks)
+
+    def settings(self):
+        return json.loads(self.map[self.HEADER.size:self.HEADER.size + self._settings_size].decode('utf-8'))
+
+    def has_latency(self):
+        return len(self.map) > self._latency_at
+
+    def latency(self):
+        return json.loads(self.map[self._latency_at:].decode('utf-8'))
+
+    def problem(self, num):
+        lh, rh, code = self.RECORD.unpack_from(self.map, self._records_at + num * self.RECORD.size)
+        return (lh, rh, KNOWN_OPERATORS[code])
+
+    def find(self, problem):
+        """
+        Return the record number of a problem with a binary search, or None
+        """
+        try:
+            key = (problem[0], problem[1], KNOWN_OPERATORS.index(problem[2]))
+        except ValueError:
+            return None
+        low, high = 0, self.records
+        while low < high:
+            mid = (low + high) // 2
+            if self.RECORD.unpack_from(self.map, self._records_at + mid * self.RECORD.size) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.records and self.RECORD.unpack_from(self.map, self._records_at + low * self.RECORD.size) == key:
+            return low
+        return None
+
+    def has(self, bitset, problem):
+        num = self.find(problem)
+        if num is None:
+            return False
+        at = self._bitsets_at[bitset] + (num >> 3)
+        return bool(bytearray(self.map[at:at + 1])[0] >> (num & 7) & 1)
+
+    def _numbers(self, bitset):
+        at = self._bitsets_at[bitset]
+        for byte_num, byte in enumerate(bytearray(self.map[at:at + self._bitset_size])):
+            if byte:
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        yield (byte_num << 3) + bit
+
+    def problems(self, bitset):
+        if self.counts[bitset] * 16 < self.records:
+            for num in self._numbers(bitset):
+                yield self.problem(num)
+            return
+        #Reading a good part of the records, copying them all in one go is quicker
+        records = _bytes_array('i', self.map[self._records_at:self._records_at + self.records * self.RECORD.size])
+        for num in self._numbers(bitset):
+            at = num * 3
+            yield (records[at], records[at + 1], KNOWN_OPERATORS[records[at + 2]])
+
+    def schedule(self):
+        """
+        Yield the rows of the schedule, [lh, rh, op] followed by the metadata
+        """
+        meta = struct.Struct('<{}d'.format(self.meta_width))
+        for row, num in enumerate(self._numbers('scheduled')):
+            values = meta.unpack_from(self.map, self._schedule_at + row * meta.size)
+            yield list(self.problem(num)) + [int(value) if value.is_integer() else value for value in values]
+
+class MappedProblemPool(ProblemPool):
+    """
+    A ProblemPool backed by one bitset of a BinaryProfile.
+
+    Size and membership are answered from the mapped file, the problems are
+    only read into memory the first time the pool is iterated, chosen from or
+    changed.
+    """
+    def __init__(self, profile, bitset):
+        super(MappedProblemPool, self).__init__()
+        self._profile = profile.acquire()
+        self._bitset = bitset
+
+    def _read_all(self):
+        if self._profile is not None:
+            profile, self._profile = self._profile, None
+            for problem in profile.problems(self._bitset):
+                super(MappedProblemPool, self).add(problem)
+            profile.release()
+
+    def __len__(self):
+        if self._profile is not None:
+            return self._profile.counts[self._bitset]
+        return super(MappedProblemPool, self).__len__()
+
+    def __bool__(self):
+        return len(self) > 0
+    __nonzero__ = __bool__
+
+    def __contains__(self, problem):
+        if self._profile is not None:
+            return self._profile.has(self._bitset, problem)
+        return super(MappedProblemPool, self).__contains__(problem)
+
+    def __iter__(self):
+        self._read_all()
+        return super(MappedProblemPool, self).__iter__()
+
+    def add(self, problem):
+        self._read_all()
+        return super(MappedProblemPool, self).add(problem)
+
+    def discard(self, problem):
+        self._read_all()
+        return super(MappedProblemPool, self).discard(problem)
+
+    def choice(self, rng=random):
+        self._read_all()
+        return super(MappedProblemPool, self).choice(rng)
+
+    def clear(self):
+        if self._profile is not None:
+            self._profile, profile = None, self._profile
+            profile.release()
+        super(MappedProblemPool, self).clear()
+
+    def to_list(self):
+        self._read_all()
+        return super(MappedProblemPool, self).to_list()
+
+class MappedSchedule(object):
+    """
+    The schedule rows of a BinaryProfile, read the first time they're iterated
+    """
+    def __init__(self, profile):
+        self._profile = profile.acquire()
+        self._count = profile.counts['scheduled']
+        self._rows = None
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        if self._rows is None:
+            self._rows = list(self._profile.schedule())
+            self._profile.release()
+            self._profile = None
+        return iter(self._rows)
+
+    def to_list(self):
+        return list(self)
+
+class MappedLatency(object):
+    """
+    The latency section of a BinaryProfile, parsed the first time it's read.
+    LatencyStats.from_dict() takes it like the dict it stands for.
+    """
+    def __init__(self, profile):
+        self._profile = profile.acquire()
+        self._data = None
+
+    def to_dict(self):
+        if self._data is None:
+            self._data = self._profile.latency()
+            self._profile.release()
+            self._profile = None
+        return self._data
+
+    def __bool__(self):
+        if self._profile is not None:
+            return self._profile.has_latency()
+        return bool(self._data)
+    __nonzero__ = __bool__
+
+    def get(self, key, default=None):
+        return self.to_dict().get(key, default)
+
+class BinaryStorage(JsonStorage):
+    """
+    Keep every profile in its own compact '<name>-stats.bin' file plus journal.
+
+    Problems are packed fixed width records with a bitset per bucket instead
+    of JSON lists (see BinaryProfile), and files are opened with mmap, so
+    loading doesn't depend on the size of the profile. Journaling, locking
+    and the manifest work the same as for the json backend, and profiles can
+    be exported to and imported from JSON.
+    """
+    name = 'binary'
+    suffix = BINARY_STATE_SUFFIX
+    manifest_name = BINARY_MANIFEST_FILE
+
+    def _load(self, path):
+        profile = BinaryProfile(path).acquire()
+        state = profile.settings()
+        state['results'] = {
+            'mastered': MappedProblemPool(profile, 'mastered'),
+            'needs_work': MappedProblemPool(profile, 'needs_work'),
+        }
+        state['retired'] = MappedProblemPool(profile, 'retired')
+        if profile.counts['scheduled']:
+            state['schedule'] = MappedSchedule(profile)
+        if profile.has_latency():
+            state['latency'] = MappedLatency(profile)
+        profile.release()
+        return state
+
+    def _dump(self, state):
+        return BinaryProfile.dump(state)
+
+class SqliteStorage(object):
+    """
+    Keep all profiles in one sqlite database.
+
+    Profiles, the problems they have seen, every attempt and every reward
+    change get their own tables, indexed by profile and problem, so listing
+    profiles, resuming and looking up what needs work don't have to parse
+    whole documents. Answers are applied to the tables as they happen, one
+    small transaction each, instead of going through a journal file.
+    """
+    name = 'sqlite'
+    # Columns of the profiles table, everything else is kept in 'settings'
+    PROFILE_COLUMNS = ('level', 'score', 'reward_mins', 'journal_seq')
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS profiles (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            level INTEGER NOT NULL DEFAULT 1,
+            score INTEGER NOT NULL DEFAULT 0,
+            reward_mins REAL NOT NULL DEFAULT 0,
+            journal_seq INTEGER NOT NULL DEFAULT 0,
+            settings TEXT NOT NULL DEFAULT '{}',
+            updated REAL
+        )""",
+        """CREATE TABLE IF NOT EXISTS problems (
+            profile_id INTEGER NOT NULL REFERENCES profiles(id) ON DELETE CASCADE,
+            lh INTEGER NOT NULL,
+            rh INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            mastered INTEGER NOT NULL DEFAULT 0,
+            needs_work INTEGER NOT NULL DEFAULT 0,
+            retired INTEGER NOT NULL DEFAULT 0,
+            schedule TEXT,
+            PRIMARY KEY (profile_id, lh, rh, op)
+        )""",
+        #The buckets each session last put a problem in since the last save,
+        #merged into problems like replay_journal() merges journals
+        """CREATE TABLE IF NOT EXISTS session_flags (
+            profile_id INTEGER NOT NULL REFERENCES profiles(id) ON DELETE CASCADE,
+            lh INTEGER NOT NULL,
+            rh INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            sid TEXT NOT NULL,
+            mastered INTEGER NOT NULL DEFAULT 0,
+            needs_work INTEGER NOT NULL DEFAULT 0,
+            retired INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (profile_id, lh, rh, op, sid)
+        )""",
+        """CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY,
+            profile_id INTEGER NOT NULL REFERENCES profiles(id) ON DELETE CASCADE,
+            seq INTEGER NOT NULL,
+            ts REAL NOT NULL,
+            lh INTEGER NOT NULL,
+            rh INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            answer INTEGER,
+            correct INTEGER NOT NULL,
+            dur REAL NOT NULL,
+            points INTEGER NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS rewards (
+            id INTEGER PRIMARY KEY,
+            profile_id INTEGER NOT NULL REFERENCES profiles(id) ON DELETE CASCADE,
+            seq INTEGER NOT NULL,
+            ts REAL NOT NULL,
+            delta REAL NOT NULL,
+            reason TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS problems_needs_work ON problems (profile_id, needs_work)",
+        "CREATE INDEX IF NOT EXISTS history_profile_problem ON history (profile_id, lh, rh, op)",
+        "CREATE INDEX IF NOT EXISTS rewards_profile ON rewards (profile_id)",
+    )
+
+    def __init__(self, db_path):
+        import sqlite3
+        self.db_path = db_path
+        #Connections may be handed to a single background writer thread (see mathster_server)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        with self.conn:
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+
+    def location(self, profile):
+        return '{} (profile: {})'.format(self.db_path, profile)
+
+    def list_profiles(self):
+        return [row[0] for row in self.conn.execute('SELECT name FROM profiles ORDER BY name')]
+
+    def manifest(self):
+        return dict(
+            (name, {'level': level, 'score': score, 'reward_mins': reward_mins, 'last_played': updated})
+            for name, level, score, reward_mins, updated in self.conn.execute('SELECT name, level, score, reward_mins, updated FROM profiles')
+        )
+
+    def exists(self, profile):
+        return self._profile_id(profile) is not None
+
+    def _profile_id(self, profile):
+        row = self.conn.execute('SELECT id FROM profiles WHERE name = ?', (profile,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def read(self, profile):
+        row = self.conn.execute(
+            'SELECT id, level, score, reward_mins, journal_seq, settings FROM profiles WHERE name = ?', (profile,)
+        ).fetchone()
+        if row is None:
+            return None
+        profile_id = row[0]
+        state = json.loads(row[5])
+        state.update(zip(self.PROFILE_COLUMNS, row[1:5]))
+        results = {'mastered': ProblemPool(), 'needs_work': ProblemPool()}
+        retired = ProblemPool()
+        schedule = []
+        for lh, rh, op, mastered, needs_work, is_retired, meta in self.conn.execute(
+                'SELECT lh, rh, op, mastered, needs_work, retired, schedule FROM problems WHERE profile_id = ? ORDER BY lh, rh, op', (profile_id,)):
+            problem = (lh, rh, op)
+            if mastered:
+                results['mastered'].add(problem)
+            if needs_work:
+                results['needs_work'].add(problem)
+            if is_retired:
+                retired.add(problem)
+            if meta:
+                schedule.append(list(problem) + json.loads(meta))
+        state['results'] = results
+        state['retired'] = retired
+        state['schedule'] = schedule
+        state['latency'] = LatencyStats.from_dict(state.get('latency'))
+        return state
+
+    def write(self, profile, state, journal=None):
+        """
+        Replace the saved state of a profile in one transaction. If other
+        sessions shared the journal, or answered since this state was read,
+        every session's answers are already merged in the tables and only
+        the settings are replaced.
+        """
+        if journal is not None:
+            state['journal_seq'] = journal.seq
+        settings = dict((k, v) for k, v in state.items() if k not in self.PROFILE_COLUMNS and k not in ('results', 'retired', 'schedule', 'tuples'))
+        with self.conn:
+            #Taken before reading journal_seq so nobody can answer in between
+            self.conn.execute('BEGIN IMMEDIATE')
+            row = self.conn.execute('SELECT id, journal_seq FROM profiles WHERE name = ?', (profile,)).fetchone()
+            if getattr(journal, 'shared', False) or row is not None and row[1] > state.get('journal_seq', 0):
+                self.conn.execute(
+                    'UPDATE profiles SET settings = ?, updated = ? WHERE id = ?',
+                    (json.dumps(settings, default=_json_default), time.time(), row[0])
+                )
+                self.conn.execute('DELETE FROM session_flags WHERE profile_id = ?', (row[0],))
+                return
+            self._replace(profile, state, settings)
+
+    def _replace(self, profile, state, settings):
+        """
+        Replace the whole saved state of a profile, in the caller's transaction
+        """
+        problems = {}
+        def row(problem):
+            return problems.setdefault(tuple(problem), [0, 0, 0, None])
+        for problem in state.get('results', {}).get('mastered', ()):
+            row(problem)[0] = 1
+        for problem in state.get('results', {}).get('needs_work', ()):
+            row(problem)[1] = 1
+        for problem in state.get('retired', ()):
+            row(problem)[2] = 1
+        for meta in state.get('schedule', ()):
+            row(meta[:3])[3] = json.dumps(list(meta[3:]))
+        self.conn.execute('INSERT OR IGNORE INTO profiles (name) VALUES (?)', (profile,))
+        profile_id = self._profile_id(profile)
+        self.conn.execute(
+            'UPDATE profiles SET level = ?, score = ?, reward_mins = ?, journal_seq = ?, settings = ?, updated = ? WHERE id = ?',
+            (state.get('level', 1), state.get('score', 0), state.get('reward_mins', 0), state.get('journal_seq', 0),
+             json.dumps(settings, default=_json_default), time.time(), profile_id)
+        )
+        self.conn.execute('DELETE FROM problems WHERE profile_id = ?', (profile_id,))
+        self.conn.execute('DELETE FROM session_flags WHERE profile_id = ?', (profile_id,))
+        self.conn.executemany(
+            'INSERT INTO problems (profile_id, lh, rh, op, mastered, needs_work, retired, schedule) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(profile_id,) + problem + tuple(flags) for problem, flags in problems.items()]
+        )
+
+    def journal(self, profile, seq=0):
+        if not self.exists(profile):
+            with self.conn:
+                self.conn.execute('INSERT OR IGNORE INTO profiles (name) VALUES (?)', (profile,))
+        return SqliteJournal(self, self._profile_id(profile), seq=seq)
+
+    def needs_work(self, profile):
+        """
+        Return the problems a profile needs to work on, straight from the index
+        """
+        return [tuple(row) for row in self.conn.execute(
+            'SELECT lh, rh, op FROM problems WHERE profile_id = (SELECT id FROM profiles WHERE name = ?) AND needs_work = 1 ORDER BY lh, rh, op', (profile,)
+        )]
+
+    def close(self):
+        self.conn.close()
+
+class SqliteJournal(object):
+    """
+    Journal for the sqlite storage backend.
+
+    Each event is applied to the database right away in its own
+    transaction, so there is never anything left to fold into a snapshot and
+    pending stays at 0. Events are numbered by the database, if another
+    session of the same profile numbered some in between the journal is
+    marked shared. The buckets of a problem are merged over every session
+    that answered it since the last save, like replay_journal() does.
+    """
+    def __init__(self, storage, profile_id, seq=0):
+        self.conn = storage.conn
+        self.profile_id = profile_id
+        self.seq = seq
+        self.pending = 0
+        self.shared = False
+        self.sid = '{}-{:x}'.format(os.getpid(), id(self))
+
+    def append(self, event):
+        now = event.get('ts', time.time())
+        with self.conn:
+            self.conn.execute('UPDATE profiles SET journal_seq = journal_seq + 1, updated = ? WHERE id = ?', (now, self.profile_id))
+            seq = self.conn.execute('SELECT journal_seq FROM profiles WHERE id = ?', (self.profile_id,)).fetchone()[0]
+            if seq != self.seq + 1:
+                self.shared = True
+            self.seq = event['seq'] = seq
+            if event['type'] == 'level':
+                self.conn.execute('UPDATE profiles SET level = ? WHERE id = ?', (event['level'], self.profile_id))
+                self.conn.execute('DELETE FROM problems WHERE profile_id = ?', (self.profile_id,))
+                self.conn.execute('DELETE FROM session_flags WHERE profile_id = ?', (self.profile_id,))
+            elif event['type'] == 'redeem':
+                self._reward(now, event['reward'], 'redeem')
+            elif event['type'] == 'answer':
+                lh, rh, op = event['problem']
+                self.conn.execute(
+                    'INSERT INTO history (profile_id, seq, ts, lh, rh, op, answer, correct, dur, points) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (self.profile_id, self.seq, now, lh, rh, op, event['answer'], int(event['correct']), event['dur'], event['points'])
+                )
+                self.conn.execute('UPDATE profiles SET score = score + ? WHERE id = ?', (event['points'], self.profile_id))
+                if event['reward']:
+                    self._reward(now, event['reward'], 'answer')
+                buckets = event['buckets']
+                key = (self.profile_id, lh, rh, op)
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO session_flags (profile_id, lh, rh, op, sid, mastered, needs_work, retired) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    key + (self.sid, int(buckets['mastered']), int(buckets['needs_work']), int(buckets['retired']))
+                )
+                #A problem needs work if any session says so, it's only mastered (or retired) if all of them agree
+                mastered, needs_work, retired = self.conn.execute(
+                    'SELECT MIN(mastered), MAX(needs_work), MIN(retired) FROM session_flags WHERE profile_id = ? AND lh = ? AND rh = ? AND op = ?', key
+                ).fetchone()
+                if needs_work:
+                    mastered = retired = 0
+                meta = event.get('schedule')
+                if mastered or needs_work or retired or meta:
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO problems (profile_id, lh, rh, op, mastered, needs_work, retired, schedule) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        key + (mastered, needs_work, retired, json.dumps(meta) if meta else None)
+                    )
+                else:
+                    self.conn.execute('DELETE FROM problems WHERE profile_id = ? AND lh = ? AND rh = ? AND op = ?', (self.profile_id, lh, rh, op))
+
+    def _reward(self, now, delta, reason):
+        self.conn.execute('UPDATE profiles SET reward_mins = reward_mins + ? WHERE id = ?', (delta, self.profile_id))
+        self.conn.execute(
+            'INSERT INTO rewards (profile_id, seq, ts, delta, reason) VALUES (?, ?, ?, ?, ?)',
+            (self.profile_id, self.seq, now, delta, reason)
+        )
+
+    def truncate(self):
+        self.pending = 0
+
+    def close(self):
+        pass
+
+STORAGE_BACKENDS = {
+    JsonStorage.name: JsonStorage,
+    BinaryStorage.name: BinaryStorage,
+    SqliteStorage.name: SqliteStorage,
+}
+_STORAGE_CACHE = {}
+
+def get_storage(backend=None, state_dir=None):
+    """
+    Return the storage backend for the profiles in state_dir (STATE_FILE_DIR by default)
+    """
+    if backend is None:
+        backend = STORAGE_BACKEND
+    if state_dir is None:
+        state_dir = STATE_FILE_DIR
+    if backend == SqliteStorage.name:
+        location = '{}/{}'.format(state_dir, STATE_DB_NAME)
+    else:
+        location = state_dir
+    key = (backend, location)
+    if key not in _STORAGE_CACHE:
+        try:
+            _STORAGE_CACHE[key] = STORAGE_BACKENDS[backend](location)
+        except KeyError:
+            print("ERROR! Unknown storage backend: {}".format(backend))
+            sys.exit(1)
+    return _STORAGE_CACHE[key]
+
+def current_profile():
+    """
+    Return the storage backend and profile name that STATE_FILE points at
+    """
+    return get_storage(state_dir=os.path.dirname(STATE_FILE)), profile_name(STATE_FILE)
+
+def export_json_profiles(storage, state_dir=None):
+    """
+    Copy every profile in storage to a '<name>-stats.json' file in state_dir.
+    Returns the exported profile names.
+    """
+    state_dir = state_dir or STATE_FILE_DIR
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    target = JsonStorage(state_dir)
+    exported = []
+    for profile in storage.list_profiles():
+        state = storage.read(profile)
+        if state is not None:
+            target.write(profile, state)
+            exported.append(profile)
+    return exported
+
+def import_json_profiles(state_dir=None, storage=None):
+    """
+    Copy every '<name>-stats.json' profile (and its journal) into storage,
+    the sqlite backend by default. Returns the imported profile names.
+    """
+    source = JsonStorage(state_dir or STATE_FILE_DIR)
+    if storage is None:
+        storage = get_storage(SqliteStorage.name, state_dir=state_dir)
+    imported = []
+    for profile in source.list_profiles():
+        state = source.read(profile)
+        if 'tuples' in state:
+            load_library(state)
+        storage.write(profile, state)
+        imported.append(profile)
+    return imported
+
+def new_state(**settings):
+    """
+    Return the save state of a brand new profile, with any settings given
+    """
+    state = {
+        'results': {
+            'needs_work': ProblemPool(),
+            'mastered': ProblemPool(),
+        },
+        'level': 1,
+        'score': 0,
+        'levels': LEVELS,
+    }
+    state.update(settings)
+    return state
+
+def load_state(new=False):
+    state = {}
+    if new:
+        print("Creating new state profile...")
+        state = new_state()
+    storage, profile = current_profile()
+    saved = storage.read(profile)
+    if saved is not None:
+        state = saved
+    elif not new:
+        print("Cannot find save state file: {}".format(storage.location(profile)))
+    if not 'left_hand' in state:
+        left_hand = get_user_input(prompt="Enter the left hand set of number you'd like to use for generating problems. Numbers should be comma separated (default={default})", default=','.join([str(i) for i in LEFT_HAND]))
+        state['left_hand'] = [int(i) for i in left_hand.split(',')]
+    if not 'right_hand' in state:
+        right_hand = get_user_input(prompt="Enter the right hand set of number you'd like to use for generating problems. Numbers should be comma separated (default={default})", default=','.join([str(i) for i in RIGHT_HAND]))
+        state['right_hand'] = [int(i) for i in right_hand.split(',')]
+    if not 'operators' in state:
+        operators = None
+        if 'results' in state:
+            if state['results']['mastered']:
+                operators = next(iter(state['results']['mastered']))[2]
+            elif state['results']['needs_work']:
+                operators = next(iter(state['results']['needs_work']))[2]
+        elif state.get('tuples'):
+            operators = state['tuples'][0][2]
+        if not operators:
+            operators = get_selection_menu(options=KNOWN_OPERATORS, title="Enter the operators to use for problems", show_done=True)
+        state['operators'] = operators
+    #Make sure that we are using known operators
+    if not set(KNOWN_OPERATORS).intersection(set(state['operators'])) == set(state['operators']):
+        unknown_ops= set(state['operators']).difference(set(KNOWN_OPERATORS))
+        print("ERROR! Unknown operator(s): {}".format(', '.join(unknown_ops)))
+        sys.exit(1)
+    if '-' in state['operators']:
+        if not 'allow_sub_neg_ans' in state:
+            allow_sub_neg_ans = get_user_input(prompt="Would you like to allow negative answers for subtraction? (default={default})", default=ALLOW_SUB_NEGATIVE_ANS, yesno=True)
+            state['allow_sub_neg_ans'] = allow_sub_neg_ans
+        if not 'allow_sub_mult_dbl_q' in state:
+            allow_sub_mult_dbl_q = get_user_input(prompt="Would you like to allow two double digits to be subracted? (default={default})", default=ALLOW_SUB_MULTI_DBL_QUESTION, yesno=True)
+            state['allow_sub_mult_dbl_q'] = allow_sub_mult_dbl_q
+    if '/' in state['operators'] and state.get('division') not in DIVISION_MODES:
+        state['division'] = get_selection_menu(options=DIVISION_MODES, title="How should division problems be answered? (whole numbers only, with a remainder like 3 r 2, or as a fraction like 7/3)")[0]
+    if 'canonical' not in state and set(state['operators']).intersection(COMMUTATIVE_OPERATORS + tuple(OPERATOR_ALIASES)):
+        canonical = get_user_input(prompt="Would you like problems like 3 x 4 and 4 x 3 to count as the same problem? (default={default})", default=CANONICAL_PROBLEMS, yesno=True)
+        state['canonical'] = canonical
+    if 'rewards_enabled' not in state:
+        state['rewards_enabled'] = get_user_input(prompt="Would you like to enable 'reward minutes' for this profile? (y/n)", yesno=True)
+    return state
+
+def redeem_reward_mins(reward_mins, minimum_to_prompt=10):
+    reward_mins = int(reward_mins)
+    if reward_mins >= minimum_to_prompt:
+        while True:
+            if get_user_input(prompt="Are you here to redeem your rewards mins? (y/n)", yesno=True, default='no'):
+                redeem_amount = get_valid_int(
+                    prompt="How many reward minutes would you like to redeem, current balance: {}".format(reward_mins),
+                    error_prompt="I'm sorry, you don't have that many minutes. Must enter a number between {minimum} and {maximum}",
+                    maximum=int(reward_mins)
+                )
+                if get_user_input(prompt="You're about to redeem: {} minutes, is that correct? (y/n)".format(redeem_amount), yesno=True):
+                    reward_mins -= redeem_amount
                     print("Rewards balance is now: {}".format(reward_mins))
                 else:
                     continue
             break
     return reward_mins
 
-def save_state(state):
-    with open(STATE_FILE, 'w') as sfile:
-        sfile.write(json.dumps(state, indent=4))
+def _json_default(obj):
+    """
+    Let json serialize the problem containers
+    """
+    if isinstance(obj, ProblemPool):
+        return obj.to_list()
+    if isinstance(obj, LatencyStats):
+        return obj.to_dict()
+    if isinstance(obj, MappedSchedule):
+        return obj.to_list()
+    if isinstance(obj, MappedLatency):
+        return obj.to_dict()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+def save_state(state, journal=None):
+    storage, profile = current_profile()
+    storage.write(profile, state, journal)
+
+def get_reward_time(level):
+    """
+    Return the seconds a problem has to be answered in to earn the bonus at a level
+    """
+    reward_time_base = REWARD_TIME_SEC
+    if level >= REWARD_TIME_LONG_LEVEL:
+        reward_time_base = REWARD_TIME_SEC * 2
+    #Adjust the bonus reward timer based on the level
+    return reward_time_base - level * REWARD_TIME_LEVEL_SEC
+
+def apply_mastery(results, library, problem, correct, in_time):
+    """
+    Move a problem between the mastered, needs_work and retired buckets after
+    an answer. Only correct answers given in time count towards mastery.
+
+    Returns (mastered, retired, recovered): mastered for the first time,
+    mastered twice and retired, taken off of needs_work.
+    """
+    mastered = retired = recovered = False
+    if not correct:
+        results['needs_work'].add(problem)
+    elif in_time:
+        #This means you must master a problem twice before it is removed
+        if problem not in results['mastered']:
+            results['mastered'].add(problem)
+            mastered = True
+        else:
+            library.remove(problem)
+            retired = True
+        if problem in results['needs_work']:
+            recovered = True
+            results['needs_work'].remove(problem)
+            library.append(problem) # Add back to normal list of tuple problems so that mastery can be checked again
+            retired = False
+    return mastered, retired, recovered
+
+AnswerResult = collections.namedtuple('AnswerResult', (
+    'problem',        # The (lh, rh, op) problem that was answered
+    'answer',         # The learner's answer
+    'correct_answer',
+    'correct',
+    'points',         # Points earned, bonus included
+    'bonus',          # Answered within the bonus reward time
+    'duration',       # Seconds taken to answer
+    'mastered',       # The problem was mastered for the first time
+    'retired',        # The problem was mastered twice and removed from the library
+    'recovered',      # The problem was taken off of needs_work
+    'time_up',        # The session ran out of time with this answer
+    'timed_out',      # The session ran out of time before an answer came, nothing was graded
+))
+
+class Session(object):
+    """
+    The game engine for a single learner, without any input or output.
+
+    Problem selection, scoring, reward minutes, mastery and level ups all
+    happen here. Front ends call next_problem(), show it however they like and
+    hand the learner's answer to submit(). Answers are journaled to storage
+    as they come in and save() writes a full snapshot. The clock and random
+    number generator can be swapped out to drive sessions without a person.
+
+    The problem library and scheduler aren't built until the first problem
+    is asked for, so redeeming reward minutes or saving doesn't pay for them.
+    """
+    def __init__(self, state, storage=None, profile=None, restart=False, max_min=None, start_time=None, rng=random, clock=None):
+        self.state = state
+        self.storage = storage
+        self.profile = profile
+        self.rng = rng
+        self.clock = time.time if clock is None else clock
+        if restart:
+            state['retired'] = ProblemPool()
+            state.pop('tuples', None)
+            state.pop('schedule', None)
+        self._library = None
+        self._scheduler = None
+        self._results = state['results']
+        self.latency = state['latency'] = LatencyStats.from_dict(state.get('latency'))
+        self.score = state.get('score', 0)
+        self.reward_mins = state.get('reward_mins', 0)
+        self.level = state.get('level', 1)
+        self.rewards_enabled = state.get('rewards_enabled', False)
+        self.max_min = MAX_MIN if max_min is None else max_min
+        self.start_time = self.clock() if start_time is None else start_time
+        self.journal = None
+        if storage is not None:
+            self.journal = storage.journal(profile, seq=state.get('journal_seq', 0))
+        self.problem = None
+        self.problem_start = None
+
+    def load(self):
+        """
+        Build the problem library and scheduler now instead of for the first problem
+        """
+        self._library = load_library(self.state)
+        self._scheduler = make_scheduler(self.state, self._library, self._results, rng=self.rng)
+
+    @property
+    def library(self):
+        if self._library is None:
+            self.load()
+        return self._library
+
+    @property
+    def scheduler(self):
+        if self._scheduler is None:
+            self.load()
+        return self._scheduler
+
+    def lookup(self, problem):
+        """
+        Return the (answer, points) of a problem in this session's problem space
+        """
+        return score_problem(problem, self.library.space.division)
+
+    def reward_time(self):
+        """
+        Return the seconds a problem has to be answered in to earn the bonus
+        """
+        return get_reward_time(self.level)
+
+    def deadline(self):
+        """
+        Return the clock time the session ends at
+        """
+        return self.start_time + (self.max_min * 60)
+
+    def time_left(self):
+        return self.deadline() - self.clock()
+
+    def bonus_left(self):
+        """
+        Return the seconds left to answer the current problem in for the bonus
+        """
+        return self.problem_start + self.reward_time() - self.clock()
+
+    def progress(self):
+        """
+        Return the numbers shown in the problem header
+        """
+        total_problems = len(self.library) + len(self._results['mastered']) + len(self._results['needs_work'])
+        return {
+            'level': self.level,
+            'complete': 100 - int((float(len(self.library))/total_problems)*100) if total_problems else 100,
+            'score': self.score,
+            'reward_mins': self.reward_mins,
+            'num_probs': len(self.library),
+            'mastered': len(self._results['mastered']),
+        }
+
+    def next_problem(self):
+        """
+        Pick the next problem, leveling up first if everything has been mastered
+        """
+        #Pull from the general list of tuples (unless all of have mastered)
+        if not self._results['needs_work'] and not self.library:
+            self.level += 1
+            self.library.reset(self.level)
+            self._results['mastered'].clear()
+            self._results['needs_work'].clear()
+            self.scheduler.reset()
+            self._log({'type': 'level', 'level': self.level})
+        with self.latency.timing('select'):
+            self.problem = self.scheduler.next_problem(now=self.clock())
+        self.problem_start = self.clock()
+        return self.problem
+
+    def submit(self, answer, elapsed=None):
+        """
+        Grade an answer to the current problem and return an AnswerResult
+        """
+        problem = self.problem
+        now = self.clock()
+        if elapsed is None:
+            elapsed = now - self.problem_start
+        grading = perf_timer()
+        correct_answer, answer_points = self.lookup(problem)
+        correct = answer == correct_answer
+        self.latency.answer(problem, elapsed, correct)
+        reward_time = self.reward_time()
+        self.scheduler.record(problem, correct, elapsed, reward_time, now=now)
+        points = 0
+        bonus = False
+        if correct:
+            points = answer_points
+            if elapsed <= reward_time:
+                bonus = True
+                points += SCORING_MATRIX['bonus']
+        mastered, retired, recovered = apply_mastery(self._results, self.library, problem, correct, bonus)
+        if retired:
+            self.scheduler.forget(problem)
+        reward = points * POINTS_TO_REWARD_VAL
+        self.score += points
+        self.reward_mins += reward
+        self.latency.overhead('grade', perf_timer() - grading)
+        self._log({
+            'type': 'answer',
+            'ts': now,
+            'problem': problem,
+            'answer': answer if isinstance(answer, int) else format_answer(answer),
+            'dur': elapsed,
+            'correct': correct,
+            'points': points,
+            'reward': reward,
+            'buckets': {
+                'mastered': problem in self._results['mastered'],
+                'needs_work': problem in self._results['needs_work'],
+                'retired': problem in self.library.retired,
+            },
+            'schedule': self.scheduler.metadata(problem),
+        })
+        self.problem = None
+        return AnswerResult(
+            problem=problem,
+            answer=answer,
+            correct_answer=correct_answer,
+            correct=correct,
+            points=points,
+            bonus=bonus,
+            duration=elapsed,
+            mastered=mastered,
+            retired=retired,
+            recovered=recovered,
+            time_up=now - self.start_time > self.max_min * 60,
+            timed_out=False,
+        )
+
+    def timeout(self):
+        """
+        End the current problem unanswered because the session ran out of
+        time. It isn't a wrong answer, the score, buckets and schedule stay
+        as they are and it is only counted in the latency stats.
+        """
+        problem = self.problem
+        now = self.clock()
+        elapsed = now - self.problem_start
+        self.latency.timeout(problem)
+        self._log({'type': 'timeout', 'ts': now, 'problem': problem, 'dur': elapsed})
+        self.problem = None
+        return AnswerResult(
+            problem=problem,
+            answer=None,
+            correct_answer=self.lookup(problem)[0],
+            correct=False,
+            points=0,
+            bonus=False,
+            duration=elapsed,
+            mastered=False,
+            retired=False,
+            recovered=False,
+            time_up=True,
+            timed_out=True,
+        )
+
+    def display(self):
+        """
+        Return the current problem the way it should be shown
+        """
+        return self.library.space.display(self.problem, self.rng)
+
+    def redeem(self, minutes):
+        """
+        Spend reward minutes
+        """
+        self._log({'type': 'redeem', 'ts': self.clock(), 'reward': -minutes})
+        self.reward_mins -= minutes
+
+    def results(self):
+        """
+        Return the mastered and needs_work problems
+        """
+        return self._results
+
+    def snapshot(self):
+        """
+        Return the full save state of the session
+        """
+        state = dict(self.state)
+        state.update({
+            'results': self._results,
+            'score': self.score,
+            'reward_mins': self.reward_mins,
+            'level': self.level,
+            'latency': self.latency,
+        })
+        #Until the library is loaded the saved retired problems and schedule are still current
+        if self._library is not None:
+            state.update({
+                'retired': self._library.retired,
+                'levels': 'grid' if self._library.tiers is None else 'tiers',
+                'scheduler': self._scheduler.name,
+                'schedule': self._scheduler.to_list(),
+            })
+        return state
+
+    def save(self):
+        """
+        Write a snapshot to storage, replacing the journal
+        """
+        if self.storage is not None:
+            #The time a save takes goes in the next one
+            with self.latency.timing('save'):
+                self.storage.write(self.profile, self.snapshot(), self.journal)
+
+    def _log(self, event):
+        if self.journal is None:
+            return
+        with self.latency.timing('journal'):
+            self.journal.append(event)
+        if self.journal.pending >= JOURNAL_COMPACT_EVERY:
+            self.save()
+
+WORKSHEET_FIELDS = ('worksheet', 'student', 'item', 'lh', 'op', 'rh', 'answer')
+GRADE_SUMMARY_FIELDS = ('student', 'answered', 'correct', 'wrong', 'invalid', 'points', 'reward_mins', 'needs_work', 'mastered')
+
+def generate_worksheets(state, count, problems, needs_work_weight=0.5, rng=random):
+    """
+    Yield count worksheets (lists of problems) for a profile.
+
+    Each problem is drawn from needs_work with probability needs_work_weight
+    and from the rest of the library otherwise, avoiding repeats on a sheet
+    where possible.
+    """
+    library = load_library(state)
+    needs_work = state['results']['needs_work']
+    if not library and not needs_work:
+        #Everything is mastered, the next level starts over with its whole library
+        library.reset(state.get('level', 1) + 1)
+    for _ in range(count):
+        sheet = []
+        seen = set()
+        for _ in range(problems):
+            for _ in range(10):
+                if needs_work and (not library or rng.random() < needs_work_weight):
+                    problem = needs_work.choice(rng)
+                else:
+                    problem = library.choice(rng)
+                if problem not in seen:
+                    break
+            seen.add(problem)
+            sheet.append(library.space.display(problem, rng))
+        yield sheet
+
+def grade_answers(rows, storage, max_open=GRADE_OPEN_PROFILES):
+    """
+    Grade answer rows against the students' profiles and save the results.
+
+    rows is any iterable of dicts with 'student', 'lh', 'op', 'rh' and
+    'answer' (and optionally 'duration' in seconds) and is consumed one row at
+    a time. Without a duration a correct answer counts towards mastery but
+    earns no bonus. At most max_open profiles are kept loaded, so memory
+    doesn't grow with the number of rows. Returns per-student totals.
+    """
+    open_profiles = collections.OrderedDict()
+    totals = {}
+    def close(student):
+        state, library = open_profiles.pop(student)
+        state['retired'] = library.retired
+        storage.write(student, state)
+        totals[student]['needs_work'] = len(state['results']['needs_work'])
+        totals[student]['mastered'] = len(state['results']['mastered'])
+    for row in rows:
+        student = (row.get('student') or '').strip()
+        if student not in totals:
+            totals[student] = dict((field, 0) for field in GRADE_SUMMARY_FIELDS[1:])
+        student_totals = totals[student]
+        try:
+            problem = (int(row['lh']), int(row['rh']), row['op'].strip())
+            duration = row.get('duration')
+            duration = float(duration) if duration not in (None, '') else None
+        except (KeyError, TypeError, ValueError):
+            problem = None
+        if problem is None or problem[2] not in KNOWN_OPERATORS:
+            student_totals['invalid'] += 1
+            continue
+        if student in open_profiles:
+            open_profiles[student] = open_profiles.pop(student)
+        else:
+            state = storage.read(student) if student else None
+            if state is None:
+                student_totals['invalid'] += 1
+                continue
+            open_profiles[student] = (state, load_library(state))
+            if len(open_profiles) > max_open:
+                close(next(iter(open_profiles)))
+        state, library = open_profiles[student]
+        problem = library.space.canonical(problem)
+        division = library.space.division
+        try:
+            answer = parse_answer(row.get('answer') or '', division if problem[2] == '/' else None)
+        except (ValueError, ZeroDivisionError):
+            answer = None
+        reward_time = get_reward_time(state.get('level', 1))
+        (correct, points), = grade_batch([(problem, answer, duration)], division, reward_time)
+        apply_mastery(state['results'], library, problem, correct, duration is None or duration <= reward_time)
+        state['latency'] = LatencyStats.from_dict(state.get('latency'))
+        state['latency'].answer(problem, duration, correct)
+        state['score'] = state.get('score', 0) + points
+        state['reward_mins'] = state.get('reward_mins', 0) + points * POINTS_TO_REWARD_VAL
+        student_totals['answered'] += 1
+        student_totals['correct' if correct else 'wrong'] += 1
+        student_totals['points'] += points
+        student_totals['reward_mins'] += points * POINTS_TO_REWARD_VAL
+    for student in list(open_profiles):
+        close(student)
+    return totals
+
+def _open_output(path):
+    if path == '-':
+        return sys.stdout
+    return open(path, 'w')
+
+def worksheet_main(argv):
+    parser = argparse.ArgumentParser(prog='mathster.py worksheet', description="Generate worksheets from profiles, weighted towards what needs work")
+    parser.add_argument('profiles', nargs='+', metavar='profile')
+    parser.add_argument('--count', type=int, default=1, help="Worksheets per profile (default=1)")
+    parser.add_argument('--problems', type=int, default=20, help="Problems per worksheet (default=20)")
+    parser.add_argument('--needs-work-weight', type=float, default=0.5, help="Chance each problem comes from needs_work (default=0.5)")
+    parser.add_argument('--seed', type=int, help="Random seed, to regenerate the same worksheets")
+    parser.add_argument('--key', action='store_true', help="Fill in the answer column")
+    parser.add_argument('--output', default='-', help="CSV file to write (default=stdout)")
+    args = parser.parse_args(argv)
+    rng = random.Random(args.seed)
+    storage = get_storage()
+    out = _open_output(args.output)
+    writer = csv.writer(out)
+    writer.writerow(WORKSHEET_FIELDS)
+    for profile in args.profiles:
+        state = storage.read(profile)
+        if state is None:
+            print("Cannot find save state file: {}".format(storage.location(profile)))
+            return 1
+        for sheet_num, sheet in enumerate(generate_worksheets(state, args.count, args.problems, args.needs_work_weight, rng), start=1):
+            for item, problem in enumerate(sheet, start=1):
+                answer = format_answer(get_ans(problem[0], problem[1], problem[2], state.get('division', DIVISION_MODE))[0]) if args.key else ''
+                writer.writerow(('{}-{}'.format(profile, sheet_num), profile, item, problem[0], problem[2], problem[1], answer))
+    if out is not sys.stdout:
+        out.close()
+    return 0
+
+def grade_main(argv):
+    parser = argparse.ArgumentParser(prog='mathster.py grade', description="Grade an answers CSV (student,lh,op,rh,answer[,duration]) and update the profiles")
+    parser.add_argument('answers', help="CSV file of answers, '-' for stdin")
+    parser.add_argument('--output', default='-', help="CSV file to write the per-student summary to (default=stdout)")
+    args = parser.parse_args(argv)
+    if args.answers == '-':
+        answers = sys.stdin
+    else:
+        answers = open(args.answers, 'r')
+    totals = grade_answers(csv.DictReader(answers), get_storage())
+    if answers is not sys.stdin:
+        answers.close()
+    out = _open_output(args.output)
+    writer = csv.writer(out)
+    writer.writerow(GRADE_SUMMARY_FIELDS)
+    for student in sorted(totals):
+        row = totals[student]
+        writer.writerow([student] + [round(row[f], 3) if f == 'reward_mins' else row[f] for f in GRADE_SUMMARY_FIELDS[1:]])
+    if out is not sys.stdout:
+        out.close()
+    return 0
+
+def stats_main(argv):
+    parser = argparse.ArgumentParser(prog='mathster.py stats', description="Export the answer latency and engine overhead histograms of profiles")
+    parser.add_argument('profiles', nargs='*', metavar='profile', help="Profiles to export (default=all)")
+    parser.add_argument('--format', choices=('json', 'prom'), default='json', help="JSON summary with quantiles, or Prometheus text (default=json)")
+    parser.add_argument('--output', default='-', help="File to write (default=stdout)")
+    args = parser.parse_args(argv)
+    storage = get_storage()
+    profiles = []
+    for profile in args.profiles or storage.list_profiles():
+        state = storage.read(profile)
+        if state is None:
+            print("Cannot find save state file: {}".format(storage.location(profile)))
+            return 1
+        profiles.append((profile, LatencyStats.from_dict(state.get('latency'))))
+    out = _open_output(args.output)
+    if args.format == 'prom':
+        for line in latency_prometheus(profiles):
+            out.write(line + '\n')
+    else:
+        json.dump(dict((profile, stats.summary()) for profile, stats in profiles), out, indent=4, sort_keys=True)
+        out.write('\n')
+    if out is not sys.stdout:
+        out.close()
+    return 0
+
+REPORT_PROFILE_FIELDS = ('profile', 'level', 'score', 'complete', 'mastered', 'needs_work', 'answers', 'wrong', 'timeouts', 'reward_earned', 'reward_redeemed', 'reward_mins')
+REPORT_FACT_FIELDS = ('lh', 'op', 'rh', 'answers', 'wrong', 'error_rate', 'median_sec', 'profiles', 'mastered', 'needs_work')
+REPORT_LEVEL_FIELDS = ('level', 'profiles', 'complete', 'mastered', 'needs_work', 'reward_earned', 'reward_redeemed')
+
+class Report(object):
+    """
+    Aggregate statistics across profiles, one profile at a time.
+
+    add() folds in a profile and returns its row of REPORT_PROFILE_FIELDS,
+    after which the profile can be dropped. Only per fact and per level
+    totals are kept, so memory grows with the number of distinct problems
+    and levels, not with the number of profiles or answers.
+    """
+    def __init__(self):
+        self.facts = {} # problem -> [answers, wrong, profiles, mastered, needs_work, LatencyHistogram]
+        self.levels = {} # level -> [profiles, complete, mastered, needs_work, reward_earned, reward_redeemed]
+
+    def _fact(self, problem):
+        fact = self.facts.get(problem)
+        if fact is None:
+            fact = self.facts[problem] = [0, 0, 0, 0, 0, LatencyHistogram()]
+        return fact
+
+    def add(self, profile, state):
+        remaining = None
+        if 'left_hand' in state and 'operators' in state:
+            #Also brings old save states up to date
+            remaining = len(load_library(state))
+        results = state.get('results', {})
+        mastered = results.get('mastered', ())
+        needs_work = results.get('needs_work', ())
+        retired = state.get('retired', ())
+        latency = LatencyStats.from_dict(state.get('latency'))
+        for problem in set(latency.problems).union(latency.untimed):
+            fact = self._fact(problem)
+            fact[0] += latency.answers(problem)
+            fact[1] += latency.errors.get(problem, 0)
+            fact[2] += 1
+            if problem in latency.problems:
+                fact[5].merge(latency.problems[problem])
+        for problem in set(mastered).union(retired):
+            self._fact(tuple(problem))[3] += 1
+        for problem in needs_work:
+            self._fact(tuple(problem))[4] += 1
+        complete = 100
+        if remaining is not None:
+            total_problems = remaining + len(mastered) + len(needs_work)
+            if total_problems:
+                complete = 100 - int((float(remaining)/total_problems)*100)
+        #Every point earned POINTS_TO_REWARD_VAL reward minutes, whatever is missing from the balance was redeemed
+        earned = state.get('score', 0) * POINTS_TO_REWARD_VAL
+        redeemed = max(earned - state.get('reward_mins', 0), 0)
+        level = state.get('level', 1)
+        totals = self.levels.setdefault(level, [0, 0, 0, 0, 0.0, 0.0])
+        for idx, value in enumerate((1, complete, len(mastered), len(needs_work), earned, redeemed)):
+            totals[idx] += value
+        answers = latency.answers()
+        return (profile, level, state.get('score', 0), complete, len(mastered), len(needs_work),
+                answers, sum(latency.errors.values()), sum(latency.timeouts.values()), round(earned, 3), round(redeemed, 3), round(state.get('reward_mins', 0), 3))
+
+    def fact_rows(self):
+        """
+        Yield a row of REPORT_FACT_FIELDS for every fact, in numeric order
+        """
+        for problem in sorted(self.facts, key=problem_sort_key):
+            answers, wrong, profiles, mastered, needs_work, hist = self.facts[problem]
+            error_rate = round(float(wrong) / answers, 3) if answers else ''
+            median = hist.quantile(0.5)
+            yield (problem[0], problem[2], problem[1], answers, wrong, error_rate,
+                   round(median, 3) if median is not None else '', profiles, mastered, needs_work)
+
+    def level_rows(self):
+        """
+        Yield a row of REPORT_LEVEL_FIELDS for every level, complete is the average
+        """
+        for level in sorted(self.levels):
+            profiles, complete, mastered, needs_work, earned, redeemed = self.levels[level]
+            yield (level, profiles, round(float(complete) / profiles, 1), mastered, needs_work, round(earned, 3), round(redeemed, 3))
+
+def iter_profile_states(storage):
+    """
+    Yield (profile, state) for every profile in storage, reading one at a time
+    """
+    for profile in storage.list_profiles():
+        state = storage.read(profile)
+        if state is not None:
+            yield profile, state
+
+class _CsvReport(object):
+    def __init__(self, out):
+        self.writer = csv.writer(out)
+        self.started = False
+
+    def table(self, name, fields):
+        if self.started:
+            self.writer.writerow(())
+        self.started = True
+        self.writer.writerow(('# {}'.format(name),))
+        self.writer.writerow(fields)
+
+    def row(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        pass
+
+class _HtmlReport(object):
+    def __init__(self, out):
+        self.out = out
+        self.in_table = False
+        out.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>Mathster report</title>\n'
+                  '<style>table{border-collapse:collapse}th,td{border:1px solid #999;padding:2px 6px;text-align:right}</style>\n'
+                  '</head>\n<body>\n')
+
+    def _end_table(self):
+        if self.in_table:
+            self.out.write('</table>\n')
+            self.in_table = False
+
+    def table(self, name, fields):
+        self._end_table()
+        self.out.write('<h2>{}</h2>\n<table>\n<tr>{}</tr>\n'.format(
+            xml_escape(name.capitalize()), ''.join('<th>{}</th>'.format(xml_escape(field)) for field in fields)))
+        self.in_table = True
+
+    def row(self, row):
+        self.out.write('<tr>{}</tr>\n'.format(''.join('<td>{}</td>'.format(xml_escape(str(value))) for value in row)))
+
+    def close(self):
+        self._end_table()
+        self.out.write('</body>\n</html>\n')
+
+REPORT_TABLES = ('profiles', 'facts', 'levels')
+REPORT_FORMATS = {
+    'csv': _CsvReport,
+    'html': _HtmlReport,
+}
+
+def write_report(profile_states, writer, tables=REPORT_TABLES):
+    """
+    Stream (profile, state) pairs into a report writer. Profile rows are
+    written as each profile is read, the fact and level tables at the end.
+    """
+    report = Report()
+    if 'profiles' in tables:
+        writer.table('profiles', REPORT_PROFILE_FIELDS)
+    for profile, state in profile_states:
+        row = report.add(profile, state)
+        if 'profiles' in tables:
+            writer.row(row)
+    if 'facts' in tables:
+        writer.table('facts', REPORT_FACT_FIELDS)
+        for row in report.fact_rows():
+            writer.row(row)
+    if 'levels' in tables:
+        writer.table('levels', REPORT_LEVEL_FIELDS)
+        for row in report.level_rows():
+            writer.row(row)
+    writer.close()
+    return report
+
+def report_main(argv):
+    parser = argparse.ArgumentParser(prog='mathster.py report', description="Report error rates, latency, mastery and reward minutes across every profile")
+    parser.add_argument('--format', choices=sorted(REPORT_FORMATS), default='csv', help="Output format (default=csv)")
+    parser.add_argument('--table', choices=REPORT_TABLES, action='append', help="Only include this table, can be repeated (default=all)")
+    parser.add_argument('--backend', choices=sorted(STORAGE_BACKENDS), help="Storage backend to read profiles from (default={})".format(STORAGE_BACKEND))
+    parser.add_argument('--state-dir', default=None, help="Directory the profiles are kept in (default={})".format(STATE_FILE_DIR))
+    parser.add_argument('--output', default='-', help="File to write (default=stdout)")
+    args = parser.parse_args(argv)
+    storage = get_storage(backend=args.backend, state_dir=args.state_dir)
+    out = _open_output(args.output)
+    write_report(iter_profile_states(storage), REPORT_FORMATS[args.format](out), tables=args.table or REPORT_TABLES)
+    if out is not sys.stdout:
+        out.close()
+    return 0
+
+SIMULATION_SETTINGS = ('SCORING_MATRIX', 'REWARD_TIME_SEC', 'REWARD_TIME_LEVEL_SEC', 'REWARD_TIME_LONG_LEVEL', 'POINTS_TO_REWARD_VAL', 'SCHEDULER', 'LEVELS', 'LEVEL_TIERS', 'LEVEL_TIER_MIN_PROBLEMS', 'DIFFICULTY_DIGIT_WEIGHT', 'DIFFICULTY_CARRY_WEIGHT', 'DIFFICULTY_ERROR_WEIGHT')
+
+class SimulatedLearner(object):
+    """
+    A synthetic learner answering problems.
+
+    A problem is answered right with probability accuracy at first, and the
+    chance of a mistake shrinks by learning every time the problem comes up
+    again. Answer times are log-normal around latency seconds, plus
+    digit_sec for every extra digit in the answer, and drop towards half of
+    that with practice.
+    """
+    def __init__(self, accuracy=0.85, latency=6.0, latency_sigma=0.4, learning=0.1, digit_sec=1.0):
+        self.accuracy = accuracy
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.learning = learning
+        self.digit_sec = digit_sec
+        self.seen = collections.Counter()
+
+    def respond(self, problem, correct_answer, rng):
+        """
+        Return (answer, seconds taken) for a problem
+        """
+        practice = (1 - self.learning) ** self.seen[problem]
+        self.seen[problem] += 1
+        seconds = self.latency + self.digit_sec * (len(format_answer(correct_answer).replace('-', '')) - 1)
+        seconds *= rng.lognormvariate(0, self.latency_sigma) * (0.5 + 0.5 * practice)
+        if rng.random() < 1 - (1 - self.accuracy) * practice:
+            return correct_answer, seconds
+        if isinstance(correct_answer, tuple):
+            return (correct_answer[0] + rng.choice((-2, -1, 1, 2)), correct_answer[1]), seconds
+        return correct_answer + rng.choice((-2, -1, 1, 2)), seconds
+
+class ManualClock(object):
+    """
+    A clock for Session that only moves when now is set, for simulated,
+    benchmarked and replayed sessions
+    """
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def simulate_learner(settings, learner, hours, feedback_sec=FEEDBACK_PAUSE_SEC, rng=random):
+    """
+    Play a brand new profile with settings for hours of simulated time.
+
+    The learner goes through a real Session (selection, scoring, mastery and
+    level ups) on a simulated clock. Returns the reward minutes earned per
+    hour, the final level, the seconds each level was reached at and how many
+    times every problem was shown.
+    """
+    clock = ManualClock()
+    session = Session(new_state(**settings), restart=True, max_min=hours * 60, start_time=0, rng=rng, clock=clock)
+    exposures = collections.Counter()
+    level_times = {}
+    answers = correct = 0
+    while True:
+        level = session.level
+        problem = session.next_problem()
+        if session.level != level:
+            level_times[session.level] = clock.now
+        exposures[problem] += 1
+        answer, seconds = learner.respond(problem, session.lookup(problem)[0], rng)
+        if clock.now + seconds > session.deadline():
+            #Time runs out mid-question, like it does on a terminal
+            clock.now = session.deadline()
+            session.timeout()
+            break
+        clock.now += seconds
+        result = session.submit(answer)
+        answers += 1
+        correct += result.correct
+        clock.now += feedback_sec
+        if result.time_up:
+            break
+    return {
+        'reward_per_hour': (session.score * POINTS_TO_REWARD_VAL) / hours,
+        'level': session.level,
+        'level_times': level_times,
+        'answers': answers,
+        'correct': correct,
+        'exposures': exposures,
+    }
+
+def _simulate_chunk(config, start, stop):
+    """
+    Simulate learners start to stop-1, each seeded from the run seed and its
+    number so the results don't depend on how the learners are split up
+    """
+    saved = dict((name, globals()[name]) for name in config['overrides'])
+    globals().update(config['overrides'])
+    try:
+        return _simulate_learners(config, start, stop)
+    finally:
+        globals().update(saved)
+
+def _simulate_learners(config, start, stop):
+    results = []
+    exposures = collections.Counter()
+    for num in range(start, stop):
+        rng = random.Random(config['seed'] * 1000003 + num)
+        learner = SimulatedLearner(
+            accuracy=min(max(rng.gauss(config['accuracy'], config['accuracy_spread']), 0.0), 1.0),
+            latency=config['latency'] * rng.lognormvariate(0, config['latency_spread']),
+            latency_sigma=config['latency_sigma'],
+            learning=config['learning'],
+            digit_sec=config['digit_sec'],
+        )
+        result = simulate_learner(config['settings'], learner, config['hours'], config['feedback_sec'], rng)
+        exposures.update(result.pop('exposures'))
+        results.append(result)
+    return start, results, exposures
+
+def _distribution(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    def pct(q):
+        return values[min(int(q * len(values)), len(values) - 1)]
+    return {
+        'count': len(values),
+        'mean': sum(values) / float(len(values)),
+        'min': values[0],
+        'p10': pct(0.1),
+        'p50': pct(0.5),
+        'p90': pct(0.9),
+        'max': values[-1],
+    }
+
+def parallel_map(func, chunks, workers):
+    """
+    Return func(*chunk) for every chunk, in order, across worker processes
+    when there is more than one worker and concurrent.futures is available
+    """
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:
+        ProcessPoolExecutor = None
+    if ProcessPoolExecutor is None or workers <= 1 or not chunks:
+        return [func(*chunk) for chunk in chunks]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, *zip(*chunks)))
+
+def run_simulation(config, workers=None, chunk_size=None):
+    """
+    Simulate config['learners'] learners across worker processes and return
+    the distributions of reward minutes per hour, minutes to reach each
+    level and problem exposures
+    """
+    learners = config['learners']
+    if not workers:
+        workers = getattr(os, 'cpu_count', lambda: 1)() or 1
+    if chunk_size is None:
+        chunk_size = max(1, int(math.ceil(learners / float(max(workers, 1) * 4))))
+    chunks = [(config, start, min(start + chunk_size, learners)) for start in range(0, learners, chunk_size)]
+    done = parallel_map(_simulate_chunk, chunks, workers)
+    results = []
+    exposures = collections.Counter()
+    for start, chunk_results, chunk_exposures in sorted(done, key=lambda chunk: chunk[0]):
+        results.extend(chunk_results)
+        exposures.update(chunk_exposures)
+    level_minutes = {}
+    for result in results:
+        for level, seconds in result['level_times'].items():
+            level_minutes.setdefault(level, []).append(seconds / 60.0)
+    time_to_level = {}
+    for level in sorted(level_minutes):
+        time_to_level[level] = _distribution(level_minutes[level])
+        time_to_level[level]['reached'] = len(level_minutes[level]) / float(len(results))
+    return {
+        'learners': len(results),
+        'hours': config['hours'],
+        'reward_mins_per_hour': _distribution([result['reward_per_hour'] for result in results]),
+        'answers_per_hour': _distribution([result['answers'] / float(config['hours']) for result in results]),
+        'accuracy': _distribution([result['correct'] / float(result['answers']) for result in results if result['answers']]),
+        'final_level': _distribution([result['level'] for result in results]),
+        'time_to_level_min': time_to_level,
+        'exposures': {
+            'per_learner': _distribution([count / float(len(results)) for count in exposures.values()]),
+            'problems': [list(problem) + [exposures[problem] / float(len(results))] for problem in sorted(exposures, key=problem_sort_key)],
+        },
+    }
+
+def simulate_main(argv):
+    parser = argparse.ArgumentParser(prog='mathster.py simulate', description="Run synthetic learners through the game to see what the scoring and progression settings add up to")
+    parser.add_argument('--learners', type=int, default=1000, help="Learners to simulate (default=1000)")
+    parser.add_argument('--hours', type=float, default=1.0, help="Hours each learner plays (default=1)")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default=one per cpu)")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed, the same seed gives the same results (default=0)")
+    parser.add_argument('--accuracy', type=float, default=0.85, help="Average chance of answering a new problem right (default=0.85)")
+    parser.add_argument('--accuracy-spread', type=float, default=0.05, help="Standard deviation of accuracy between learners (default=0.05)")
+    parser.add_argument('--latency', type=float, default=6.0, help="Median seconds to answer a single digit problem (default=6)")
+    parser.add_argument('--latency-spread', type=float, default=0.3, help="Log-normal sigma of latency between learners (default=0.3)")
+    parser.add_argument('--latency-sigma', type=float, default=0.4, help="Log-normal sigma of one learner's answer times (default=0.4)")
+    parser.add_argument('--digit-sec', type=float, default=1.0, help="Extra seconds per extra digit in the answer (default=1)")
+    parser.add_argument('--learning', type=float, default=0.1, help="How much mistakes and answer times shrink every time a problem is seen again (default=0.1)")
+    parser.add_argument('--feedback-sec', type=float, default=FEEDBACK_PAUSE_SEC, help="Seconds spent after every answer (default={})".format(FEEDBACK_PAUSE_SEC))
+    parser.add_argument('--left-hand', default=','.join(str(i) for i in LEFT_HAND), help="Comma separated left hand numbers")
+    parser.add_argument('--right-hand', default=','.join(str(i) for i in RIGHT_HAND), help="Comma separated right hand numbers")
+    parser.add_argument('--operators', default='+-*', help="Operators to use (default=+-*)")
+    parser.add_argument('--canonical', action='store_true', help="Count 3 x 4 and 4 x 3 as the same problem")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=JSON',
+                        help="Override a setting for the run, one of: {}".format(', '.join(SIMULATION_SETTINGS)))
+    parser.add_argument('--output', default='-', help="JSON file to write (default=stdout)")
+    args = parser.parse_args(argv)
+    overrides = {}
+    for setting in args.set:
+        name, _, value = setting.partition('=')
+        if name not in SIMULATION_SETTINGS:
+            parser.error("Unknown setting: {}".format(name))
+        try:
+            overrides[name] = json.loads(value)
+        except ValueError:
+            parser.error("Setting {} is not valid JSON: {}".format(name, value))
+    config = {
+        'learners': args.learners,
+        'hours': args.hours,
+        'seed': args.seed,
+        'accuracy': args.accuracy,
+        'accuracy_spread': args.accuracy_spread,
+        'latency': args.latency,
+        'latency_spread': args.latency_spread,
+        'latency_sigma': args.latency_sigma,
+        'digit_sec': args.digit_sec,
+        'learning': args.learning,
+        'feedback_sec': args.feedback_sec,
+        'overrides': overrides,
+        'settings': {
+            'left_hand': [int(i) for i in args.left_hand.split(',')],
+            'right_hand': [int(i) for i in args.right_hand.split(',')],
+            'operators': list(args.operators),
+            'allow_sub_neg_ans': ALLOW_SUB_NEGATIVE_ANS == 'yes',
+            'allow_sub_mult_dbl_q': ALLOW_SUB_MULTI_DBL_QUESTION == 'yes',
+            'canonical': args.canonical,
+            'rewards_enabled': True,
+        },
+    }
+    summary = run_simulation(config, workers=args.workers)
+    summary['config'] = config
+    out = _open_output(args.output)
+    json.dump(summary, out, indent=4, sort_keys=True)
+    out.write('\n')
+    if out is not sys.stdout:
+        out.close()
+    return 0
 
 def main(load_save=False):
     running = True
-    reward_time_base = REWARD_TIME_SEC
-    clear()
+    renderer = make_renderer()
+    read = make_input()
+    renderer.clear()
     if load_save:
         print("Loading save data")
         save_data = load_state()
-        try:
-            tuples = save_data['tuples']
-        except KeyError:
-            tuples = gen_tuples(**save_data)
     else:
         save_data = load_state(new=True)
-        tuples = gen_tuples(**save_data)
-        total_problems = len(tuples)
-    results = save_data['results']
-    score = save_data['score']
-    rewards_enabled = save_data.get('rewards_enabled', False)
-    reward_mins = save_data.get('reward_mins', 0)
-    level = save_data.get('level', 1)
-    operators = save_data['operators']
-    left_hand = save_data['left_hand']
-    right_hand = save_data['right_hand']
-    allow_sub_neg_ans = save_data.get('allow_sub_neg_ans', ALLOW_SUB_NEGATIVE_ANS)
-    allow_sub_mult_dbl_q = save_data.get('allow_sub_mult_dbl_q', ALLOW_SUB_MULTI_DBL_QUESTION)
+    storage, profile = current_profile()
+    session = Session(save_data, storage=storage, profile=profile, restart=not load_save, max_min=MAX_MIN, start_time=START_TIME)
     problem_header_text1 = "### Level: {level} Complete: %{complete} ###\nCurrent Score: {score}"
-    problem_header_text2 = "\nLibrary of problems: {num_probs} mastered: {mastered}\nTime Left: {time_left} {time_units}\n"
-    if rewards_enabled:
+    problem_header_text2 = "\nLibrary of problems: {num_probs} mastered: {mastered}\nTime Left: {time_left} {time_units}{bonus}\n"
+    if session.rewards_enabled:
         problem_header_text1 += " ({reward_mins:.3f} reward mins)"
         #Check if we are redeeming reward mins
-        new_reward_mins = redeem_reward_mins(reward_mins, minimum_to_prompt=15)
-        if int(new_reward_mins) < int(reward_mins):
-            print("Saving state file to: {}...".format(STATE_FILE))
-            save_state({
-                'results': results,
-                'tuples': tuples,
-                'score': score,
-                'reward_mins': new_reward_mins,
-                'rewards_enabled': rewards_enabled,
-                'level': level,
-                'operators': operators,
-                'left_hand': left_hand,
-                'right_hand': right_hand,
-                'allow_sub_neg_ans': allow_sub_neg_ans,
-                'allow_sub_mult_dbl_q': allow_sub_mult_dbl_q
-            })
+        new_reward_mins = redeem_reward_mins(session.reward_mins, minimum_to_prompt=15)
+        if int(new_reward_mins) < int(session.reward_mins):
+            session.redeem(session.reward_mins - new_reward_mins)
+            print("Saving state file to: {}...".format(storage.location(profile)))
+            session.save()
             return
     problem_header_text = problem_header_text1 + problem_header_text2
-    if level >= 10:
-        reward_time = REWARD_TIME_SEC * 2
-    end_time = START_TIME + (MAX_MIN * 60)
-    while running:
-        time_left = end_time - time.time()
+
+    def draw(level_up_text, prob_text):
+        """
+        Return the frame for the current problem, with the time left as of now
+        """
+        time_left = max(session.time_left(), 0)
         if time_left < 60:
+            time_left = math.ceil(time_left)
             units = "seconds"
         else:
             time_left = int(time_left/60)
             units = "minutes"
-        total_problems = len(tuples) + len(results['mastered']) + len(results['needs_work'])
-        print(problem_header_text.format(
-            level=level,
-            complete=100 - int((len(tuples)/total_problems)*100),
-            score=score,
-            reward_mins=reward_mins,
-            num_probs=len(tuples),
-            mastered=len(results['mastered']),
+        bonus_left = session.bonus_left()
+        header = level_up_text + problem_header_text.format(
             time_left=int(time_left),
-            time_units=units
-        ))
-        if len(results['needs_work']) > 0:
-            if len(results['needs_work']) > 4:
-                #If there are more than 4 problems that need work, then favor the ones that need more work
-                if random.choice([True, True, False]) or not tuples:
-                    work_on = random.choice(results['needs_work'])
-                else:
-                    work_on = random.choice(tuples)
+            time_units=units,
+            bonus=" (bonus points for {} more seconds)".format(int(math.ceil(bonus_left))) if bonus_left > 0 else '',
+            **session.progress()
+        )
+        return header + '\n' + prob_text
+
+    try:
+        while running:
+            level = session.level
+            session.next_problem()
+            work_on = session.display()
+            level_up_text = ''
+            if session.level != level:
+                level_up_text = "CONGRATURATLIONS!!! You've progressed to level {}\n".format(session.level)
+            prob_text = "  Solve the problem:\n\n    {0} {2} {1} = ?\n".format(*work_on)
+            if session.level >= 10:
+                if work_on[0] >= work_on[1]:
+                    prob_text = "Solve the problem:\n\n{indent} {0:>4}\n{indent}{2}{1:>4}\n{indent}{flat:>4}\n".format(*work_on, indent='    ', flat='_____')
+            with session.latency.timing('render'):
+                renderer.frame(draw(level_up_text, prob_text))
+            if read is not None:
+                #The countdown keeps going while the answer is typed and the session ends the moment time is up
+                read.deadline = session.deadline()
+                read.on_tick = lambda: renderer.refresh(draw(level_up_text, prob_text))
+            division = session.library.space.division if work_on[2] == '/' else None
+            try:
+                ans_resp = get_valid_answer(division, prompt=renderer.prompt("Enter your answer"), read=read)
+            except InputTimeout:
+                session.timeout()
+                renderer.feedback("Time is UP!")
+                running = False
+                continue
+            if ans_resp == None:
+                renderer.feedback("Exiting")
+                running = False
+                continue
+            result = session.submit(ans_resp)
+            if result.correct:
+                renderer.feedback(random.choice(CONGRATULATIONS).format(points=result.points - (SCORING_MATRIX['bonus'] if result.bonus else 0)))
+                if result.bonus:
+                    renderer.feedback("You answered in {:.1f} seconds! Enjoy {} extra bonus points!".format(result.duration, SCORING_MATRIX['bonus']))
+                if result.recovered:
+                    renderer.feedback("CONGRATULATIONS!! You got one right that you got wrong before!")
             else:
-                #If there are 1-4 problems that need work then slightly favor one from the main pool of tuples
-                if random.choice([True, False, False]) or not tuples:
-                    work_on = random.choice(results['needs_work'])
-                else:
-                    work_on = random.choice(tuples)
-        else:
-            #Pull from the general list of tuples (unless all of have mastered)
-            if not tuples:
-                level += 1
-                print("CONGRATURATLIONS!!! You've progressed to level {}".format(level))
-                tuples = gen_tuples(left_hand, right_hand, operators)
-                results['mastered'] = []
-                results['needs_work'] = []
-            work_on = random.choice(tuples)
-        if level >= 10:
-            reward_time_base = REWARD_TIME_SEC * 2
-        #Adjust the bonus reward timer based on the level
-        reward_time_adjust = level * 2
-        reward_time = reward_time_base - reward_time_adjust
-        #Set start time
-        prob_start = time.time()
-        prob_prompt = "  Solve the problem:\n\n    {0} {2} {1} = ?\n\nEnter your answer".format(*work_on)
-        if level >= 10:
-            if work_on[0] >= work_on[1]:
-                prob_prompt = "Solve the problem:\n\n{indent} {0:>4}\n{indent}{2}{1:>4}\n{indent}{flat:>4}\n\nEnter your answer".format(*work_on, indent='    ', flat='_____')
-        ans_resp = get_valid_int(prompt=prob_prompt)
-        prob_end = time.time()
-        prob_dur = prob_end - prob_start
-        correct_ans = get_ans(*work_on)
-        if ans_resp == correct_ans[0]:
-            ans_points = get_score_value(*correct_ans)
-            score += ans_points
-            reward_mins += ans_points * POINTS_TO_REWARD_VAL
-            print(random.choice(CONGRATULATIONS).format(points=ans_points))
-            if prob_dur <= reward_time:
-                score += SCORING_MATRIX['bonus']
-                reward_mins += POINTS_TO_REWARD_VAL * SCORING_MATRIX['bonus']
-                print("You answered in {:.1f} seconds! Enjoy {} extra bonus points!".format(prob_dur, SCORING_MATRIX['bonus']))
-                #This means you must master a problem twice before it is removed
-                if work_on not in results['mastered']:
-                    results['mastered'].append(work_on)
-                else:
-                    tuples.remove(work_on)
-                if work_on in results['needs_work']:
-                    print("CONGRATULATIONS!! You got one right that you got wrong before!")
-                    results['needs_work'].remove(work_on)
-                    tuples.append(work_on) # Add back to normal list of tuple problems so that mastery can be checked again
-        elif ans_resp == None:
-            print("Exiting")
-            running = False
-            continue
-        else:
-            print(random.choice(ENCOURAGEMENTS).format(answer=correct_ans[0]))
-            if not work_on in results['needs_work']:
-                results['needs_work'].append(work_on)
-            if level < 10:
-                while not get_valid_int(prompt="Show me you've see the answer. Enter it here") == correct_ans[0]:
-                    print("The correct answer should be: {}".format(correct_ans[0]))
-        if prob_end - START_TIME > MAX_MIN * 60:
-            print("Time is UP!")
-            running = False
-        else:
-            time.sleep(1.5)
-            clear()
-    print_results(results)
-    print("\nFinal score: {}".format(score))
+                renderer.feedback(random.choice(ENCOURAGEMENTS).format(answer=format_answer(result.correct_answer)))
+                if session.level < 10:
+                    if read is not None:
+                        read.on_tick = None
+                    try:
+                        while not get_valid_answer(division, prompt="Show me you've see the answer. Enter it here", read=read) == result.correct_answer:
+                            renderer.feedback("The correct answer should be: {}".format(format_answer(result.correct_answer)))
+                    except InputTimeout:
+                        result = result._replace(time_up=True)
+            if result.time_up:
+                renderer.feedback("Time is UP!")
+                running = False
+            else:
+                renderer.pause(FEEDBACK_PAUSE_SEC)
+                renderer.end_frame()
+    except (KeyboardInterrupt, SystemExit):
+        #Fold the journal into the save state file on the way out so nothing is lost
+        print("\nSaving state file to: {}...".format(storage.location(profile)))
+        session.save()
+        raise
+    finally:
+        if read is not None:
+            read.close()
+    print_results(session.results())
+    print("\nFinal score: {}".format(session.score))
     try:
         text_input("Press 'Enter' to exit")
     except:
         sys.exit(1)
-    print("Saving state file to: {}...".format(STATE_FILE))
-    save_state({
-        'results': results,
-        'tuples': tuples,
-        'score': score,
-        'reward_mins': reward_mins,
-        'rewards_enabled': rewards_enabled,
-        'level': level,
-        'operators': operators,
-        'left_hand': left_hand,
-        'right_hand': right_hand,
-        'allow_sub_neg_ans': allow_sub_neg_ans,
-        'allow_sub_mult_dbl_q': allow_sub_mult_dbl_q
-    })
+    print("Saving state file to: {}...".format(storage.location(profile)))
+    session.save()
 
 if __name__ == "__main__":
     PROFILE = None
@@ -523,23 +4103,54 @@ if __name__ == "__main__":
             save_state(NEW_STATE)
             PROFILES = [ PROFILE ]
             LOAD_SAVE = True
+        elif sys.argv[1] == 'import-json':
+            #Into the sqlite backend unless another one is given
+            for IMPORTED in import_json_profiles(storage=get_storage(sys.argv[2]) if len(sys.argv) > 2 else None):
+                print("Imported profile: {}".format(IMPORTED))
+            sys.exit(0)
+        elif sys.argv[1] == 'export-json':
+            #From the configured backend unless another one is given, next to the other profiles unless a directory is given
+            for EXPORTED in export_json_profiles(get_storage(sys.argv[2] if len(sys.argv) > 2 else None), sys.argv[3] if len(sys.argv) > 3 else None):
+                print("Exported profile: {}".format(EXPORTED))
+            sys.exit(0)
+        elif sys.argv[1] == 'worksheet':
+            sys.exit(worksheet_main(sys.argv[2:]))
+        elif sys.argv[1] == 'grade':
+            sys.exit(grade_main(sys.argv[2:]))
+        elif sys.argv[1] == 'stats':
+            sys.exit(stats_main(sys.argv[2:]))
+        elif sys.argv[1] == 'report':
+            sys.exit(report_main(sys.argv[2:]))
+        elif sys.argv[1] == 'simulate':
+            sys.exit(simulate_main(sys.argv[2:]))
+        elif sys.argv[1] == 'bench':
+            import mathster_bench
+            sys.exit(mathster_bench.main(sys.argv[2:]))
+        elif sys.argv[1] in ('record', 'replay', 'loadtest'):
+            import mathster_replay
+            sys.exit(mathster_replay.main(sys.argv[1:]))
+        elif sys.argv[1] in ('serve', 'client', 'loadgen'):
+            #The server needs asyncio, so it lives in its own python3 only module
+            import mathster_server
+            sys.exit(mathster_server.main(sys.argv[1:]))
         else:
             print("Unknown argument: {}".format(sys.argv[1]))
             sys.exit(1)
     START_TIME=time.time()
     if not PROFILE:
         # Load the profile selection
-        PROFILES = [f[:-11] for f in os.listdir(STATE_FILE_DIR) if os.path.isfile('{}/{}'.format(STATE_FILE_DIR,f)) and f.endswith('-stats.json')]
-        PROFILES.sort()
+        MANIFEST = get_storage().manifest()
+        PROFILES = sorted(MANIFEST)
         if not PROFILES:
             PROFILE = get_user_input(prompt='No profile found, enter a name to create a new profile')
             STATE_FILE = '{}/{}-stats.json'.format(STATE_FILE_DIR, PROFILE)
             NEW_STATE = load_state(new=True)
             save_state(NEW_STATE)
         else:
-            PROFILE = get_selection_menu(options=PROFILES, title="Select your profile to load")[0]
+            PROFILE_LABELS = [profile_label(p, MANIFEST[p]) for p in PROFILES]
+            PROFILE = PROFILES[PROFILE_LABELS.index(get_selection_menu(options=PROFILE_LABELS, title="Select your profile to load")[0])]
             STATE_FILE = '{}/{}-stats.json'.format(STATE_FILE_DIR, PROFILE)
-            if os.path.isfile(STATE_FILE):
+            if get_storage().exists(PROFILE):
                 if not get_user_input(prompt='Ready to load profile "{}". Would you like to load it to resume? (y/n)'.format(PROFILE), yesno=True):
                     if not get_user_input(prompt='Are you sure? All previous progress will be lost! (y/n)', yesno=True):
                         print("Ok, exiting!")
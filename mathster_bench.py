@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the hot paths of the mathster engine.
+
+Every benchmark times one piece of work on synthetic profiles of growing
+size: generating problems, picking and grading them, scoring, saving and
+loading big profiles, sorting the end of game results, and the interactive
+loop itself driven by a scripted learner typing on stdin (with clear() and
+the pauses stubbed out). Each piece of work is repeated a few rounds and the
+best and median round are reported.
+
+Results are written as JSON so runs of different versions can be compared:
+
+    python mathster.py bench --output old.json
+    (change things)
+    python mathster.py bench --compare old.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import mathster
+
+BENCH_SEED = 1234 # Seed for every random choice, so runs work on the same data
+RANGE_SIZES = (12, 50, 200) # Left and right hand run from 1 to these
+OPERATOR_MIXES = ('+', '+,-,*', '+,-,*,/')
+SESSION_SIZES = ((50, 100), (200, 2000), (500, 20000)) # (range, problems spread over the buckets) of the sessions picking problems
+SESSION_ANSWERS = 2000
+PROFILE_SIZES = (1000, 20000, 100000) # Problems mastered, retired or needing work in the profiles saved and loaded
+LOOP_ANSWERS = 500 # Answers typed into the interactive loop per round
+ROUNDS = 5
+QUICK = {
+    'range_sizes': (12, 50),
+    'session_sizes': ((50, 100), (200, 2000)),
+    'session_answers': 500,
+    'profile_sizes': (1000, 20000),
+    'loop_answers': 100,
+    'rounds': 3,
+}
+
+def _rounds(func, rounds):
+    """
+    Call func once per round, return the seconds every round took
+    """
+    times = []
+    for _ in range(rounds):
+        start = mathster.perf_timer()
+        func()
+        times.append(mathster.perf_timer() - start)
+    return times
+
+def _result(name, params, times, ops=1):
+    """
+    Summarize the rounds of a benchmark, ops is the work done in one round
+    """
+    times = sorted(times)
+    median = times[len(times) // 2]
+    return {
+        'name': name,
+        'params': params,
+        'rounds': len(times),
+        'ops': ops,
+        'best_sec': times[0],
+        'median_sec': median,
+        'ops_per_sec': ops / median if median else None,
+    }
+
+@contextlib.contextmanager
+def patched(obj, **attrs):
+    """
+    Set attributes of obj for the duration of the block, ones it didn't
+    have are removed again afterwards
+    """
+    missing = object()
+    saved = dict((name, getattr(obj, name, missing)) for name in attrs)
+    for name, value in attrs.items():
+        setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is missing:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, value)
+
+def _settings(size, operators='+,-,*', **settings):
+    """
+    Return the settings of a profile practicing 1 to size with operators
+    """
+    hand = list(range(1, size + 1))
+    state = dict(
+        left_hand=hand,
+        right_hand=list(hand),
+        operators=operators.split(','),
+        allow_sub_neg_ans=False,
+        allow_sub_mult_dbl_q=False,
+        canonical=False,
+        division='exact',
+        rewards_enabled=False,
+    )
+    state.update(settings)
+    return state
+
+def _profile(size, problems, rng, operators='+,-,*'):
+    """
+    Return a save state with the schedule and latency stats of a short
+    session, and problems spread over the buckets
+    """
+    state = mathster.new_state(**_settings(size, operators))
+    session = mathster.Session(state, rng=rng, clock=mathster.ManualClock())
+    for _ in range(min(problems, 2000)):
+        problem = session.next_problem()
+        session.clock.now += rng.uniform(1, 10)
+        correct_answer = session.lookup(problem)[0]
+        session.submit(correct_answer if rng.random() < 0.8 else None)
+    state = session.snapshot()
+    space = session.library.space
+    sample = set()
+    while len(sample) < min(problems, len(space)):
+        sample.add(space.sample(rng))
+    sample = sorted(sample)
+    rng.shuffle(sample)
+    state['retired'] = mathster.ProblemPool(sample[:len(sample) // 2])
+    state['results'] = {
+        'mastered': mathster.ProblemPool(sample[:len(sample) * 3 // 4]),
+        'needs_work': mathster.ProblemPool(sample[len(sample) * 3 // 4:]),
+    }
+    return state
+
+def bench_gen_tuples(config):
+    """
+    Materializing every problem with gen_tuples() and sizing the lazy ProblemSpace
+    """
+    for size in config['range_sizes']:
+        hand = list(range(1, size + 1))
+        for mix in OPERATOR_MIXES:
+            operators = mix.split(',')
+            count = len(mathster.gen_tuples(hand, hand, operators))
+            params = {'range': size, 'operators': mix}
+            yield _result('gen_tuples', params, _rounds(lambda: mathster.gen_tuples(hand, hand, operators), config['rounds']), count)
+            yield _result('problem_space', params, _rounds(lambda: len(mathster.ProblemSpace(hand, hand, operators)), config['rounds']), count)
+
+def bench_session(config):
+    """
+    Picking, grading and retiring problems the way the main() loop does, with
+    a large library and needs_work list
+    """
+    for size, problems in config['session_sizes']:
+        for scheduler in sorted(mathster.SCHEDULERS):
+            rng = random.Random(BENCH_SEED)
+            state = _profile(size, problems, rng, operators='+,*')
+            state['scheduler'] = scheduler
+            state.pop('schedule', None)
+            answers = config['session_answers']
+            def play():
+                session = mathster.Session(dict(state, results={
+                    'mastered': mathster.ProblemPool(state['results']['mastered']),
+                    'needs_work': mathster.ProblemPool(state['results']['needs_work']),
+                }, retired=mathster.ProblemPool(state['retired'])), rng=random.Random(BENCH_SEED), clock=mathster.ManualClock())
+                for _ in range(answers):
+                    problem = session.next_problem()
+                    session.clock.now += 3
+                    correct_answer = session.lookup(problem)[0]
+                    session.submit(correct_answer if session.rng.random() < 0.8 else None)
+            params = {'range': size, 'problems': problems, 'needs_work': len(state['results']['needs_work']), 'scheduler': scheduler}
+            yield _result('session_answer', params, _rounds(play, config['rounds']), answers)
+
+def bench_scoring(config):
+    """
+    Answer and score lookups
+    """
+    hand = list(range(1, 51))
+    for mix in OPERATOR_MIXES:
+        operators = mix.split(',')
+        problems = mathster.gen_tuples(hand, hand, operators)
+        answers = [mathster.get_ans(lh, rh, op) for lh, rh, op in problems]
+        def get_ans():
+            for lh, rh, op in problems:
+                mathster.get_ans(lh, rh, op)
+        def get_score_value():
+            for ans, op in answers:
+                mathster.get_score_value(ans, op)
+        params = {'range': 50, 'operators': mix}
+        yield _result('get_ans', params, _rounds(get_ans, config['rounds']), len(problems))
+        yield _result('get_score_value', params, _rounds(get_score_value, config['rounds']), len(problems))
+
+def bench_storage(config):
+    """
+    Saving, loading and starting a session of large profiles with every storage backend
+    """
+    for problems in config['profile_sizes']:
+        state = _profile(500, problems, random.Random(BENCH_SEED))
+        for backend in sorted(mathster.STORAGE_BACKENDS):
+            state_dir = tempfile.mkdtemp(prefix='mathster-bench-')
+            try:
+                storage = mathster.get_storage(backend, state_dir)
+                params = {'problems': problems, 'backend': backend}
+                yield _result('profile_save', params, _rounds(lambda: storage.write('bench', state), config['rounds']))
+                yield _result('profile_load', params, _rounds(lambda: mathster.load_library(storage.read('bench')), config['rounds']))
+                #Reading the profile up to its first question, with the library and scheduler
+                for levels in mathster.LEVEL_MODES:
+                    storage.write('bench-' + levels, dict(state, levels=levels))
+                    def start(profile='bench-' + levels):
+                        mathster.Session(storage.read(profile), clock=mathster.ManualClock()).next_problem()
+                    yield _result('session_start', dict(params, levels=levels), _rounds(start, config['rounds']))
+            finally:
+                for key in [key for key in mathster._STORAGE_CACHE if key[1].startswith(state_dir)]:
+                    storage = mathster._STORAGE_CACHE.pop(key)
+                    if hasattr(storage, 'close'):
+                        storage.close()
+                shutil.rmtree(state_dir, ignore_errors=True)
+
+class NullOutput(object):
+    """
+    Output that goes nowhere
+    """
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+def bench_print_results(config):
+    """
+    Sorting and printing the end of game results
+    """
+    for problems in config['profile_sizes']:
+        results = _profile(500, problems, random.Random(BENCH_SEED))['results']
+        def run():
+            with patched(sys, stdout=NullOutput()):
+                mathster.print_results(results)
+        yield _result('print_results', {'problems': problems}, _rounds(run, config['rounds']), len(results['mastered']) + len(results['needs_work']))
+
+class ScriptedTerminal(object):
+    """
+    Stand in for the terminal while main() runs.
+
+    Output is thrown away except for its tail, which the scripted learner
+    reads the current problem from. Used as text_input() it types answers
+    (every wrong_every'th one wrong, then the right one when asked to show
+    it), and 'exit' once answers have been given.
+    """
+    PROBLEM = re.compile(r'(-?\d+) ([-+*x/]) (-?\d+) = \?|(-?\d+)\n\s*([-+*x/])\s*(-?\d+)\n')
+
+    def __init__(self, answers, wrong_every=5):
+        self.answers = answers
+        self.wrong_every = wrong_every
+        self.given = 0
+        self.tail = ''
+        self.last = None
+
+    def write(self, text):
+        self.tail = (self.tail + text)[-500:]
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def __call__(self, prompt=''):
+        self.write(prompt)
+        if 'Show me' in prompt:
+            return self.last
+        if 'Enter your answer' not in prompt:
+            return ''
+        if self.given >= self.answers:
+            return 'exit'
+        groups = [group for group in list(self.PROBLEM.finditer(self.tail))[-1].groups() if group is not None]
+        lh, op, rh = int(groups[0]), groups[1], int(groups[2])
+        self.last = mathster.format_answer(mathster.get_ans(lh, rh, op)[0])
+        self.given += 1
+        if self.given % self.wrong_every == 0:
+            return self.last + '1'
+        return self.last
+
+def bench_main_loop(config):
+    """
+    The interactive loop end to end, with a scripted learner on stdin,
+    including journaling and saving the profile
+    """
+    for size in config['range_sizes']:
+        state_dir = tempfile.mkdtemp(prefix='mathster-bench-')
+        try:
+            storage = mathster.JsonStorage(state_dir)
+            state = mathster.new_state(**_settings(size))
+            answers = config['loop_answers']
+            def play():
+                terminal = ScriptedTerminal(answers)
+                random.seed(BENCH_SEED)
+                with patched(mathster, text_input=terminal, clear=lambda: None, make_input=lambda stream=None: None,
+                              STATE_FILE_DIR=state_dir, STATE_FILE=storage.location('bench'), STORAGE_BACKEND=storage.name,
+                              START_TIME=time.time(), MAX_MIN=24 * 60, FEEDBACK_PAUSE_SEC=0), \
+                     patched(time, sleep=lambda seconds: None), \
+                     patched(sys, stdout=terminal):
+                    mathster.main(load_save=True)
+            times = []
+            for _ in range(config['rounds']):
+                storage.write('bench', json.loads(json.dumps(state, default=mathster._json_default)))
+                times.extend(_rounds(play, 1))
+            yield _result('main_loop', {'range': size, 'operators': '+,-,*'}, times, answers)
+        finally:
+            shutil.rmtree(state_dir, ignore_errors=True)
+
+BENCHMARKS = (
+    ('gen_tuples', bench_gen_tuples),
+    ('session', bench_session),
+    ('scoring', bench_scoring),
+    ('storage', bench_storage),
+    ('print_results', bench_print_results),
+    ('main_loop', bench_main_loop),
+)
+
+def _revision():
+    """
+    Return the git revision of the code being measured, if there is one
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(mathster.__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(config, only=()):
+    """
+    Run the BENCHMARKS named in only (all of them by default) and return the
+    report
+    """
+    report = {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'created': time.time(),
+        'config': config,
+        'benchmarks': [],
+    }
+    for name, bench in BENCHMARKS:
+        if only and name not in only:
+            continue
+        sys.stderr.write("Running {}...\n".format(name))
+        report['benchmarks'].extend(bench(config))
+    return report
+
+def _key(result):
+    return (result['name'], json.dumps(result['params'], sort_keys=True))
+
+def compare(old, new, out):
+    """
+    Print how much slower (above 1) or faster every benchmark in new got
+    """
+    old_results = dict((_key(result), result) for result in old['benchmarks'])
+    out.write("Compared to {} ({}):\n".format(old.get('revision'), time.ctime(old.get('created', 0))))
+    for result in new['benchmarks']:
+        before = old_results.get(_key(result))
+        if before is None or not before['median_sec']:
+            ratio = 'new'
+        else:
+            ratio = '{:.2f}x'.format(result['median_sec'] / before['median_sec'])
+        out.write("  {:<16} {:<60} {:>12.6f}s {:>8}\n".format(result['name'], _key(result)[1], result['median_sec'], ratio))
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='mathster.py bench', description="Time the hot paths of the engine and write the results as JSON")
+    parser.add_argument('--output', default='-', help="Where to write the results, - for stdout (default=-)")
+    parser.add_argument('--only', action='append', default=[], choices=[name for name, _ in BENCHMARKS],
+                        help="Only run this benchmark, can be given more than once")
+    parser.add_argument('--quick', action='store_true', help="Smaller sizes and fewer rounds")
+    parser.add_argument('--rounds', type=int, help="Rounds per benchmark (default={})".format(ROUNDS))
+    parser.add_argument('--compare', metavar='RESULTS', help="Results of an earlier run to compare against, printed to stderr")
+    args = parser.parse_args(argv)
+    config = {
+        'range_sizes': RANGE_SIZES,
+        'session_sizes': SESSION_SIZES,
+        'session_answers': SESSION_ANSWERS,
+        'profile_sizes': PROFILE_SIZES,
+        'loop_answers': LOOP_ANSWERS,
+        'rounds': ROUNDS,
+    }
+    if args.quick:
+        config.update(QUICK)
+    if args.rounds:
+        config['rounds'] = args.rounds
+    old = None
+    if args.compare:
+        with open(args.compare, 'r') as cfile:
+            old = json.load(cfile)
+    report = run_benchmarks(config, args.only)
+    out = mathster._open_output(args.output)
+    try:
+        out.write(json.dumps(report, indent=4, sort_keys=True) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if old is not None:
+        compare(old, report, sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+"""
+Record sessions of the interactive game and replay them.
+
+record plays the normal game, main() with its prompts and menus, on a
+profile and writes a script of the session: the profile as it was when the
+session started, the seed of the random number generator, and everything
+the learner typed with when they typed it:
+
+    python mathster.py record alice alice-session.json
+
+replay runs main() again from the saved starting profile in a scratch
+directory, typing the recorded input at full speed on a clock that jumps to
+the recorded times, so it plays out exactly the way it did. The prompts and
+the score and buckets it ends with are checked against the recording:
+
+    python mathster.py replay alice-session.json
+
+loadtest replays scripts over and over across worker processes and writes
+the questions answered per second as JSON, optionally with the CPU profile
+(cProfile) and the allocations (tracemalloc, Python 3 only) of the loop:
+
+    python mathster.py loadtest alice-session.json --replays 200 --cpu-profile
+"""
+
+import argparse
+import contextlib
+import cProfile
+import gc
+import json
+import math
+import os
+import platform
+import pstats
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import mathster
+from mathster_bench import NullOutput, patched
+
+SCRIPT_VERSION = 1
+PROFILE_TOP = 25 # Functions and lines listed in the CPU and allocation profiles
+ANSI_ESCAPE = re.compile(r'\033\[[0-9;?]*[A-Za-z]|\033[78]')
+
+if hasattr(time, 'process_time'):
+    cpu_timer = time.process_time
+else:
+    cpu_timer = time.clock
+
+class ReplayError(Exception):
+    """
+    A replay didn't go the way the recording did
+    """
+    pass
+
+def _plain(prompt):
+    """
+    Return a prompt without the escape sequences a terminal renderer adds
+    """
+    return ANSI_ESCAPE.sub('', prompt)
+
+class _ClockedTime(object):
+    """
+    Stands in for the time module inside mathster, with time() on a ManualClock
+    """
+    def __init__(self, clock):
+        self.time = clock
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class Recorder(object):
+    """
+    Capture the input of a session as it is played.
+
+    Every read and pause main() makes goes through here and becomes an event
+    with the seconds since the start it finished at, moving the ManualClock
+    to that time. Redrawing the countdown moves the clock too, but only the
+    time shown depends on it so it isn't recorded. Since the clock only moves
+    when input comes in or a pause ends, everything main() does in between
+    sees the same time on both runs.
+    """
+    def __init__(self, clock, text_input=None, wall=time.time):
+        self.clock = clock
+        self.text_input = text_input or mathster.text_input
+        self.wall = wall
+        self.started = clock.now
+        self.events = []
+
+    def _event(self, kind, prompt=None, value=None):
+        self.clock.now = self.wall()
+        event = {'kind': kind, 'at': self.clock.now - self.started}
+        if prompt is not None:
+            event['prompt'] = _plain(prompt)
+        if value is not None:
+            event['input'] = value
+        self.events.append(event)
+
+    def read(self, read, prompt=''):
+        try:
+            value = read(prompt)
+        except mathster.InputTimeout:
+            self._event('timeout', prompt)
+            raise
+        except EOFError:
+            self._event('eof', prompt)
+            raise
+        except KeyboardInterrupt:
+            self._event('interrupt', prompt)
+            raise
+        self._event('input', prompt, value)
+        return value
+
+    def __call__(self, prompt=''):
+        return self.read(self.text_input, prompt)
+
+    def pausing(self, pause):
+        def recorded_pause(seconds):
+            try:
+                pause(seconds)
+            except KeyboardInterrupt:
+                self._event('interrupt')
+                raise
+            self._event('pause')
+        return recorded_pause
+
+    def ticking(self, on_tick):
+        def recorded_tick():
+            self.clock.now = self.wall()
+            on_tick()
+        return recorded_tick
+
+class _RecordedInput(object):
+    """
+    A DeadlineInput whose reads are recorded
+    """
+    def __init__(self, recorder, read):
+        object.__setattr__(self, '_recorder', recorder)
+        object.__setattr__(self, '_read', read)
+
+    def __call__(self, prompt=''):
+        return self._recorder.read(self._read, prompt)
+
+    def __getattr__(self, name):
+        return getattr(self._read, name)
+
+    def __setattr__(self, name, value):
+        if name == 'on_tick' and value is not None:
+            value = self._recorder.ticking(value)
+        setattr(self._read, name, value)
+
+class Replayer(object):
+    """
+    Type the recorded input back into a session.
+
+    Reads and pauses take the next event in order and move the ManualClock
+    to when it happened. A read with a different prompt than the one
+    recorded, or running out of events, raises ReplayError.
+    """
+    def __init__(self, events, clock):
+        self.events = events
+        self.clock = clock
+        self.started = clock.now
+        self.pos = 0
+
+    def _next(self, prompt=None):
+        if self.pos >= len(self.events):
+            raise ReplayError("Input was asked for after the last recorded event: {!r}".format(_plain(prompt or '')))
+        event = self.events[self.pos]
+        if prompt is not None and event.get('prompt') != _plain(prompt):
+            raise ReplayError("Event {} was recorded for {!r} but the prompt is {!r}".format(self.pos, event.get('prompt'), _plain(prompt)))
+        self.pos += 1
+        self.clock.now = self.started + event['at']
+        return event
+
+    def __call__(self, prompt=''):
+        event = self._next(prompt)
+        if event['kind'] == 'input':
+            return event['input']
+        if event['kind'] == 'timeout':
+            raise mathster.InputTimeout()
+        if event['kind'] == 'eof':
+            raise EOFError()
+        if event['kind'] == 'interrupt':
+            raise KeyboardInterrupt()
+        raise ReplayError("Event {} is a {} where input was recorded".format(self.pos - 1, event['kind']))
+
+    def pause(self, seconds):
+        event = self._next()
+        if event['kind'] == 'interrupt':
+            raise KeyboardInterrupt()
+        if event['kind'] != 'pause':
+            raise ReplayError("Event {} is {} input where a pause was recorded".format(self.pos - 1, event['kind']))
+
+    def finish(self):
+        if self.pos != len(self.events):
+            raise ReplayError("{} recorded events were never replayed".format(len(self.events) - self.pos))
+
+class _ReplayedInput(object):
+    """
+    Stands in for a DeadlineInput, the deadline is in the recording
+    """
+    def __init__(self, replayer):
+        self.replayer = replayer
+        self.deadline = None
+        self.on_tick = None
+
+    def __call__(self, prompt=''):
+        return self.replayer(prompt)
+
+    def close(self):
+        pass
+
+def outcome(state):
+    """
+    Return what a session ended with, to compare a replay to its recording
+    """
+    if state is None:
+        return None
+    results = state.get('results', {})
+    return {
+        'score': state.get('score', 0),
+        'reward_mins': round(state.get('reward_mins', 0), 9),
+        'level': state.get('level', 1),
+        'mastered': sorted(list(problem) for problem in results.get('mastered', ())),
+        'needs_work': sorted(list(problem) for problem in results.get('needs_work', ())),
+        'retired': len(state.get('retired', ())),
+    }
+
+def answered(state):
+    """
+    Return how many questions a profile has answered or run out of time on
+    """
+    if state is None:
+        return 0
+    latency = mathster.LatencyStats.from_dict(state.get('latency'))
+    return latency.answers() + sum(latency.timeouts.values())
+
+def _state_file(state_dir, profile):
+    """
+    Return the STATE_FILE that points main() at profile, whatever the backend
+    """
+    return '{}/{}-stats.json'.format(state_dir, profile)
+
+def _play(script, clock, read, make_renderer, make_input, state_file):
+    """
+    Run main() with the input, clock and renderer of a recording or replay
+    """
+    random.seed(script['seed'])
+    with patched(mathster, time=_ClockedTime(clock), text_input=read, make_renderer=make_renderer, make_input=make_input,
+                 STATE_FILE=state_file, START_TIME=script['started'], MAX_MIN=script['max_min']):
+        try:
+            mathster.main(load_save=not script['restart'])
+        except (KeyboardInterrupt, SystemExit):
+            #main() saves on the way out, the script ends here either way
+            pass
+
+def record_session(profile, max_min=None, seed=None, restart=False):
+    """
+    Play a session of main() on profile and return its script
+    """
+    storage = mathster.get_storage()
+    initial = storage.read(profile)
+    if seed is None:
+        seed = random.SystemRandom().randrange(2 ** 32)
+    clock = mathster.ManualClock(time.time())
+    recorder = Recorder(clock)
+    script = {
+        'version': SCRIPT_VERSION,
+        'profile': profile,
+        'storage': storage.name,
+        'python': platform.python_version(),
+        'seed': seed,
+        'max_min': mathster.MAX_MIN if max_min is None else max_min,
+        'restart': restart,
+        'started': clock.now,
+        'state': json.loads(json.dumps(initial, default=mathster._json_default)) if initial is not None else None,
+        'events': recorder.events,
+    }
+    real_make_renderer = mathster.make_renderer
+    real_make_input = mathster.make_input
+    def make_renderer(stream=None):
+        renderer = real_make_renderer(stream)
+        renderer.pause = recorder.pausing(renderer.pause)
+        return renderer
+    def make_input(stream=None):
+        read = real_make_input(stream)
+        return _RecordedInput(recorder, read) if read is not None else None
+    _play(script, clock, recorder, make_renderer, make_input, _state_file(mathster.STATE_FILE_DIR, profile))
+    ended = storage.read(profile)
+    script['outcome'] = outcome(ended)
+    script['questions'] = answered(ended) - answered(initial)
+    return script
+
+@contextlib.contextmanager
+def _scratch_dir():
+    """
+    Yield a directory to replay in, the storage backends opened on it are
+    closed and forgotten afterwards
+    """
+    state_dir = tempfile.mkdtemp(prefix='mathster-replay-')
+    try:
+        yield state_dir
+    finally:
+        for key in [key for key in mathster._STORAGE_CACHE if key[1].startswith(state_dir)]:
+            storage = mathster._STORAGE_CACHE.pop(key)
+            if hasattr(storage, 'close'):
+                storage.close()
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+def replay_session(script, backend=None, show=False):
+    """
+    Replay a script against main() in a scratch directory and return what
+    the session ended with. Raises ReplayError when it doesn't end the way
+    the recording did.
+    """
+    backend = backend or script['storage']
+    clock = mathster.ManualClock(script['started'])
+    replayer = Replayer(script['events'], clock)
+    out = sys.stdout if show else NullOutput()
+    def make_renderer(stream=None):
+        renderer = mathster.PlainRenderer(out)
+        renderer.pause = replayer.pause
+        return renderer
+    with _scratch_dir() as state_dir:
+        storage = mathster.get_storage(backend, state_dir=state_dir)
+        if script['state'] is not None:
+            storage.write(script['profile'], json.loads(json.dumps(script['state'])))
+        with patched(mathster, STATE_FILE_DIR=state_dir, STORAGE_BACKEND=backend), patched(sys, stdout=out):
+            _play(script, clock, replayer, make_renderer, lambda stream=None: _ReplayedInput(replayer), _state_file(state_dir, script['profile']))
+        replayer.finish()
+        ended = outcome(storage.read(script['profile']))
+    if ended != script['outcome']:
+        raise ReplayError("The session ended with {} but the recording with {}".format(json.dumps(ended, sort_keys=True), json.dumps(script['outcome'], sort_keys=True)))
+    return ended
+
+def load_script(path):
+    with open(path, 'r') as sfile:
+        script = json.load(sfile)
+    if script.get('version') != SCRIPT_VERSION:
+        raise ReplayError("{} is not a version {} session script".format(path, SCRIPT_VERSION))
+    if script['python'].split('.')[0] != platform.python_version().split('.')[0]:
+        #The random number generator is seeded differently
+        sys.stderr.write("WARNING! {} was recorded on Python {}, it can only be replayed exactly on Python {} too\n".format(
+            path, script['python'], script['python'].split('.')[0]))
+    return script
+
+def _profile_rows(stats, top):
+    """
+    Return the top functions of merged cProfile stats by time spent in them
+    """
+    rows = sorted(stats.items(), key=lambda item: -item[1][1])[:top]
+    return [{'function': function, 'calls': calls, 'total_sec': total, 'cumulative_sec': cumulative} for function, (calls, total, cumulative) in rows]
+
+def _loadtest_chunk(config, start, stop):
+    """
+    Replay scripts start to stop-1 (round robin over config['scripts']) and
+    return the questions answered, timings and profiles
+    """
+    scripts = config['scripts']
+    profiler = cProfile.Profile() if config['cpu_profile'] else None
+    if config['alloc_profile']:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+    errors = []
+    asked = 0
+    wall = mathster.perf_timer()
+    cpu = cpu_timer()
+    for num in range(start, stop):
+        script = scripts[num % len(scripts)]
+        if profiler is not None:
+            profiler.enable()
+        try:
+            replay_session(script, config['storage'])
+            asked += script['questions']
+        except ReplayError as error:
+            errors.append(str(error))
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    chunk = {
+        'replays': stop - start,
+        'questions': asked,
+        'wall_sec': mathster.perf_timer() - wall,
+        'cpu_sec': cpu_timer() - cpu,
+        'errors': errors,
+    }
+    if config['alloc_profile']:
+        #Only what is still reachable counts as retained
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        chunk['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        #Leave out what the profilers themselves hold on to
+        ignored = [tracemalloc.Filter(False, module.__file__) for module in (tracemalloc, cProfile, pstats)]
+        ignored.append(tracemalloc.Filter(False, os.path.splitext(__file__)[0] + '.py'))
+        chunk['alloc_profile'] = dict(
+            (str(stat.traceback), (stat.size_diff, stat.count_diff))
+            for stat in after.filter_traces(ignored).compare_to(before.filter_traces(ignored), 'lineno') if stat.size_diff > 0
+        )
+    if profiler is not None:
+        chunk['cpu_profile'] = dict(
+            ('{}:{}({})'.format(*function), (calls, total, cumulative))
+            for function, (_, calls, total, cumulative, _) in pstats.Stats(profiler).stats.items()
+        )
+    return chunk
+
+def run_loadtest(config, workers=None):
+    """
+    Run config['replays'] replays across worker processes and return the
+    questions per second, with the merged profiles when asked for
+    """
+    replays = config['replays']
+    if not workers:
+        workers = getattr(os, 'cpu_count', lambda: 1)() or 1
+    chunk_size = max(1, int(math.ceil(replays / float(workers))))
+    chunks = [(config, start, min(start + chunk_size, replays)) for start in range(0, replays, chunk_size)]
+    started = mathster.perf_timer()
+    done = mathster.parallel_map(_loadtest_chunk, chunks, workers)
+    wall = mathster.perf_timer() - started
+    asked = sum(chunk['questions'] for chunk in done)
+    cpu = sum(chunk['cpu_sec'] for chunk in done)
+    errors = [error for chunk in done for error in chunk['errors']]
+    report = {
+        'replays': replays,
+        'workers': len(chunks),
+        'questions': asked,
+        'wall_sec': wall,
+        'questions_per_sec': asked / wall if wall else None,
+        'questions_per_sec_per_worker': [chunk['questions'] / chunk['wall_sec'] if chunk['wall_sec'] else None for chunk in done],
+        'cpu_sec': cpu,
+        'cpu_ms_per_question': cpu * 1000 / asked if asked else None,
+        'diverged': len(errors),
+        'first_error': errors[0] if errors else None,
+    }
+    if config['cpu_profile']:
+        stats = {}
+        for chunk in done:
+            for function, (calls, total, cumulative) in chunk['cpu_profile'].items():
+                merged = stats.get(function, (0, 0.0, 0.0))
+                stats[function] = (merged[0] + calls, merged[1] + total, merged[2] + cumulative)
+        report['cpu_profile'] = _profile_rows(stats, config['top'])
+    if config['alloc_profile']:
+        lines = {}
+        for chunk in done:
+            for line, (size, count) in chunk['alloc_profile'].items():
+                merged = lines.get(line, (0, 0))
+                lines[line] = (merged[0] + size, merged[1] + count)
+        report['peak_bytes'] = max(chunk['peak_bytes'] for chunk in done)
+        report['alloc_profile'] = [{'line': line, 'bytes': size, 'blocks': count}
+                                   for line, (size, count) in sorted(lines.items(), key=lambda item: -item[1][0])[:config['top']]]
+    return report
+
+def record_main(args):
+    if os.path.exists(args.script) and not mathster.get_user_input(prompt='{} already exists, overwrite it? (y/n)'.format(args.script), yesno=True):
+        return 1
+    script = record_session(args.profile, max_min=args.minutes, seed=args.seed, restart=args.restart)
+    out = mathster._open_output(args.script)
+    try:
+        json.dump(script, out, indent=1, sort_keys=True)
+        out.write('\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print("Recorded {} questions ({} events) to: {}".format(script['questions'], len(script['events']), args.script))
+    return 0
+
+def replay_main(args):
+    try:
+        script = load_script(args.script)
+        started = mathster.perf_timer()
+        replay_session(script, args.storage, show=args.show)
+    except ReplayError as error:
+        print("ERROR! Replay of {} diverged: {}".format(args.script, error))
+        return 1
+    elapsed = mathster.perf_timer() - started
+    print("Replayed {} questions in {:.3f} seconds, the session ended the way it was recorded".format(script['questions'], elapsed))
+    return 0
+
+def loadtest_main(args):
+    if args.alloc_profile and tracemalloc is None:
+        print("ERROR! Allocation profiles need tracemalloc (Python 3)")
+        return 1
+    try:
+        scripts = [load_script(path) for path in args.scripts]
+    except ReplayError as error:
+        print("ERROR! {}".format(error))
+        return 1
+    config = {
+        'scripts': scripts,
+        'replays': args.replays,
+        'storage': args.storage,
+        'cpu_profile': args.cpu_profile,
+        'alloc_profile': args.alloc_profile,
+        'top': args.top,
+    }
+    report = run_loadtest(config, workers=args.workers)
+    report['scripts'] = args.scripts
+    report['python'] = platform.python_version()
+    out = mathster._open_output(args.output)
+    try:
+        out.write(json.dumps(report, indent=4, sort_keys=True) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 1 if report['diverged'] else 0
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='mathster.py', description="Record, replay and load test sessions of the interactive game")
+    subparsers = parser.add_subparsers(dest='command')
+    record_parser = subparsers.add_parser('record', help="Play a session and record it")
+    record_parser.add_argument('profile')
+    record_parser.add_argument('script', help="Where to write the session script")
+    record_parser.add_argument('--minutes', type=int, default=mathster.MAX_MIN, help="Session length (default={})".format(mathster.MAX_MIN))
+    record_parser.add_argument('--seed', type=int, help="Random seed (default=a random one, saved in the script)")
+    record_parser.add_argument('--restart', action='store_true', help="Start the profile over instead of resuming it")
+    replay_parser = subparsers.add_parser('replay', help="Replay a recorded session and check it ends the same way")
+    replay_parser.add_argument('script')
+    replay_parser.add_argument('--storage', choices=sorted(mathster.STORAGE_BACKENDS), help="Storage backend to replay on (default=the recorded one)")
+    replay_parser.add_argument('--show', action='store_true', help="Print the game while it replays")
+    loadtest_parser = subparsers.add_parser('loadtest', help="Replay sessions across worker processes and measure questions per second")
+    loadtest_parser.add_argument('scripts', nargs='+')
+    loadtest_parser.add_argument('--replays', type=int, default=100, help="Replays in total, taking the scripts in turn (default=100)")
+    loadtest_parser.add_argument('--workers', type=int, help="Worker processes (default=one per CPU)")
+    loadtest_parser.add_argument('--storage', choices=sorted(mathster.STORAGE_BACKENDS), help="Storage backend to replay on (default=the recorded one)")
+    loadtest_parser.add_argument('--cpu-profile', action='store_true', help="Profile the replays with cProfile")
+    loadtest_parser.add_argument('--alloc-profile', action='store_true', help="Trace memory allocations of the replays with tracemalloc")
+    loadtest_parser.add_argument('--top', type=int, default=PROFILE_TOP, help="Entries in each profile (default={})".format(PROFILE_TOP))
+    loadtest_parser.add_argument('--output', default='-', help="JSON file to write (default=stdout)")
+    args = parser.parse_args(argv)
+    if args.command == 'record':
+        return record_main(args)
+    elif args.command == 'replay':
+        return replay_main(args)
+    elif args.command == 'loadtest':
+        return loadtest_main(args)
+    parser.print_help()
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+"""
+Serve many mathster sessions from a single process.
+
+Every connection gets its own Session (profile, timer and reward minutes) and
+all of them share one asyncio event loop. Nothing in the loop sleeps or
+clears the screen, and all disk work is handed to one background thread so a
+slow disk doesn't hold up other learners.
+
+The protocol is plain text, one line per message, so it can be used with
+netcat as well as the bundled client.
+
+Client to server:
+    PROFILE <name> [minutes]              Start a session on an existing profile
+    NEW <name> <op,op,...> [minutes]      Create a profile and start a session on it
+    <integer>                             Answer the current problem
+    QUIT                                  Save and disconnect
+
+Server to client:
+    STATUS level=.. complete=.. score=.. reward_mins=.. num_probs=.. mastered=.. time_left=..
+    PROBLEM <lh> <op> <rh>
+    RESULT correct|wrong answer=.. points=.. bonus=0|1 duration=..
+    LEVEL <level>
+    TIMEUP
+    BYE score=.. reward_mins=..
+    ERR <message>
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import mathster
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 4242
+
+def _report_error(future):
+    """
+    Print errors from background storage work, nobody else will see them
+    """
+    error = future.exception()
+    if error is not None:
+        sys.stderr.write("ERROR! Background save failed: {!r}\n".format(error))
+
+class BackgroundStorage(object):
+    """
+    Wrap a storage backend so all of its disk work happens, in order, on one
+    background thread.
+
+    Snapshots are copied in the calling thread before being handed off, so
+    the session can keep changing while the write is in progress.
+    """
+    def __init__(self, storage, executor):
+        self.storage = storage
+        self.executor = executor
+        self.name = storage.name
+
+    def submit(self, func, *args):
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(_report_error)
+        return future
+
+    def location(self, profile):
+        return self.storage.location(profile)
+
+    def write(self, profile, state, journal=None):
+        state = json.loads(json.dumps(state, default=mathster._json_default))
+        if journal is None:
+            return self.submit(self.storage.write, profile, state)
+        journal.pending = 0
+        return self.submit(lambda: self.storage.write(profile, state, journal.inner()))
+
+    def journal(self, profile, seq=0):
+        return QueuedJournal(self, profile, seq)
+
+class QueuedJournal(object):
+    """
+    A journal whose appends are queued for the background storage thread
+    """
+    def __init__(self, background, profile, seq=0):
+        self.background = background
+        self.profile = profile
+        self.seq = seq
+        self.pending = 0
+        self._start_seq = seq
+        self._inner = None
+
+    def inner(self):
+        """
+        Return the real journal, only called from the background thread
+        """
+        if self._inner is None:
+            self._inner = self.background.storage.journal(self.profile, seq=self._start_seq)
+        return self._inner
+
+    def append(self, event):
+        self.seq += 1
+        self.pending += 1
+        self.background.submit(lambda: self.inner().append(event))
+
+    def truncate(self):
+        self.pending = 0
+
+    def close(self):
+        self.background.submit(self._close)
+
+    def _close(self):
+        if self._inner is not None:
+            self._inner.close()
+            self._inner = None
+
+class SessionServer(object):
+    """
+    Run a Session for every connected learner
+    """
+    def __init__(self, storage, max_min=mathster.MAX_MIN):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.storage = BackgroundStorage(storage, self.executor)
+        self.max_min = max_min
+        self.active = set()
+
+    async def _read(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _start(self, line):
+        """
+        Create the Session asked for by a PROFILE or NEW line, returns (session, error)
+        """
+        parts = line.split()
+        if not parts or parts[0].upper() not in ('PROFILE', 'NEW'):
+            return None, "expected PROFILE <name> [minutes] or NEW <name> <op,op,...> [minutes]"
+        command, args = parts[0].upper(), parts[1:]
+        minutes = self.max_min
+        try:
+            if command == 'PROFILE' and len(args) == 2:
+                minutes = int(args[1])
+            elif command == 'NEW' and len(args) == 3:
+                minutes = int(args[2])
+        except ValueError:
+            return None, "minutes must be an integer"
+        if not args:
+            return None, "missing profile name"
+        profile = args[0]
+        if profile in self.active:
+            return None, "profile {} is already playing".format(profile)
+        #Claim the profile before waiting on the disk so nobody else can start it meanwhile
+        self.active.add(profile)
+        state = await self._read(self.storage.storage.read, profile)
+        error = None
+        if command == 'PROFILE':
+            if state is None:
+                error = "unknown profile {}".format(profile)
+        elif state is not None:
+            error = "profile {} already exists".format(profile)
+        elif len(args) < 2:
+            error = "missing operators"
+        else:
+            operators = args[1].split(',')
+            unknown = set(operators).difference(mathster.KNOWN_OPERATORS)
+            if unknown:
+                error = "unknown operator(s): {}".format(', '.join(sorted(unknown)))
+            state = mathster.new_state(
+                left_hand=list(mathster.LEFT_HAND),
+                right_hand=list(mathster.RIGHT_HAND),
+                operators=operators,
+                canonical=mathster.CANONICAL_PROBLEMS == 'yes',
+                rewards_enabled=True,
+            )
+        if error:
+            self.active.discard(profile)
+            return None, error
+        return mathster.Session(state, storage=self.storage, profile=profile, max_min=minutes), None
+
+    async def handle(self, reader, writer):
+        def send(line):
+            writer.write((line + '\n').encode('utf-8'))
+        session = None
+        try:
+            while session is None:
+                line = await reader.readline()
+                if not line:
+                    return
+                session, error = await self._start(line.decode('utf-8', 'replace'))
+                if error:
+                    send("ERR {}".format(error))
+                    await writer.drain()
+            await self._play(session, reader, send, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if session is not None:
+                self.active.discard(session.profile)
+                session.save()
+                #Queued behind the save on the storage thread
+                session.journal.close()
+                send("BYE score={} reward_mins={:.3f}".format(session.score, session.reward_mins))
+            try:
+                await writer.drain()
+                writer.close()
+            except ConnectionError:
+                pass
+
+    async def _play(self, session, reader, send, writer):
+        #Building the library can take a while for big problem spaces, keep it off the event loop
+        await self._read(session.load)
+        while True:
+            level = session.level
+            problem = session.next_problem()
+            if session.level != level:
+                send("LEVEL {}".format(session.level))
+            progress = session.progress()
+            send("STATUS level={level} complete={complete} score={score} reward_mins={reward_mins:.3f} num_probs={num_probs} mastered={mastered} time_left={time_left}".format(
+                time_left=int(session.time_left()),
+                **progress
+            ))
+            send("PROBLEM {0} {2} {1}".format(*session.display()))
+            while True:
+                await writer.drain()
+                try:
+                    line = await asyncio.wait_for(reader.readline(), timeout=max(session.time_left(), 0))
+                except asyncio.TimeoutError:
+                    session.timeout()
+                    send("TIMEUP")
+                    return
+                if not line:
+                    return
+                line = line.decode('utf-8', 'replace').strip()
+                if line.upper() in ('QUIT', 'EXIT'):
+                    return
+                division = session.library.space.division if session.problem[2] == '/' else None
+                try:
+                    answer = mathster.parse_answer(line, division)
+                except (ValueError, ZeroDivisionError):
+                    send("ERR answer must be {}".format("a number " + mathster.ANSWER_HINTS[division] if division in mathster.ANSWER_HINTS else "an integer"))
+                    continue
+                break
+            result = session.submit(answer)
+            send("RESULT {} answer={} points={} bonus={} duration={:.3f}".format(
+                'correct' if result.correct else 'wrong',
+                mathster.format_answer(result.correct_answer).replace(' ', ''),
+                result.points,
+                int(result.bonus),
+                result.duration,
+            ))
+            if result.time_up:
+                send("TIMEUP")
+                return
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        print("Serving mathster on {}:{} (profiles in {})".format(host, port, self.storage.location('*')))
+        sys.stdout.flush()
+        async with server:
+            await server.serve_forever()
+
+def serve_main(args):
+    if args.state_dir:
+        mathster.STATE_FILE_DIR = args.state_dir
+    if not os.path.isdir(mathster.STATE_FILE_DIR):
+        os.mkdir(mathster.STATE_FILE_DIR)
+    storage = mathster.get_storage(args.storage)
+    server = SessionServer(storage, max_min=args.minutes)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.executor.shutdown(wait=True)
+    return 0
+
+def client_main(args):
+    """
+    Play a session on a server from the terminal
+    """
+    conn = socket.create_connection((args.host, args.port))
+    rfile = conn.makefile('r')
+    def send(line):
+        conn.sendall((line + '\n').encode('utf-8'))
+    if args.new:
+        send("NEW {} {} {}".format(args.profile, args.new, args.minutes))
+    else:
+        send("PROFILE {} {}".format(args.profile, args.minutes))
+    def ask(prompt, division):
+        while True:
+            try:
+                answer = mathster.text_input(prompt).strip()
+            except (EOFError, KeyboardInterrupt):
+                answer = 'exit'
+            if answer == 'exit':
+                return 'QUIT'
+            #Only the server knows how division answers are written, it says so if they're wrong
+            if division:
+                return answer
+            try:
+                int(answer)
+            except ValueError:
+                print("Incorrect integer inputed: '{}'".format(answer))
+                continue
+            return answer
+    prompt = division = None
+    for line in rfile:
+        kind, _, rest = line.strip().partition(' ')
+        if kind == 'STATUS':
+            fields = dict(field.split('=', 1) for field in rest.split())
+            print("\n### Level: {level} Complete: %{complete} ###\nCurrent Score: {score} ({reward_mins} reward mins)\nLibrary of problems: {num_probs} mastered: {mastered}\nTime Left: {time_left} seconds".format(**fields))
+        elif kind == 'PROBLEM':
+            prompt = "\n  Solve the problem:\n\n    {} = ?\n\nEnter your answer: ".format(rest)
+            division = rest.split()[1] == '/'
+            send(ask(prompt, division))
+        elif kind == 'RESULT':
+            fields = dict(field.split('=', 1) for field in rest.split()[1:])
+            if rest.startswith('correct'):
+                print("Correct! Your answer was worth: {} points!".format(fields['points']))
+            else:
+                print("I'm sorry, that's not quite right!\n\nAnswer: {}".format(fields['answer']))
+        elif kind == 'LEVEL':
+            print("CONGRATURATLIONS!!! You've progressed to level {}".format(rest))
+        elif kind == 'TIMEUP':
+            print("Time is UP!")
+        elif kind == 'ERR':
+            print("ERROR! {}".format(rest))
+            if not rest.startswith('answer'):
+                break
+            send(ask(prompt, division))
+        elif kind == 'BYE':
+            print("Goodbye! {}".format(rest))
+            break
+    conn.close()
+    return 0
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100.0))]
+
+async def _loadgen_learner(host, port, name, operators, answers, think, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    async def send(line):
+        writer.write((line + '\n').encode('utf-8'))
+        await writer.drain()
+    await send("PROFILE {} 90".format(name))
+    answered = 0
+    sent_at = None
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        kind, _, rest = line.decode('utf-8').strip().partition(' ')
+        if kind == 'ERR' and rest.startswith('unknown profile'):
+            await send("NEW {} {} 90".format(name, operators))
+        elif kind == 'PROBLEM':
+            if sent_at is not None:
+                latencies.append(time.time() - sent_at)
+            if answered >= answers:
+                await send("QUIT")
+                continue
+            lh, op, rh = rest.split()
+            if think:
+                await asyncio.sleep(think)
+            sent_at = time.time()
+            answered += 1
+            await send(mathster.format_answer(mathster.get_ans(int(lh), int(rh), op, mathster.DIVISION_MODE)[0]))
+        elif kind in ('BYE', 'TIMEUP') or (kind == 'ERR' and not rest.startswith('answer')):
+            break
+    writer.close()
+    return answered
+
+async def _loadgen(args):
+    latencies = []
+    started = time.time()
+    counts = await asyncio.gather(*[
+        _loadgen_learner(args.host, args.port, '{}{}'.format(args.prefix, idx), args.operators, args.answers, args.think, latencies)
+        for idx in range(args.sessions)
+    ])
+    elapsed = time.time() - started
+    latencies.sort()
+    return {
+        'sessions': args.sessions,
+        'answers': sum(counts),
+        'seconds': elapsed,
+        'answers_per_sec': sum(counts) / elapsed if elapsed else 0.0,
+        'latency_p50_ms': _percentile(latencies, 50) * 1000,
+        'latency_p99_ms': _percentile(latencies, 99) * 1000,
+        'latency_max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+    }
+
+def loadgen_main(args):
+    """
+    Drive many scripted learners against a server and report its throughput
+    """
+    server = None
+    state_dir = None
+    if args.spawn:
+        #Run the server in its own process (and so its own core) against a scratch profile directory
+        state_dir = tempfile.mkdtemp(prefix='mathster-loadgen-')
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mathster.py'), 'serve',
+             '--host', args.host, '--port', str(args.port), '--state-dir', state_dir, '--storage', args.storage],
+            stdout=subprocess.PIPE,
+        )
+        server.stdout.readline()
+    try:
+        report = asyncio.run(_loadgen(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            shutil.rmtree(state_dir, ignore_errors=True)
+    print(json.dumps(report, indent=4))
+    return 0
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='mathster.py', description="Multi-learner mathster server, client and load generator")
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help="Serve sessions over TCP")
+    serve_parser.add_argument('--host', default=DEFAULT_HOST)
+    serve_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument('--minutes', type=int, default=mathster.MAX_MIN, help="Default session length")
+    serve_parser.add_argument('--state-dir', help="Profile directory (default: {})".format(mathster.STATE_FILE_DIR))
+    serve_parser.add_argument('--storage', choices=sorted(mathster.STORAGE_BACKENDS), default=mathster.STORAGE_BACKEND)
+    client_parser = subparsers.add_parser('client', help="Play a session on a server")
+    client_parser.add_argument('profile')
+    client_parser.add_argument('--host', default=DEFAULT_HOST)
+    client_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    client_parser.add_argument('--minutes', type=int, default=mathster.MAX_MIN)
+    client_parser.add_argument('--new', metavar='OPERATORS', help="Create the profile with these comma separated operators")
+    loadgen_parser = subparsers.add_parser('loadgen', help="Measure how many sessions a server sustains")
+    loadgen_parser.add_argument('--host', default=DEFAULT_HOST)
+    loadgen_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    loadgen_parser.add_argument('--sessions', type=int, default=100, help="Concurrent learners")
+    loadgen_parser.add_argument('--answers', type=int, default=50, help="Answers per learner")
+    loadgen_parser.add_argument('--think', type=float, default=0.0, help="Seconds each learner waits before answering")
+    loadgen_parser.add_argument('--operators', default='+,-,*')
+    loadgen_parser.add_argument('--prefix', default='loadgen-', help="Profile name prefix")
+    loadgen_parser.add_argument('--spawn', action='store_true', help="Start a server with a scratch profile directory")
+    loadgen_parser.add_argument('--storage', choices=sorted(mathster.STORAGE_BACKENDS), default=mathster.STORAGE_BACKEND)
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        return serve_main(args)
+    elif args.command == 'client':
+        return client_main(args)
+    elif args.command == 'loadgen':
+        return loadgen_main(args)
+    parser.print_help()
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,143 @@
+import random
+import shutil
+import tempfile
+import unittest
+
+import mathster
+
+def legacy_state(left_hand, right_hand, operators, tuples):
+    """
+    Return a save state the way versions before the lazy ProblemSpace wrote
+    them, with every remaining problem listed under 'tuples'
+    """
+    return {
+        'left_hand': left_hand,
+        'right_hand': right_hand,
+        'operators': operators,
+        'tuples': [list(problem) for problem in tuples],
+        'results': {
+            'mastered': mathster.ProblemPool(),
+            'needs_work': mathster.ProblemPool(),
+        },
+    }
+
+def naive_grid(left_hand, right_hand, operators):
+    """
+    The problems the original gen_tuples() paired up, every left with every right hand
+    """
+    return [(lh, rh, op) for lh in left_hand for rh in right_hand for op in operators]
+
+class TuplesMigrationTest(unittest.TestCase):
+    def test_product_division_problems_start_unretired(self):
+        hand = [1, 2, 3, 4]
+        state = legacy_state(hand, hand, ['+', '/'], naive_grid(hand, hand, ['+', '/']))
+        library = mathster.load_library(state)
+        self.assertEqual(len(library.retired), 0)
+        for problem in [(6, 2, '/'), (8, 4, '/'), (16, 4, '/')]:
+            self.assertIn(problem, library.space)
+            self.assertNotIn(problem, library.retired)
+        self.assertNotIn('tuples', state)
+
+    def test_problems_missing_from_tuples_are_retired(self):
+        hand = [1, 2, 3, 4]
+        done = [(2, 3, '+'), (4, 2, '/'), (3, 1, '/')]
+        tuples = [problem for problem in naive_grid(hand, hand, ['+', '/']) if problem not in done]
+        library = mathster.load_library(legacy_state(hand, hand, ['+', '/'], tuples))
+        self.assertEqual(sorted(library.retired), sorted(done))
+
+class GradeBatchTest(unittest.TestCase):
+    def test_points_and_bonus(self):
+        bonus = mathster.SCORING_MATRIX['bonus']
+        grades = mathster.grade_batch([
+            ((2, 3, '*'), 6, 1.0),
+            ((2, 3, '*'), 5, 1.0),
+            ((2, 3, '*'), 6, 9.0),
+            ((2, 3, '+'), 5, None),
+        ], reward_time=5)
+        self.assertEqual(grades, [(True, 1 + bonus), (False, 0), (True, 1), (True, mathster.SCORING_MATRIX['default'])])
+
+    def test_remainder_division(self):
+        grades = mathster.grade_batch([((17, 5, '/'), (3, 2), None), ((17, 5, '/'), (3, 0), None)], division='remainder')
+        self.assertEqual([correct for correct, points in grades], [True, False])
+
+class GradeAnswersTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp(prefix='mathster-test-')
+        self.storage = mathster.JsonStorage(self.state_dir)
+        self.storage.write('kid', mathster.new_state(left_hand=[1, 2, 3], right_hand=[1, 2, 3], operators=['*']))
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    def test_wrong_answers_without_durations_reach_the_report(self):
+        rows = [
+            {'student': 'kid', 'lh': '2', 'op': '*', 'rh': '3', 'answer': '5'},
+            {'student': 'kid', 'lh': '2', 'op': '*', 'rh': '3', 'answer': '6'},
+            {'student': 'kid', 'lh': '3', 'op': '*', 'rh': '3', 'answer': '8'},
+            {'student': 'kid', 'lh': '1', 'op': '*', 'rh': '3', 'answer': '3', 'duration': '2.5'},
+        ]
+        totals = mathster.grade_answers(rows, self.storage)
+        self.assertEqual(totals['kid']['wrong'], 2)
+        report = mathster.Report()
+        row = report.add('kid', self.storage.read('kid'))
+        fields = dict(zip(mathster.REPORT_PROFILE_FIELDS, row))
+        self.assertEqual((fields['answers'], fields['wrong']), (4, 2))
+        facts = dict(((fact[0], fact[1], fact[2]), dict(zip(mathster.REPORT_FACT_FIELDS, fact))) for fact in report.fact_rows())
+        self.assertEqual((facts[(2, '*', 3)]['answers'], facts[(2, '*', 3)]['wrong']), (2, 1))
+        self.assertTrue(facts[(1, '*', 3)]['median_sec'] > 0)
+
+class SharedProfileTest(unittest.TestCase):
+    """
+    Two sessions of one profile end up with the same saved state on every backend
+    """
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp(prefix='mathster-test-')
+
+    def tearDown(self):
+        for key in [key for key in mathster._STORAGE_CACHE if key[1].startswith(self.state_dir)]:
+            storage = mathster._STORAGE_CACHE.pop(key)
+            if hasattr(storage, 'close'):
+                storage.close()
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    def storage(self, backend):
+        storage = mathster.get_storage(backend, self.state_dir)
+        storage.write('p', mathster.new_state(left_hand=[1, 2, 3, 4], right_hand=[1, 2, 3, 4], operators=['+']))
+        return storage
+
+    def session(self, storage, seed=1):
+        return mathster.Session(storage.read('p'), storage=storage, profile='p', rng=random.Random(seed))
+
+    def answer(self, session, problem, correct):
+        session.problem, session.problem_start = problem, session.clock()
+        return session.submit(session.lookup(problem)[0] if correct else -1)
+
+    def test_saving_without_answers_keeps_other_sessions_answers(self):
+        for backend in sorted(mathster.STORAGE_BACKENDS):
+            storage = self.storage(backend)
+            idle = self.session(storage)
+            player = self.session(storage, seed=2)
+            points = sum(self.answer(player, player.next_problem(), True).points for _ in range(5))
+            player.save()
+            idle.save()
+            state = storage.read('p')
+            self.assertEqual(state['score'], points, backend)
+            self.assertEqual(len(state['results']['mastered']) + len(state['results']['needs_work']), 5, backend)
+
+    def test_needs_work_is_merged_over_sessions(self):
+        for backend in sorted(mathster.STORAGE_BACKENDS):
+            storage = self.storage(backend)
+            wrong = self.session(storage)
+            right = self.session(storage, seed=2)
+            problems = [wrong.next_problem() for _ in range(4)]
+            for problem in problems:
+                self.answer(wrong, problem, False)
+                self.answer(right, problem, True)
+            right.save()
+            wrong.save()
+            state = storage.read('p')
+            self.assertEqual(sorted(state['results']['needs_work']), sorted(set(problems)), backend)
+            self.assertEqual(len(state['results']['mastered']), 0, backend)
+
+if __name__ == '__main__':
+    unittest.main()